@@ -15,20 +15,24 @@ Maintained by: Amanda Steinhebel, amanda.l.steinhebel@nasa.gov
 from typing import Dict
 from core.spi import Spi 
 from core.nexysio import Nexysio
-from core.decode import Decode
+from core.decode import Decode, StreamingDecoder, TelescopeDecoder
 from core.injectionboard import Injectionboard
 from core.voltageboard import Voltageboard
 from core.asic import Asic
 from bitstring import BitArray
 from tqdm import tqdm
+import numpy as np
 import pandas as pd
 import regex as re
+import threading
 import time
 import yaml
 import os
 
 # Logging stuff
 import logging
+from modules.rawdata import RECORD_HEADER
+from modules.calibration import get_calibration
 from modules.setup_logger import logger
 logger = logging.getLogger(__name__)
 
@@ -37,7 +41,7 @@ class astropix3:
     # Init just opens the chip and gets the handle. After this runs
     # asic_config also needs to be called to set it up. Seperating these 
     # allows for simpler specifying of values. 
-    def __init__(self, clock_period_ns = 5, inject:int = None, offline:bool=False):
+    def __init__(self, clock_period_ns = 5, inject:int = None, offline:bool=False, simulate:bool=False):
         """
         Initalizes astropix object. 
         No required arguments
@@ -45,6 +49,8 @@ class astropix3:
         clock_period_ns:int - period of main clock in ns
         inject:bool - if set to True will enable injection for the whole array.
         offline:bool - if True, do not try to interface with chip
+        simulate:bool - if True, use a simulated Nexys (core/simulator.py) instead of hardware. 
+                        Hit rate can be changed with self.handle.hitrate
         """
 
         # _asic_start tracks if the inital configuration has been run on the ASIC yet.
@@ -58,8 +64,11 @@ class astropix3:
         else:
             self._asic_start = False
             self.nexys = Nexysio()
-            self._wait_progress(2)
-            self.handle = self.nexys.autoopen() 
+            if simulate:
+                self.handle = self.nexys.simulate()
+            else:
+                self._wait_progress(2)
+                self.handle = self.nexys.autoopen() 
                 
             # Ensure it is working
             logger.info("Opened FPGA, testing...")
@@ -74,6 +83,11 @@ class astropix3:
         self.sampleclock_period_ns = clock_period_ns
         # Creates objects used later on
         self.decode = Decode(clock_period_ns)
+        self.stream_decoder = StreamingDecoder(clock_period_ns)
+        # Calibration per chip ID, applied after decoding if set
+        self.calibration = {}
+        # Empty decoded dataframe per chip ID, most readouts have no hits
+        self._empty_hits = {}
 
 ##################### YAML INTERACTIONS #########################
 #reading done in core/asic.py
@@ -86,6 +100,20 @@ class astropix3:
         :param filename: Name of yml file in config folder
         """
 
+        with open(f"{filename}", "w", encoding="utf-8") as stream:
+            try:
+                yaml.dump(self._conf_dict(), stream, default_flow_style=False, sort_keys=False)
+
+            except yaml.YAMLError as exc:
+                logger.error(exc)
+
+    def get_conf_yaml(self):
+        """
+        Returns ASIC config as yaml string, in the same format as write_conf_to_yaml
+        """
+        return yaml.dump(self._conf_dict(), default_flow_style=False, sort_keys=False)
+
+    def _conf_dict(self):
         dicttofile ={self.asic.chip:
             {
                 "telescope": {"nchips": self.asic.num_chips},
@@ -99,12 +127,7 @@ class astropix3:
         else:
             dicttofile[self.asic.chip]['config'] = self.asic.asic_config
 
-        with open(f"{filename}", "w", encoding="utf-8") as stream:
-            try:
-                yaml.dump(dicttofile, stream, default_flow_style=False, sort_keys=False)
-
-            except yaml.YAMLError as exc:
-                logger.error(exc)
+        return dicttofile
         
 
 ##################### ASIC METHODS FOR USERS #########################
@@ -154,6 +177,10 @@ class astropix3:
             self.asic.enable_inj_col(self.injection_col, inplace=False)
             self.asic.enable_inj_row(self.injection_row, inplace=False)
 
+        # Telescope readout stream is demultiplexed by chip ID
+        if self.asic.num_chips > 1:
+            self.telescope_decoder = TelescopeDecoder(self.asic.num_chips, self.sampleclock_period_ns)
+
         # Load config it to the chip
         logger.info("LOADING TO ASIC...")
         self.asic_update()
@@ -166,6 +193,22 @@ class astropix3:
     def disable_pixel(self, col: int, row: int, inplace:bool=True):
        self.asic.disable_pixel(col, row, inplace)
 
+    def get_pixel_mask(self, chip:int = 0):
+        """
+        Returns PixelMask (core/pixelmask.py) with comparator, injection and analog output state
+        chip:int - Chip number in telescope setup
+        """
+        return self.asic.get_pixel_mask(chip)
+
+    def set_pixel_mask(self, mask, chip:int = 0, inplace:bool=True):
+        """
+        Sets comparator, injection and analog output state from a PixelMask in one update
+        mask:PixelMask - Mask, e.g. from get_pixel_mask
+        chip:int - Chip number in telescope setup
+        inplace:bool - True - Updates asic after updating pixel mask
+        """
+        self.asic.set_pixel_mask(mask, chip, inplace)
+
     #Turn on injection of different pixel than the one used in _init_
     def enable_injection(self, col:int, row:int, inplace:bool=True):
         self.asic.enable_inj_col(col, inplace)
@@ -173,9 +216,23 @@ class astropix3:
 
     # The method to write data to the asic. Called whenever somthing is changed
     # or after a group of changes are done. Taken straight from asic.py.
-    def asic_update(self):
-        self.nexys.chip_reset()        
-        self.asic.asic_update()
+    def asic_update(self, force:bool=False):
+        """
+        Resets the chip and uploads the config. The reset is always done, e.g. to rearm the chip after a readout,
+        only the upload is skipped if the config did not change since the last upload.
+
+        force:bool - Upload even if the config is unchanged
+        """
+        return self.asic.asic_update(force=force, reset=True)
+
+    def batch_update(self):
+        """
+        Context manager to batch config changes into one upload at the end. 
+        Usage:
+        with astro.batch_update():
+            astro.disable_pixel(col, row)
+        """
+        return self.asic.batch_update()
 
 
     # Methods to update the internal variables. Please don't do it manually
@@ -215,6 +272,18 @@ class astropix3:
         self.nexys.send_routing_cmd()
         logger.info("SPI ENABLED")
 
+    def asic_update_spi(self, chips:list = None, force:bool=False):
+        """
+        Uploads the config of telescope chips addressed by chip ID via SPI. SPI has to be enabled.
+        Chips with unchanged config are skipped. 
+
+        chips:list - Chip IDs to update, default all chips
+        force:bool - Upload even if the config is unchanged
+
+        Returns list of updated chip IDs
+        """
+        return self.asic.asic_update_spi(chips, force)
+
     def close_connection(self):
         """
         Terminates the spi bus.
@@ -270,6 +339,35 @@ class astropix3:
         # Send config to the chip
         self.vboard.update_vb()
 
+    def update_threshold(self, vthreshold:float):
+        """
+        Sets the threshold voltage on the voltage board. Only the voltage board is updated,
+        the ASIC config is left as it is, so this can be used between scan steps.
+
+        vthreshold:float - ToT threshold value. UNITS: mV
+        """
+        try:
+            self._voltages_exist
+        except Exception:
+            raise RuntimeError("init_voltages must be called before update_threshold!")
+
+        # Turns from mV to V with the 1V offset normally present
+        vth = (vthreshold/1000) + 1
+        if vth > 1.801 or vth < 0:
+            logger.error("Threshold voltage %f mV out of range of sensor!", vthreshold)
+            raise ValueError("Threshold voltage out of range of sensor")
+
+        dacvals = list(self.vboard.dacvalues)
+        dacvals[-1] = vth
+        self.vboard.dacvalues = (len(dacvals), dacvals)
+        self.vboard.update_vb()
+
+    def get_threshold(self):
+        """
+        Returns threshold voltage of the voltage board in mV
+        """
+        return (self.vboard.dacvalues[-1] - 1) * 1000
+
     # Here we have the stuff to run injection
 
     # defaults for the arguments:
@@ -372,6 +470,18 @@ class astropix3:
         else:
             return False
 
+    def get_raw_header(self, args = None):
+        """
+        Returns header dict for a binary raw data file with all settings.
+        args - run script arguments to store with the config
+        """
+        return {
+            'config': self.get_conf_yaml(),
+            'log_header': self.get_log_header(),
+            'args': str(args),
+            'created': time.strftime("%Y%m%d-%H%M%S")
+            }
+
     def get_log_header(self):
         """
         Returns header for use in a log file with all settings.
@@ -466,7 +576,129 @@ class astropix3:
             hit_list.append(hits)
 
         # Much simpler to convert to df in the return statement vs df.concat
-        return pd.DataFrame(hit_list)
+        hits = pd.DataFrame(hit_list)
+
+        if 0 in self.calibration and len(hits):
+            self.calibration[0].apply(hits)
+
+        return hits
+
+    def decode_readout_stream(self, readout:bytearray, i:int, printer: bool = False):
+        """
+        Decodes readout as part of a continuous stream.
+        A hit frame split across two readouts is kept and decoded with the next readout,
+        so readouts can be taken in smaller chunks without losing frames.
+
+        Required argument:
+        readout: Bytearray - readout from sensor, not the printed Hex values
+        i: int - Readout number
+
+        Optional:
+        printer: bool - Print decoded output to terminal
+
+        Returns dataframe with the same columns as decode_readout
+        """
+        return self._hits_dataframe(self.stream_decoder.feed_hits(readout), i, printer)
+
+    def decode_readouts(self, readouts:list, start:int = 0, printer: bool = False):
+        """
+        Decodes a list of readouts as part of a continuous stream with one vectorized decode.
+        Faster than decode_readout_stream per readout for offline decoding.
+
+        Required argument:
+        readouts: list - readouts from sensor, bytes or bytearray
+
+        Optional:
+        start: int - Readout number of the first readout
+        printer: bool - Print decoded output to terminal
+
+        Returns dataframe with the same columns as decode_readout
+        """
+        frames = [self.stream_decoder.feed_hits(readout) for readout in readouts]
+        counts = [len(hits) for hits in frames]
+
+        hits = np.concatenate(frames) if frames else np.empty((0, self.decode.bytesperhit), dtype=np.uint8)
+
+        return self._hits_dataframe(hits, np.repeat(np.arange(start, start + len(readouts)), counts), printer)
+
+    def decode_readout_telescope(self, readout:bytearray, i:int, printer: bool = False):
+        """
+        Decodes readout of a telescope setup as part of a continuous stream.
+        Hits are demultiplexed by chip ID with one sort, each chip is decoded vectorized.
+
+        Required argument:
+        readout: Bytearray - readout from sensor, not the printed Hex values
+        i: int - Readout number
+
+        Optional:
+        printer: bool - Print decoded output to terminal
+
+        Returns dict with a dataframe per chip ID, with the same columns as decode_readout
+        """
+        frames = self.telescope_decoder.demux(readout)
+
+        return {chip: self._hits_dataframe(hits, i, printer, chip) for chip, hits in frames.items()}
+
+    def load_calibration(self, filename:str, kev_per_mv:float = None, chip:int = 0):
+        """
+        Loads a per-pixel calibration array of fit_calibration.py, memory-mapped.
+        Decoded hits of this chip then get the columns charge_mv and, if kev_per_mv is set, energy_kev.
+
+        filename:str - .npy file with the calibration array
+        kev_per_mv:float - Energy per mV injection voltage
+        chip:int - Chip ID in telescope setup
+        """
+        self.calibration[chip] = get_calibration(filename, kev_per_mv)
+        self._empty_hits.pop(chip, None)
+        logger.info("Loaded calibration %s for chip %d", filename, chip)
+
+    def _hits_dataframe(self, frames:np.ndarray, i:int, printer: bool = False, chip:int = 0):
+        """
+        Decodes 5 byte frames of the vectorized decoder to the columns of decode_readout in one dataframe
+        frames: np.ndarray - One frame per row, from StreamingDecoder.feed_hits
+        i: int - Readout number, or array with the readout number of each hit
+        chip: int - Chip ID, selects the calibration
+        """
+        if len(frames) == 0 and chip in self._empty_hits:
+            return self._empty_hits[chip].copy()
+
+        frames = frames.astype(np.int64)
+        tot_msb = frames[:, 3] & 0b1111
+        tot_total = (tot_msb << 8) + frames[:, 4]
+
+        hits = pd.DataFrame({
+            'readout': i,
+            'Chip ID': frames[:, 0] >> 3,
+            'payload': frames[:, 0] & 0b111,
+            'location': frames[:, 1] & 0b111111,
+            'isCol': (frames[:, 1] >> 7).astype(bool),
+            'timestamp': frames[:, 2],
+            'tot_msb': tot_msb,
+            'tot_lsb': frames[:, 4],
+            'tot_total': tot_total,
+            'tot_us': (tot_total * self.sampleclock_period_ns)/1000.0,
+            'hittime': time.time()
+            }, index=pd.RangeIndex(len(frames)))
+
+        if chip in self.calibration:
+            self.calibration[chip].apply(hits)
+
+        if len(hits) == 0:
+            self._empty_hits[chip] = hits.copy()
+
+        # will give terminal output if desiered
+        if printer:
+            for hit in hits.itertuples(index=False):
+                wrong_id        = 0 if (hit[1]) == 0 else '\x1b[0;31;40m{}\x1b[0m'.format(hit[1])
+                wrong_payload   = 4 if (hit[2]) == 4 else'\x1b[0;31;40m{}\x1b[0m'.format(hit[2])
+                print(
+                f"{hit.readout} Header: ChipId: {wrong_id}\tPayload: {wrong_payload}\t"
+                f"Location: {hit.location}\tRow/Col: {'Col' if hit.isCol else 'Row'}\t"
+                f"Timestamp: {hit.timestamp}\t"
+                f"ToT: MSB: {hit.tot_msb}\tLSB: {hit.tot_lsb} Total: {hit.tot_total} ({hit.tot_us} us)"
+                )
+
+        return hits
 
     # To be called when initalizing the asic, clears the FPGAs memory 
     def dump_fpga(self):
@@ -499,3 +731,337 @@ class astropix3:
     def _wait_progress(self, seconds:int):
         for _ in tqdm(range(seconds), desc=f'Wait {seconds} s'):
             time.sleep(1)
+
+
+###################### ACQUISITION ENGINE ###########################
+
+class RingBuffer:
+    """
+    Preallocated byte ring buffer for readout records.
+
+    One writer thread and any number of readers, each with its own read position.
+    Positions only ever grow and each one is moved by a single thread, after the data
+    it covers is complete, so no locks are needed. Records use the layout of the
+    binary raw data format (modules/rawdata.py).
+    """
+
+    def __init__(self, size:int = 1 << 24):
+        """
+        size:int - Buffer size in bytes
+        """
+        self._size = size
+        self._buffer = bytearray(size)
+        self._write_pos = 0
+        self._read_pos = {}
+        # Number of times the writer had to wait for the slowest reader
+        self.stalls = 0
+
+    def add_reader(self, name:str):
+        """
+        Registers a reader. All readers must be added before the writer starts.
+        """
+        self._read_pos[name] = self._write_pos
+
+    def free(self):
+        """
+        Returns number of bytes which can be written without overwriting unread data
+        """
+        if not self._read_pos:
+            return self._size
+        return self._size - (self._write_pos - min(self._read_pos.values()))
+
+    def write(self, index:int, readout:bytes, timestamp:float = None, stop:threading.Event = None):
+        """
+        Appends one readout record. Waits while the slowest reader has not made enough space.
+
+        index:int - Readout number
+        readout:bytes - Raw readout
+        timestamp:float - Monotonic timestamp, defaults to time.monotonic()
+        stop:threading.Event - Gives up waiting for space when set
+
+        Returns bool, True if the record was written
+        """
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        record = RECORD_HEADER.pack(index, timestamp, len(readout)) + bytes(readout)
+        length = len(record)
+
+        if length > self._size:
+            raise ValueError(f"Readout of {len(readout)} bytes does not fit in ring buffer of {self._size} bytes")
+
+        if self.free() < length:
+            self.stalls += 1
+            logger.debug("Ring buffer full, waiting for consumers")
+            while self.free() < length:
+                if stop is not None and stop.is_set():
+                    return False
+                time.sleep(.0001)
+
+        pos = self._write_pos % self._size
+        first = min(length, self._size - pos)
+        self._buffer[pos:pos + first] = record[:first]
+        self._buffer[:length - first] = record[first:]
+
+        # Publish record only after it is complete
+        self._write_pos += length
+        return True
+
+    def read(self, name:str):
+        """
+        Returns list of all records not yet read by reader <name> as (index, timestamp, readout) tuples
+        """
+        start = self._read_pos[name]
+        end = self._write_pos
+
+        if start == end:
+            return []
+
+        pos = start % self._size
+        if pos + end - start <= self._size:
+            data = bytes(self._buffer[pos:pos + end - start])
+        else:
+            data = bytes(self._buffer[pos:]) + bytes(self._buffer[:end - start - (self._size - pos)])
+
+        records = []
+        offset = 0
+        while offset < len(data):
+            index, timestamp, length = RECORD_HEADER.unpack_from(data, offset)
+            offset += RECORD_HEADER.size
+            records.append((index, timestamp, data[offset:offset + length]))
+            offset += length
+
+        self._read_pos[name] = end
+        return records
+
+
+class ReadoutPoller:
+    """
+    Adaptive readout polling for astropix3.
+
+    Modes:
+    interrupt - read the interrupt register, read out only if hits are present
+    speculative - read out on every poll without checking the interrupt, readouts
+                  holding only idle bytes are dropped. Saves one USB round trip per hit.
+
+    The wait between polls doubles while no hits are found, up to max_wait, and
+    drops back to min_wait as soon as a readout holds hits.
+    """
+
+    MODES = ('interrupt', 'speculative')
+
+    def __init__(self, astro:astropix3, bufferlength:int = 3, mode:str = 'interrupt', min_wait:float = 0., max_wait:float = .01, readout_delay:float = .001):
+        """
+        astro:astropix3 - configured astropix object
+        bufferlength:int - Buffer length passed to get_readout
+        mode:str - 'interrupt' or 'speculative'
+        min_wait:float - Wait between polls while busy in s
+        max_wait:float - Longest wait between polls while idle in s
+        readout_delay:float - Wait between seeing the interrupt and reading out in s
+        """
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown poll mode {mode}, use one of {self.MODES}")
+
+        self.astro = astro
+        self.bufferlength = bufferlength
+        self.mode = mode
+        self.min_wait = min_wait
+        self.max_wait = max_wait
+        self.readout_delay = readout_delay
+
+        self.wait = min_wait
+        self.reset_counters()
+
+    def reset_counters(self):
+        """
+        Resets poll counters
+        """
+        self.polls = 0
+        self.readouts = 0
+        self.empty_readouts = 0
+        self.latency_sum = 0.
+        self.latency_max = 0.
+        self._start = time.monotonic()
+        self._last_poll = self._start
+
+    def poll(self):
+        """
+        Waits for the current poll interval and polls once.
+
+        Returns bytearray with readout if hits were found, else None
+        """
+        if self.wait:
+            time.sleep(self.wait)
+
+        now = time.monotonic()
+        # Hits found now arrived at most one poll interval ago
+        latency = now - self._last_poll
+        self._last_poll = now
+        self.polls += 1
+
+        readout = None
+        if self.mode == 'speculative':
+            readout = self.astro.get_readout(self.bufferlength)
+            # Nothing but idle bytes
+            if not bytes(readout).strip(b'\xbc\xff'):
+                self.empty_readouts += 1
+                readout = None
+        elif self.astro.hits_present():
+            if self.readout_delay:
+                time.sleep(self.readout_delay)
+            readout = self.astro.get_readout(self.bufferlength)
+
+        if readout is None:
+            self.wait = min(max(2 * self.wait, 1e-4), self.max_wait)
+            return None
+
+        self.wait = self.min_wait
+        self.readouts += 1
+        self.latency_sum += latency
+        self.latency_max = max(self.latency_max, latency)
+        return readout
+
+    def stats(self):
+        """
+        Returns dict with poll counters, poll rate in Hz and hit latency in s
+        """
+        elapsed = time.monotonic() - self._start
+        return {
+            'polls': self.polls,
+            'readouts': self.readouts,
+            'empty_readouts': self.empty_readouts,
+            'poll_rate': self.polls / elapsed if elapsed > 0 else 0.,
+            'mean_latency': self.latency_sum / self.readouts if self.readouts else 0.,
+            'max_latency': self.latency_max,
+            'wait': self.wait
+            }
+
+
+class AcquisitionEngine:
+    """
+    Background acquisition for astropix3.
+
+    A dedicated reader thread only polls the chip (ReadoutPoller) and drains the Nexys FIFO
+    into a ring buffer, so chip dead time depends on USB transfers alone. Decoding, persistence
+    and plotting are consumers which read the ring buffer independently, either in their
+    own thread (add_consumer) or by polling from any thread (add_reader/poll).
+    """
+
+    def __init__(self, astro:astropix3, bufferlength:int = 3, ringsize:int = 1 << 24, readout_delay:float = .001, idle_wait:float = .001, mode:str = 'interrupt', max_wait:float = .01):
+        """
+        astro:astropix3 - configured astropix object
+        bufferlength:int - Buffer length passed to get_readout
+        ringsize:int - Ring buffer size in bytes
+        readout_delay:float - Wait between seeing the interrupt and reading out in s
+        idle_wait:float - Wait of consumer threads without new readouts in s
+        mode:str - Poll mode of ReadoutPoller, 'interrupt' or 'speculative'
+        max_wait:float - Longest wait between polls while no hits are found in s
+        """
+        self.astro = astro
+        self.idle_wait = idle_wait
+
+        self.poller = ReadoutPoller(astro, bufferlength, mode, max_wait=max_wait, readout_delay=readout_delay)
+
+        self.ring = RingBuffer(ringsize)
+        self.readouts = 0
+        self.maxreadouts = None
+
+        self._stop = threading.Event()
+        self._consumers_stop = threading.Event()
+        self._reader = None
+        self._consumers = []
+
+    @property
+    def running(self):
+        """True while the reader thread is taking data"""
+        return self._reader is not None and self._reader.is_alive()
+
+    def add_reader(self, name:str):
+        """
+        Registers a consumer which fetches records itself with poll(name). Must be called before start.
+        """
+        self.ring.add_reader(name)
+
+    def poll(self, name:str):
+        """
+        Returns list of new (index, timestamp, readout) tuples for reader <name>
+        """
+        return self.ring.read(name)
+
+    def add_consumer(self, name:str, callback):
+        """
+        Registers a consumer running in its own thread. Must be called before start.
+
+        callback - called as callback(index, timestamp, readout) for each readout
+        """
+        self.ring.add_reader(name)
+        self._consumers.append(threading.Thread(target=self._consume, args=(name, callback), name=f"astropix-{name}", daemon=True))
+
+    def start(self, maxreadouts:int = None):
+        """
+        Starts reader and consumer threads.
+
+        maxreadouts:int - Stop taking data after this many readouts
+        """
+        self.maxreadouts = maxreadouts
+        self._stop.clear()
+        self._consumers_stop.clear()
+        self.poller.reset_counters()
+
+        for consumer in self._consumers:
+            consumer.start()
+
+        self._reader = threading.Thread(target=self._acquire, name="astropix-reader", daemon=True)
+        self._reader.start()
+        logger.info("Acquisition started")
+
+    def stop(self):
+        """
+        Stops taking data. Consumer threads process all remaining records before they finish.
+        """
+        if self._consumers_stop.is_set():
+            return
+
+        self._stop.set()
+        if self._reader is not None:
+            self._reader.join()
+
+        self._consumers_stop.set()
+        for consumer in self._consumers:
+            consumer.join()
+
+        logger.info(f"Acquisition stopped after {self.readouts} readouts, {self.ring.stalls} ring buffer stalls")
+        logger.info(f"Poll statistics: {self.poller.stats()}")
+
+    def _acquire(self):
+        try:
+            while not self._stop.is_set():
+                if self.maxreadouts is not None and self.readouts >= self.maxreadouts:
+                    break
+
+                readout = self.poller.poll()
+
+                if readout is not None:
+                    if not self.ring.write(self.readouts, readout, stop=self._stop):
+                        break
+                    self.readouts += 1
+
+        except Exception as e:
+            logger.exception(f"Acquisition stopped by unexpected exception! \n{e}")
+
+    def _consume(self, name:str, callback):
+        while True:
+            # Check before reading, so records written before the stop are still processed
+            finished = self._consumers_stop.is_set()
+            records = self.ring.read(name)
+
+            for index, timestamp, readout in records:
+                try:
+                    callback(index, timestamp, readout)
+                except Exception as e:
+                    logger.exception(f"Consumer {name} failed on readout {index}! \n{e}")
+
+            if finished:
+                break
+            if not records:
+                time.sleep(self.idle_wait)
@@ -9,8 +9,7 @@ Maintained by: Amanda Steinhebel, amanda.l.steinhebel@nasa.gov
 
 #from msilib.schema import File
 #from http.client import SWITCHING_PROTOCOLS
-from astropix import astropix3
-import modules.hitplotter as hitplotter
+from astropix import astropix3, AcquisitionEngine
 import os
 import binascii
 import pandas as pd
@@ -20,6 +19,9 @@ import logging
 import argparse
 import csv
 
+from modules.rawdata import RawDataWriter, RAW_EXTENSION
+from modules.hitsink import HitSink, HIT_COLUMNS
+from modules.livedisplay import LiveDisplay
 from modules.setup_logger import logger
 
 
@@ -78,26 +80,21 @@ def main(args):
         astro.start_injection()
     
     # Masking pixels
-    # Read noise scan summary file
-    noise_input_file = open(args.noisescaninfo, 'r')
-    lines = noise_input_file.readlines()
-    #print(lines[0])
-    del lines[0] # remove header
-
-    # Get counts
-    count_vals=[]
-    for line in lines:
-        noise_val = int(line.split(',')[2])
-        col_val = int(line.split(',')[0])
-        row_val = int(line.split(',')[1])
-        masking_threshold_in_pixels = args.noisethreshold
-        if noise_val > masking_threshold_in_pixels:        
-            astro.disable_pixel(col_val,row_val)
-        else:
-            astro.enable_pixel(col_val,row_val)
-        
+    # Read noise scan summary file, columns Col, Row, Count (further columns are ignored)
+    noise = np.loadtxt(args.noisescaninfo, delimiter=',', skiprows=1, usecols=(0, 1, 2), dtype=int, ndmin=2)
+
+    # Mask noisy pixels and enable all others with one update
+    mask = astro.get_pixel_mask()
+    mask.apply_noise_scan(noise[:, 0], noise[:, 1], noise[:, 2], args.noisethreshold)
+    astro.set_pixel_mask(mask)
+
+    # Decoded hits get calibrated charge (and energy) columns
+    columns = None
+    if args.calibration is not None:
+        astro.load_calibration(args.calibration, args.kevpermv)
+        columns = HIT_COLUMNS + astro.calibration[0].columns
+
     max_errors = args.errormax
-    i = 0
     errors = 0 # Sets the threshold 
     if args.maxtime is not None: 
         end_time=time.time()+(args.maxtime*60.)
@@ -106,104 +103,88 @@ def main(args):
     # Prepares the file paths 
     if args.saveascsv: # Here for csv
         csvpath = args.outdir +'/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-        csvframe =pd.DataFrame(columns = [
-                'readout',
-                'Chip ID',
-                'payload',
-                'location',
-                'isCol',
-                'timestamp',
-                'tot_msb',
-                'tot_lsb',
-                'tot_total',
-                'tot_us',
-                'hittime'
-        ])
+        csvframe = HitSink(csvpath, columns=columns)
 
     # Save final configuration to output file    
     ymlpathout=args.outdir +"/"+args.yaml+"_"+time.strftime("%Y%m%d-%H%M%S")+".yml"
     astro.write_conf_to_yaml(ymlpathout)
-    # Prepinvertare text files/logs
-    bitpath = args.outdir + '/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
-    # textfiles are always saved so we open it up 
-    bitfile = open(bitpath,'w')
-    # Writes all the config information to the file
-    bitfile.write(astro.get_log_header())
-    bitfile.write(str(args))
-    bitfile.write("\n")
-
-    # Enables the hitplotter and uses logic on whether or not to save the images
-    if args.showhits: plotter = hitplotter.HitPlotter(35, outdir=(args.outdir if args.plotsave else None))
+    # Prepare raw data file
+    bitpath = args.outdir + '/' + fname + time.strftime("%Y%m%d-%H%M%S") + RAW_EXTENSION
+    # Raw data files are always saved, the header holds all the config information
+    bitfile = RawDataWriter(bitpath, astro.get_raw_header(args))
+
+    # Enables the live display in its own process and uses logic on whether or not to save the maps
+    if args.showhits:
+        display = LiveDisplay(astro.asic.num_cols, astro.asic.num_rows, outdir=(args.outdir if args.plotsave else None))
+        display.start()
+
+    # Readouts are taken in a background thread and written to the raw data file by a second thread,
+    # so decoding and plotting in this thread do not add dead time
+    engine = AcquisitionEngine(astro, bufferlength=3, mode=args.pollmode)
+    engine.add_consumer('rawfile', lambda index, timestamp, readout: bitfile.write(index, readout, timestamp))
+    engine.add_reader('decode')
+
+    def process_readout(i, timestamp, readout):
+        nonlocal errors
+
+        print(binascii.hexlify(readout))
+
+        # Added fault tolerance for decoding, the limits of which are set through arguments
+        if args.ludicrousspeed is False:
+
+            try:
+                # Frames split across two readouts are completed with the next readout
+                hits = astro.decode_readout_stream(readout, i, printer = False)
+
+            except IndexError:
+                errors += 1
+                logger.warning(f"Decoding failed. Failure {errors} of {max_errors} on readout {i}")
+                # We write out the failed decode dataframe
+                hits = decode_fail_frame
+                hits.readout = i
+                hits.hittime = time.time()
+
+                # This loggs the end of it all 
+                if errors > max_errors:
+                    logger.warning(f"Decoding failed {errors} times on an index error. Terminating Progam...")
+            finally:
+                # If we are saving a csv this will write it out. 
+                if args.saveascsv:
+                    csvframe.append(hits)
+                    #print(hits)
+                # This handels the hitplotting. Hits are only queued, the display process draws them
+                if args.showhits:
+                    # This ensures we aren't plotting NaN values of failed decodings
+                    if hits is not decode_fail_frame:
+                        display.send(hits)
+
+                # If we are logging runtime, this does it!
+                if args.timeit:
+                    print(f"Read and decode took {time.monotonic()-timestamp}s")
 
     try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly
-        
-        while True: # Loop continues before: while error => error_max 
 
-            # This might be possible to do in the loop declaration, but its a lot easier to simply add in this logic
-            if args.maxruns is not None:
-                if i >= args.maxruns: break
+        engine.start(maxreadouts=args.maxruns)
+
+        while True: # Loop continues until maxruns or maxtime is reached
+
+            # Readout limit is handled by the engine, which stops by itself
+            if not engine.running: break
             if args.maxtime is not None:
                 if time.time() >= end_time: break
-            
-            
-            if astro.hits_present(): # Checks if hits are present
-                # We aren't using timeit, just measuring the diffrence in ns
-                if args.timeit: start = time.time_ns()
-    
-                time.sleep(.001) # this is probably not needed, will ask Nicolas
 
-                readout = astro.get_readout(3) # Gets the bytearray from the chip
-                
-                if args.timeit:
-                    print(f"Readout took {(time.time_ns()-start)*10**-9}s")
-
-                # Writes the hex version to hits
-                bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
-                print(binascii.hexlify(readout))
-
-                # Added fault tolerance for decoding, the limits of which are set through arguments
-                if args.ludicrousspeed is False:
-
-                    try:
-                        hits = astro.decode_readout(readout, i, printer = False)
-
-                    except IndexError:
-                        errors += 1
-                        logger.warning(f"Decoding failed. Failure {errors} of {max_errors} on readout {i}")
-                        # We write out the failed decode dataframe
-                        hits = decode_fail_frame
-                        hits.readout = i
-                        hits.hittime = time.time()
-
-                        # This loggs the end of it all 
-                        if errors > max_errors:
-                            logger.warning(f"Decoding failed {errors} times on an index error. Terminating Progam...")
-                    finally:
-                        i += 1
-
-                        # If we are saving a csv this will write it out. 
-                        if args.saveascsv:
-                            csvframe = pd.concat([csvframe, hits])
-                            #print(hits)
-                        # This handels the hitplotting. Code by Henrike and Amanda
-                        if args.showhits:
-                            # This ensures we aren't plotting NaN values. I don't know if this would break or not but better 
-                            # safe than sorry
-                            if pd.isnull(hits.tot_msb.loc(0)):
-                                pass
-                            elif len(hits)>0:#safeguard against bad readouts without recorded decodable hits
-                                #Isolate row and column information from array returned from decoder
-                                rows = hits.location[hits.isCol]
-                                columns = hits.location[hits.isCol]
-                                plotter.plot_event( rows, columns, i)
-
-                        # If we are logging runtime, this does it!
-                        if args.timeit:
-                            print(f"Read and decode took {(time.time_ns()-start)*10**-9}s")
-
-            # If no hits are present this waits for some to accumulate
-            else: time.sleep(.001)
+            readouts = engine.poll('decode')
+
+            for i, timestamp, readout in readouts:
+                process_readout(i, timestamp, readout)
+
+            # If no readouts are waiting this waits for some to accumulate
+            if not readouts: time.sleep(.001)
 
+        # Process readouts taken before the engine stopped
+        engine.stop()
+        for i, timestamp, readout in engine.poll('decode'):
+            process_readout(i, timestamp, readout)
 
     # Ends program cleanly when a keyboard interupt is sent.
     except KeyboardInterrupt:
@@ -212,9 +193,11 @@ def main(args):
     except Exception as e:
         logger.exception(f"Encountered Unexpected Exception! \n{e}")
     finally:
+        engine.stop()
         if args.saveascsv: 
-            csvframe.index.name = "dec_order"
-            csvframe.to_csv(csvpath) 
+            csvframe.close()
+        if args.showhits:
+            display.close()
         if args.inject is not None: astro.stop_injection()   
         bitfile.close() # Close open file        
         astro.close_connection() # Closes SPI
@@ -239,10 +222,10 @@ if __name__ == "__main__":
 
     parser.add_argument('-s', '--showhits', action='store_true',
                     default=False, required=False,
-                    help='Display hits in real time during data taking')
+                    help='Display hits, occupancy and ToT maps in real time during data taking')
     
     parser.add_argument('-p', '--plotsave', action='store_true', default=False, required=False,
-                    help='Save plots as image files. If set, will be saved in  same dir as data. Default: FALSE')
+                    help='Save final live display maps as image files. If set, will be saved in  same dir as data. Default: FALSE')
     
     parser.add_argument('-c', '--saveascsv', action='store_true', 
                     default=False, required=False, 
@@ -272,12 +255,21 @@ if __name__ == "__main__":
     parser.add_argument('--timeit', action="store_true", default=False,
                     help='Prints runtime from seeing a hit to finishing the decode to terminal')
 
+    parser.add_argument('--pollmode', type=str, choices = ['interrupt', 'speculative'], action="store", default='interrupt',
+                    help='Readout polling. interrupt - read out when the interrupt is set, speculative - read out on every poll and drop empty readouts. DEFAULT: interrupt')
+
     parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='I',
                     help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: D')
 
     parser.add_argument('-nt', '--noisethreshold', type=int, action="store", default=0, required=False,
                     help='Set threshold on noisy pixel to mask it. DEFAULT: 0')
 
+    parser.add_argument('--calibration', action='store', default=None, required=False,
+                    help='Calibration array (.npy) of fit_calibration.py, adds charge_mv to the decoded hits. Default: None')
+
+    parser.add_argument('--kevpermv', type=float, action='store', default=None, required=False,
+                    help='Energy per mV injection voltage, adds energy_kev to calibrated hits. Default: None')
+
     parser.add_argument('--ludicrousspeed', action='store_true', default=False,
                     help="Fastest possible data collection. No decode, no output, no file.\
                          Saves bitstreams in memory until keyboard interupt or other error and then writes them to file.\
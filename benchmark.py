@@ -0,0 +1,237 @@
+"""
+Throughput benchmarks for readout, config upload, config pattern generation and decoding using the simulated Nexys
+(core/simulator.py). Runs without hardware.
+
+Run: python3.9 benchmark.py -r 1000 --hitrate 10000
+"""
+
+from astropix import astropix3
+from core.decode import StreamingDecoder, TelescopeDecoder
+from core.simulator import NexysSimulator
+from bitstring import BitArray
+import numpy as np
+import time
+import logging
+import argparse
+
+from modules.setup_logger import logger
+
+
+def read_spi_fifo_unbatched(nexys):
+    """read_spi_fifo before batching: 64 byte reads, a separate config register read and 10 ms sleep per chunk"""
+
+    read_stream = bytearray()
+
+    while not nexys.get_spi_config() & 16:
+        read_stream.extend(nexys.read_spi(64))
+        time.sleep(0.01)
+
+    # Bytes are read, the batched read must not expect them any more
+    nexys._spi_readout_bytes = 0
+
+    return read_stream
+
+
+def bench_readout(astro, args):
+    """
+    Take readouts with the unbatched and the batched read_spi_fifo and report readout rate and
+    USB transactions per readout. The unbatched read sleeps 10 ms per chunk, it takes at most
+    100 readouts.
+    """
+
+    for name, read, nreadouts in (('unbatched', lambda: read_spi_fifo_unbatched(astro.nexys), min(args.readouts, 100)),
+                                  ('batched', astro.nexys.read_spi_fifo, args.readouts)):
+        astro.dump_fpga()
+        astro.handle.reset_counters()
+        readouts = []
+
+        start = time.perf_counter()
+        for _ in range(nreadouts):
+            astro.nexys.write_spi_bytes(args.bufferlength)
+            readouts.append(read())
+        elapsed = time.perf_counter() - start
+
+        nbytes = sum(len(readout) for readout in readouts)
+
+        print(f"Readout:  {nreadouts / elapsed:10.1f} readouts/s  {nbytes / elapsed / 1e6:8.3f} MB/s  "
+              f"{astro.handle.transactions / nreadouts:.1f} USB transactions/readout  ({name})")
+
+    return readouts
+
+
+def bench_config(astro, args):
+    """Upload the ASIC config and report upload rate, without the 100 ms chip reset of astropix3.asic_update"""
+
+    astro.handle.reset_counters()
+
+    start = time.perf_counter()
+    for _ in range(args.configs):
+        astro.asic.asic_update(force=True)
+    elapsed = time.perf_counter() - start
+
+    print(f"Config:   {args.configs / elapsed:10.1f} uploads/s   {1e3 * elapsed / args.configs:8.3f} ms/upload  "
+          f"{astro.handle.sr_bytes / args.configs:.0f} SR bytes/upload")
+
+
+def bench_patterns(astro, args):
+    """Generate ASIC SR patterns for one chip and a telescope, and a GECCO pattern"""
+
+    vector = astro.asic.gen_asic_vector()
+
+    for name, value in (('1 chip', vector), (f'{args.chips} chips', vector * args.chips)):
+        start = time.perf_counter()
+        for _ in range(args.configs):
+            astro.nexys.gen_asic_pattern(value, True)
+        elapsed = time.perf_counter() - start
+
+        print(f"Pattern:  {1e3 * elapsed / args.configs:10.3f} ms/pattern  ASIC {name}, {len(value)} bits")
+
+    value = BitArray(uint=0, length=136)
+
+    start = time.perf_counter()
+    for _ in range(args.configs):
+        astro.nexys.gen_gecco_pattern(12, value, 8)
+    elapsed = time.perf_counter() - start
+
+    print(f"Pattern:  {1e3 * elapsed / args.configs:10.3f} ms/pattern  GECCO voltageboard, {len(value)} bits")
+
+
+def bench_decode(astro, readouts):
+    """
+    Decode readouts one by one with the scalar decode_readout and the streaming decode_readout_stream,
+    and all at once with decode_readouts. Rates are compared to decode_readout.
+    """
+
+    rates = {}
+    for name, decode in (('decode_readout', astro.decode_readout),
+                         ('decode_readout_stream', astro.decode_readout_stream)):
+        astro.stream_decoder.reset()
+        nhits = 0
+
+        start = time.perf_counter()
+        for i, readout in enumerate(readouts):
+            try:
+                nhits += len(decode(readout, i, printer=False))
+            except IndexError:
+                pass
+        elapsed = time.perf_counter() - start
+
+        rates[name] = len(readouts) / elapsed
+        print(f"Decode:   {rates[name]:10.1f} readouts/s  {nhits / elapsed:10.1f} hits/s  "
+              f"({name}, {rates[name] / rates['decode_readout']:.2f})")
+
+    astro.stream_decoder.reset()
+
+    start = time.perf_counter()
+    nhits = len(astro.decode_readouts(readouts))
+    elapsed = time.perf_counter() - start
+
+    print(f"Decode:   {len(readouts) / elapsed:10.1f} readouts/s  {nhits / elapsed:10.1f} hits/s  "
+          f"(decode_readouts, {len(readouts) / elapsed / rates['decode_readout']:.2f})")
+
+
+def bench_telescope(args):
+    """
+    Decode a telescope readout stream for 1, 2, 4, ... chips, demultiplexed by chip ID and as one
+    plain stream. Both decode batches of readouts, demultiplexing should cost little on top
+    and not grow with the number of chips.
+    """
+
+    nchips = 1
+    while nchips <= args.chips:
+        simulator = NexysSimulator(nchips=nchips, seed=0)
+        stream = simulator.gen_frames(args.readouts * args.bufferlength)
+        size = len(stream) // args.readouts
+        readouts = [stream[i:i + size] for i in range(0, len(stream), size)]
+
+        rates = {}
+        for name in ('single stream', 'telescope'):
+            decoder = StreamingDecoder() if name == 'single stream' else TelescopeDecoder(nchips)
+            frames = []
+            nhits = 0
+
+            start = time.perf_counter()
+            for i, readout in enumerate(readouts):
+                if name == 'single stream':
+                    frames.append(decoder.feed_hits(readout))
+                else:
+                    decoder.queue(readout, i)
+
+                if i % args.batch == args.batch - 1 or i == len(readouts) - 1:
+                    if name == 'single stream':
+                        nhits += len(decoder.decode_astropix2_hits_np(np.concatenate(frames)))
+                        frames = []
+                    else:
+                        nhits += sum(len(hits) for hits in decoder.decode_queue().values())
+            elapsed = time.perf_counter() - start
+
+            rates[name] = nhits / elapsed
+
+        print(f"Decode:   {rates['telescope']:10.1f} hits/s telescope  {rates['single stream']:10.1f} hits/s single stream  "
+              f"({nchips} chips, {rates['telescope'] / rates['single stream']:.2f})")
+
+        nchips *= 2
+
+
+def main(args):
+
+    astro = astropix3(simulate=True)
+    astro.handle.hitrate = args.hitrate
+
+    astro.init_voltages()
+    astro.asic_init(yaml='./config/' + args.yaml + '.yml')
+    astro.enable_spi()
+    astro.dump_fpga()
+
+    readouts = bench_readout(astro, args)
+    bench_config(astro, args)
+    bench_patterns(astro, args)
+    bench_decode(astro, readouts)
+    bench_telescope(args)
+
+    astro.close_connection()
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Astropix throughput benchmarks on the simulated Nexys')
+
+    parser.add_argument('-y', '--yaml', action='store', required=False, type=str, default = 'testconfig_v3',
+                    help = 'filepath (in config/ directory) .yml file containing chip configuration. Default: config/testconfig_v3.yml')
+
+    parser.add_argument('-r', '--readouts', type=int, action='store', default=1000,
+                    help = 'Number of readouts. DEFAULT: 1000')
+
+    parser.add_argument('-b', '--bufferlength', type=int, action='store', default=20,
+                    help = 'Readout buffer length, multiplied by 8 to give the number of bytes. DEFAULT: 20')
+
+    parser.add_argument('-c', '--configs', type=int, action='store', default=10,
+                    help = 'Number of config uploads. DEFAULT: 10')
+
+    parser.add_argument('-n', '--chips', type=int, action='store', default=8,
+                    help = 'Number of chips for the telescope pattern benchmark, the telescope decode benchmark doubles up to it. DEFAULT: 8')
+
+    parser.add_argument('--batch', type=int, action='store', default=50,
+                    help = 'Number of readouts decoded together in the telescope benchmark. DEFAULT: 50')
+
+    parser.add_argument('--hitrate', type=float, action='store', default=10000.,
+                    help = 'Simulated hit rate in Hz. DEFAULT: 10000')
+
+    parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='W',
+                    help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: W')
+
+    args = parser.parse_args()
+
+    loglevel = {'D': logging.DEBUG, 'I': logging.INFO, 'E': logging.ERROR,
+                'W': logging.WARNING, 'C': logging.CRITICAL}[args.loglevel]
+
+    formatter = logging.Formatter('%(asctime)s:%(msecs)d.%(name)s.%(levelname)s:%(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+
+    logging.getLogger().addHandler(sh)
+    logging.getLogger().setLevel(loglevel)
+
+    logger = logging.getLogger(__name__)
+
+    main(args)
@@ -11,13 +11,19 @@ Functions for ASIC configuration
 import logging
 import yaml
 import sys
+from contextlib import contextmanager
 
+import numpy as np
 from bitstring import BitArray
 
 from core.nexysio import Nexysio
+from core.pixelmask import PixelMask
 from modules.setup_logger import logger
 
 
+# Number of encoded config patterns kept for repeated uploads
+ASIC_PATTERN_CACHE_SIZE = 8
+
 logger = logging.getLogger(__name__)
 
 class Asic(Nexysio):
@@ -38,6 +44,14 @@ class Asic(Nexysio):
 
         self._chipname = ""
 
+        self._pattern_cache = {}
+
+        # Vector of the last upload and state of batch_update
+        self._uploaded = None
+        self._uploaded_spi = {}
+        self._batch_depth = 0
+        self._batch_pending = None
+
     @property
     def chipname(self):
         """Get/set chipname
@@ -213,21 +227,58 @@ class Asic(Nexysio):
             self.asic_config['recconfig'][key][1] = 0b001_11111_11111_11111_11111_11111_11111_11110
 
 
+    def __recconfig(self, chip: int = 0) -> dict:
+        """recconfig section of chip, chip is ignored for single chip setups"""
+
+        if self.num_chips > 1:
+            return self.asic_config[f'config_{chip}']['recconfig']
+
+        return self.asic_config['recconfig']
+
+    def get_pixel_mask(self, chip: int = 0) -> PixelMask:
+        """
+        Get pixel mask, injection and analog output state
+
+        :param chip: Chip number in telescope setup
+
+        :returns: PixelMask decoded from recconfig
+        """
+
+        return PixelMask.from_recconfig(self.__recconfig(chip), self.num_cols, self.num_rows)
+
+    def set_pixel_mask(self, mask: PixelMask, chip: int = 0, inplace: bool = True) -> None:
+        """
+        Set pixel mask, injection and analog output state
+
+        :param mask: PixelMask
+        :param chip: Chip number in telescope setup
+        :param inplace: True - Updates asic after updating pixel mask
+        """
+
+        if (mask.num_cols, mask.num_rows) != (self.num_cols, self.num_rows):
+            logger.error("Mask size %dx%d does not match chip size %dx%d",
+                         mask.num_cols, mask.num_rows, self.num_cols, self.num_rows)
+            raise ValueError("Pixel mask does not match chip geometry")
+
+        mask.to_recconfig(self.__recconfig(chip))
+
+        if inplace: self.asic_update()
+
     @staticmethod
-    def __int2nbit(value: int, nbits: int) -> BitArray:
-        """Convert int to 6bit bitarray
+    def __int2nbit(value: int, nbits: int) -> np.ndarray:
+        """Convert int to bit array, MSB first
 
         :param value: Integer value
         :param nbits: Number of bits
 
-        :returns: Bitarray of specified length
+        :returns: Array of bits with specified length
         """
 
-        try:
-            return BitArray(uint=value, length=nbits)
-        except ValueError:
+        if not 0 <= value < (1 << nbits):
             logger.error('Allowed Values 0 - %d', 2**nbits-1)
-            return None
+            raise ValueError(f"Value {value} does not fit in {nbits} bits")
+
+        return (np.int64(value) >> np.arange(nbits - 1, -1, -1, dtype=np.int64)) & 1
 
     def load_conf_from_yaml(self, chipversion: int, filename: str, **kwargs) -> None:
         """Load ASIC config from yaml
@@ -282,53 +333,224 @@ class Asic(Nexysio):
                 sys.exit(1)
 
 
-    def gen_asic_vector(self, msbfirst: bool = False) -> BitArray:
+    def __chip_configs(self) -> list:
+        """Chip configs in the order they are appended to the vector"""
+
+        if self.num_chips > 1:
+            return [self.asic_config[f'config_{chip}'] for chip in range(self.num_chips-1, -1, -1)]
+
+        return [self.asic_config]
+
+    def __compile_layout(self, nbits: tuple, chip_lengths: tuple) -> None:
+        """
+        Compile bit layout of the config vector
+
+        :param nbits: Number of bits per field in vector order
+        :param chip_lengths: Number of bits per chip in vector order
+        """
+
+        self._layout = (nbits, chip_lengths)
+        self._offsets = np.concatenate(([0], np.cumsum(nbits, dtype=np.int64)))
+        self._rawbits = np.zeros(self._offsets[-1], dtype=np.uint8)
+        self._fieldvalues = [None] * len(nbits)
+
+        # Bit order of the vector, the vector is reversed after each appended chip if not msbfirst
+        self._order = {}
+        for msbfirst in (False, True):
+            order = np.empty(0, dtype=np.int64)
+            start = 0
+
+            for length in chip_lengths:
+                order = np.concatenate((order, np.arange(start, start + length)))
+                start += length
+
+                if not msbfirst:
+                    order = order[::-1]
+
+            self._order[msbfirst] = order
+
+        # Raw bits of each chip, chips are appended in descending order
+        starts = np.concatenate(([0], np.cumsum(chip_lengths, dtype=np.int64)))
+        self._chip_slices = {len(chip_lengths) - 1 - block: slice(starts[block], starts[block + 1])
+                             for block in range(len(chip_lengths))}
+
+        self._vectors = {}
+
+        logger.info("Compiled config layout with %d fields for %d chip(s)", len(nbits), len(chip_lengths))
+
+    def gen_asic_vector(self, msbfirst: bool = False, chip: int = None) -> BitArray:
         """
         Generate asic bitvector from digital, bias and dacconfig
 
+        The bit layout is compiled once, on later calls only changed fields are
+        encoded again and an unchanged vector is returned from cache.
+
         :param msbfirst: Send vector MSB first
+        :param chip: Generate vector of this chip only, default all chips
         """
-        bitvector = BitArray()
 
-        if self.num_chips > 1:
-            for chip in range(self.num_chips-1, -1, -1):
+        fields, values = [], []
+        chip_lengths = []
 
-                for key in self.asic_config[f'config_{chip}']:
-                    for values in self.asic_config[f'config_{chip}'][key].values():
-                        bitvector.append(self.__int2nbit(values[1], values[0]))
+        for config in self.__chip_configs():
+            length = 0
+            for key in config:
+                for name, field in config[key].items():
+                    fields.append((key, name, field[0]))
+                    values.append(field[1])
+                    length += field[0]
+            chip_lengths.append(length)
 
-                if not msbfirst:
-                    bitvector.reverse()
+        nbits = tuple(field[2] for field in fields)
+        chip_lengths = tuple(chip_lengths)
 
-                logger.info("Generated chip_%d config successfully!", chip)
-        else:
-            for key in self.asic_config:
-                for values in self.asic_config[key].values():
-                    bitvector.append(self.__int2nbit(values[1], values[0]))
+        if getattr(self, '_layout', None) != (nbits, chip_lengths):
+            self.__compile_layout(nbits, chip_lengths)
+
+        changed = False
+
+        for index, value in enumerate(values):
+            if value != self._fieldvalues[index]:
+                key, name, length = fields[index]
+                try:
+                    self._rawbits[self._offsets[index]:self._offsets[index + 1]] = self.__int2nbit(value, length)
+                except ValueError as exc:
+                    raise ValueError(f"Invalid config value {key}/{name}: {exc}") from None
+
+                self._fieldvalues[index] = value
+                changed = True
+
+        if changed:
+            self._vectors = {}
+
+        if (msbfirst, chip) not in self._vectors:
+            if chip is None:
+                bits = self._rawbits[self._order[msbfirst]]
+            else:
+                bits = self._rawbits[self._chip_slices[chip]]
+                bits = bits if msbfirst else bits[::-1]
 
-            if not msbfirst:
-                bitvector.reverse()
+            self._vectors[msbfirst, chip] = BitArray(np.packbits(bits).tobytes())[:len(bits)]
 
-        logger.debug(bitvector)
+            logger.debug(self._vectors[msbfirst, chip])
 
-        return bitvector    
+        return BitArray(self._vectors[msbfirst, chip])
 
     def readback_asic(self):
         asicbits = self.gen_asic_pattern(self.gen_asic_vector(), True, readback_mode = True)
         print(asicbits)
         self.nexys.write(asicbits)
 
-    def asic_update(self):
+    @contextmanager
+    def batch_update(self):
+        """
+        Batch config changes, uploads requested inside the batch are done once at the end
+
+        The upload is skipped if the config vector is unchanged. Batches can be nested,
+        the outermost batch uploads. If the batch raises, nothing is uploaded.
+
+        Usage:
+        with asic.batch_update():
+            asic.disable_pixel(col, row)
+        """
+
+        self._batch_depth += 1
+        try:
+            yield self
+        except BaseException:
+            if self._batch_depth == 1:
+                self._batch_pending = None
+            raise
+        finally:
+            self._batch_depth -= 1
+
+        if self._batch_depth == 0 and self._batch_pending is not None:
+            force, reset = self._batch_pending
+            self._batch_pending = None
+            self.asic_update(force=force, reset=reset)
+
+    def asic_update(self, force: bool = False, reset: bool = False) -> bool:
         """
         Remakes configbits and writes to asic. 
-        Takes no input and does not return
+        Skips the upload if the config vector is the same as in the last upload,
+        a requested chip reset is always done.
+
+        :param force: Upload even if the config is unchanged
+        :param reset: Reset chip before upload, also if the upload is skipped
+
+        :returns: True if the config was uploaded
         """
+        # Inside a batch the upload is done when the batch ends
+        if self._batch_depth:
+            pending_force, pending_reset = self._batch_pending or (False, False)
+            self._batch_pending = (pending_force or force, pending_reset or reset)
+            return False
+
+        # The reset rearms the chip, it is needed even without a config change
+        if reset:
+            self.nexys.chip_reset()
+
+        bitvector = self.gen_asic_vector()
+        cachekey = bitvector.tobytes() + len(bitvector).to_bytes(4, 'little')
+
+        if not force and cachekey == self._uploaded:
+            logger.info("Config unchanged, skipped ASIC update")
+            return False
+
         if self._chipversion == 1:
             dummybits = self.gen_asic_pattern(BitArray(uint=0, length=245), True) # Not needed for v2
             self.nexys.write(dummybits)
 
-        # Write config
-        asicbits = self.nexys.gen_asic_pattern(self.gen_asic_vector(), True)
+        # Write config, patterns of recent vectors are cached
+        asicbits = self._pattern_cache.pop(cachekey, None)
+        if asicbits is None:
+            asicbits = self.nexys.gen_asic_pattern(bitvector, True)
+            if len(self._pattern_cache) >= ASIC_PATTERN_CACHE_SIZE:
+                del self._pattern_cache[next(iter(self._pattern_cache))]
+        self._pattern_cache[cachekey] = asicbits
+
         for value in asicbits:
             self.nexys.write(value)
         logger.info("Wrote configbits successfully")
+
+        self._uploaded = cachekey
+
+        return True
+
+    def asic_update_spi(self, chips: list = None, force: bool = False) -> list:
+        """
+        Write config to chips addressed by chip ID via SPI
+
+        All chip vectors are sent in one SPI write, chips with unchanged config are skipped.
+        SPI has to be enabled.
+
+        :param chips: List of chip IDs, default all chips
+        :param force: Upload even if the config is unchanged
+
+        :returns: List of updated chip IDs
+        """
+
+        if chips is None:
+            chips = range(self.num_chips)
+
+        data = bytearray()
+        updated = []
+
+        for chip in chips:
+            bitvector = self.gen_asic_vector(chip=chip)
+            cachekey = bitvector.tobytes() + len(bitvector).to_bytes(4, 'little')
+
+            if not force and self._uploaded_spi.get(chip) == cachekey:
+                continue
+
+            data.extend(self.nexys.asic_spi_vector(bitvector, True, broadcast=False, chipid=chip))
+            self._uploaded_spi[chip] = cachekey
+            updated.append(chip)
+
+        if data:
+            self.nexys.write_spi(data, False)
+            logger.info("Wrote configbits via SPI to chip(s) %s", updated)
+        else:
+            logger.info("Config unchanged, skipped SPI update")
+
+        return updated
@@ -6,11 +6,11 @@ Created on Tue Dec 28 19:03:40 2021
 @author: Nicolas Striebig
 """
 
+import numpy as np
 import pandas as pd
 import re
 import math
 import binascii
-from bitstring import BitArray
 
 import logging
 from modules.setup_logger import logger
@@ -18,6 +18,9 @@ from modules.setup_logger import logger
 
 logger = logging.getLogger(__name__)
 
+# Lookup table to reverse the bitorder of a byte
+REVERSE_BITORDER = np.array([int(f'{value:08b}'[::-1], 2) for value in range(256)], dtype=np.uint8)
+
 class Decode:
     def __init__(self, sampleclock_period_ns = 5):
         self.sampleclock_period_ns = sampleclock_period_ns
@@ -25,11 +28,7 @@ class Decode:
 
     def reverse_bitorder(self, data: bytearray) -> bytearray:
         for index, item in enumerate(data):
-
-            item_rev = BitArray(uint=item, length=8)
-            item_rev.reverse()
-
-            data[index] = item_rev.uint
+            data[index] = int(REVERSE_BITORDER[item])
 
         return data
 
@@ -106,6 +105,97 @@ class Decode:
 
         return pd.DataFrame(hit_pd, columns=['id','payload','location', 'col', 'timestamp', 'tot_total'])
 
+    @staticmethod
+    def frame_starts(nonidle: np.ndarray, bytesperhit: int = 5) -> np.ndarray:
+        """
+        Find start positions of hit frames
+
+        Reproduces the byte-by-byte scan of hits_from_readoutstream: a frame starts at the
+        first non-idle byte and the scan resumes bytesperhit bytes later. Only one step per
+        hit is done in Python, idle bytes are skipped vectorized.
+
+        :param nonidle: Boolean mask of non-idle bytes
+        :param bytesperhit: Bytes per hit frame
+
+        :returns: Start positions of frames
+        """
+
+        candidates = np.flatnonzero(nonidle)
+
+        if len(candidates) == 0:
+            return candidates
+
+        # Index of the next candidate, if the frame starting at each candidate is taken
+        next_candidate = np.searchsorted(candidates, candidates + bytesperhit).tolist()
+
+        starts = []
+        k = 0
+
+        while k < len(candidates):
+            starts.append(k)
+            k = next_candidate[k]
+
+        return candidates[starts]
+
+    def hits_from_readoutstream_np(self, readout: bytearray, reverse_bitorder: bool = True) -> np.ndarray:
+        """
+        Find hits in readoutstream, vectorized version of hits_from_readoutstream
+
+        Frames truncated by the end of the readout are dropped.
+
+        :param readout: Readout stream
+        :param reverse_bitorder: Reverse Bitorder per byte
+
+        :returns: Array with one 5 byte frame per row
+        """
+
+        data = np.frombuffer(bytes(readout), dtype=np.uint8)
+
+        idle_byte = 0xbc if reverse_bitorder else 0x3d
+
+        starts = self.frame_starts((data != idle_byte) & (data != 0xff), self.bytesperhit)
+        starts = starts[starts + self.bytesperhit <= len(data)]
+
+        hits = data[starts[:, np.newaxis] + np.arange(self.bytesperhit)]
+
+        if reverse_bitorder:
+            hits = REVERSE_BITORDER[hits]
+
+        return hits
+
+    def decode_astropix2_hits_np(self, hits: np.ndarray) -> pd.DataFrame:
+        """
+        Decode 5byte Frames from AstroPix 2, vectorized version of decode_astropix2_hits
+
+        :param hits: Array with one 5 byte frame per row
+
+        :returns: Dataframe with decoded hits
+        """
+
+        return pd.DataFrame(self.hit_fields(hits))
+
+    def hit_fields(self, hits: np.ndarray) -> dict:
+        """
+        Fields of 5byte Frames from AstroPix 2 as arrays, columns of decode_astropix2_hits_np
+
+        :param hits: Array with one 5 byte frame per row
+
+        :returns: Dict with one array per field
+        """
+
+        hits = np.asarray(hits, dtype=np.uint8).reshape(-1, self.bytesperhit).astype(np.int64)
+
+        logger.info("Number of Hits %d", len(hits))
+
+        return {
+            'id':           hits[:, 0] >> 3,
+            'payload':      hits[:, 0] & 0b111,
+            'location':     hits[:, 1] & 0b111111,
+            'col':          (hits[:, 1] >> 7) & 1,
+            'timestamp':    hits[:, 2],
+            'tot_total':    ((hits[:, 3] & 0b1111) << 8) + hits[:, 4],
+        }
+
     ###################################################################################################
     ################################### Old decoding, to be removed ###################################
     ###################################################################################################
@@ -244,4 +334,200 @@ class Decode:
                     id, payload, location, col, timestamp, tot_msb, tot_lsb, tot_total, (tot_total * self.sampleclock_period_ns)/1000.0
                 )
 
-        return hit_pd
\ No newline at end of file
+        return hit_pd
+
+class StreamingDecoder(Decode):
+    """Decode a readout stream incrementally, keeping partial frames across readouts"""
+
+    def __init__(self, sampleclock_period_ns = 5, reverse_bitorder: bool = True):
+        super().__init__(sampleclock_period_ns)
+        self._reverse = reverse_bitorder
+        self._tail = bytearray()
+
+    @property
+    def pending(self) -> int:
+        """Number of bytes of an incomplete frame waiting for the next readout"""
+
+        return len(self._tail)
+
+    @property
+    def tail(self) -> bytes:
+        """Incomplete frame waiting for the next readout, feeding it to a new decoder restores the state"""
+
+        return bytes(self._tail)
+
+    def reset(self) -> None:
+        """Drop incomplete frame"""
+
+        self._tail = bytearray()
+
+    def feed_hits(self, readout: bytearray) -> np.ndarray:
+        """
+        Append readout to stream and extract all complete frames
+
+        Only the incomplete frame at the end of the stream is kept, idle bytes
+        are never scanned twice.
+
+        :param readout: Readout stream
+
+        :returns: Array with one 5 byte frame per row
+        """
+
+        data = np.frombuffer(bytes(self._tail) + bytes(readout), dtype=np.uint8)
+
+        idle_byte = 0xbc if self._reverse else 0x3d
+
+        starts = self.frame_starts((data != idle_byte) & (data != 0xff), self.bytesperhit)
+
+        complete = starts + self.bytesperhit <= len(data)
+
+        # At most the last frame can be incomplete
+        self._tail = bytearray(data[starts[-1]:]) if len(starts) and not complete[-1] else bytearray()
+
+        if len(self._tail):
+            logger.debug("Keep %d bytes of incomplete frame", len(self._tail))
+
+        hits = data[starts[complete][:, np.newaxis] + np.arange(self.bytesperhit)]
+
+        if self._reverse:
+            hits = REVERSE_BITORDER[hits]
+
+        return hits
+
+    def feed(self, readout: bytearray) -> pd.DataFrame:
+        """
+        Append readout to stream and decode all complete frames
+
+        :param readout: Readout stream
+
+        :returns: Dataframe with decoded hits
+        """
+
+        return self.decode_astropix2_hits_np(self.feed_hits(readout))
+
+    def decode_stream(self, readouts):
+        """
+        Decode an iterable of readouts
+
+        :param readouts: Iterable of readout streams
+
+        :returns: Generator yielding a dataframe with decoded hits per readout
+        """
+
+        for readout in readouts:
+            yield self.feed(readout)
+
+
+class TelescopeDecoder(StreamingDecoder):
+    """
+    Decode the readout stream of a telescope setup
+
+    The stream of all chips is decoded once with the vectorized decoder and split by chip ID
+    with one stable argsort, which keeps the frame order within each chip. Readouts can be
+    queued and decoded in batches, per chip only one dataframe slice per batch is added.
+    """
+
+    def __init__(self, nchips: int, sampleclock_period_ns = 5, reverse_bitorder: bool = True):
+        """
+        :param nchips: Number of chips in telescope
+        :param sampleclock_period_ns: Period of main clock in ns
+        :param reverse_bitorder: Reverse Bitorder per byte
+        """
+        super().__init__(sampleclock_period_ns, reverse_bitorder)
+
+        self.nchips = nchips
+        self._queue = []
+
+    def split(self, ids: np.ndarray) -> dict:
+        """
+        Group hits by chip ID
+
+        :param ids: Chip ID per hit
+
+        :returns: Dict with the indices of the hits of each chip, in stream order
+        """
+
+        order = np.argsort(ids, kind='stable')
+        chips, starts = np.unique(ids[order], return_index=True)
+
+        unknown = chips[chips >= self.nchips]
+        if len(unknown):
+            logger.warning("Frames with unknown chip ID %s", unknown.tolist())
+
+        return dict(zip(chips.tolist(), np.split(order, starts[1:])))
+
+    def demux(self, readout: bytearray) -> dict:
+        """
+        Append readout to stream and split complete frames by chip ID
+
+        :param readout: Readout stream
+
+        :returns: Dict with array of 5 byte frames per chip
+        """
+
+        hits = self.feed_hits(readout)
+
+        return {chip: hits[index] for chip, index in self.split(hits[:, 0] >> 3).items()}
+
+    def queue(self, readout: bytearray, index: int = 0) -> int:
+        """
+        Append readout to stream and queue complete frames for decode_queue
+
+        :param readout: Readout stream
+        :param index: Readout number
+
+        :returns: Number of queued frames of this readout
+        """
+
+        hits = self.feed_hits(readout)
+
+        if len(hits):
+            self._queue.append((index, hits))
+
+        return len(hits)
+
+    def decode_queue(self) -> dict:
+        """
+        Decode all queued frames at once and split them by chip ID
+
+        :returns: Dict with dataframe of decoded hits per chip, with readout number column
+        """
+
+        items, self._queue = self._queue, []
+
+        if not items:
+            return {}
+
+        hits = np.concatenate([hits for _, hits in items])
+        readouts = np.repeat([index for index, _ in items], [len(hits) for _, hits in items])
+
+        # Frames are sorted by chip before decoding, the chips are then slices of one dataframe
+        groups = self.split(hits[:, 0] >> 3)
+        order = np.concatenate(list(groups.values()))
+
+        decoded = pd.DataFrame({**self.hit_fields(hits[order]), 'readout': readouts[order]})
+        bounds = np.cumsum([0] + [len(index) for index in groups.values()])
+
+        return {chip: decoded.iloc[begin:end].reset_index(drop=True)
+                for chip, begin, end in zip(groups, bounds[:-1], bounds[1:])}
+
+    def feed_telescope(self, readout: bytearray, index: int = 0) -> dict:
+        """
+        Demultiplex and decode readout
+
+        :param readout: Readout stream
+        :param index: Readout number
+
+        :returns: Dict with dataframe of decoded hits per chip
+        """
+
+        self.queue(readout, index)
+
+        return self.decode_queue()
+
+    def reset(self) -> None:
+        """Drop incomplete frame and queued frames"""
+
+        super().reset()
+
+        self._queue = []
@@ -6,16 +6,25 @@ Created on Fri Jun 25 16:10:45 2021
 @author: Nicolas Striebig
 
 """
-import ftd2xx as ftd
 import sys
 import time
 
 import logging
 import binascii
 
+import numpy as np
+from bitstring import Bits
+
 from core.spi import Spi
+from core.simulator import NexysSimulator
 from modules.setup_logger import logger
 
+# ftd2xx is only needed for hardware, the simulator runs without it
+try:
+    import ftd2xx as ftd
+except (ImportError, OSError):
+    ftd = None
+
 READ_ADRESS     = 0x00
 WRITE_ADRESS    = 0x01
 
@@ -27,6 +36,13 @@ LD_ASIC         = 0x08
 SIN_GECCO       = 0x02
 LD_GECCO        = 0x04
 
+# Patterns per config bit, indexed by bit value
+ASIC_BIT_PATTERN = np.array([[0, 1, 0, 2, 0],
+                             [SIN_ASIC, SIN_ASIC | 1, SIN_ASIC, SIN_ASIC | 2, SIN_ASIC]], dtype=np.uint8)
+ASIC_READBACK_PATTERN = bytes([4, 4 | 1, 4, 4 | 2, 4])
+GECCO_BIT_PATTERN = np.array([[0, 1, 0],
+                              [SIN_GECCO, SIN_GECCO | 1, SIN_GECCO]], dtype=np.uint8)
+
 NEXYS_USB_DESC  = b'Digilent USB Device A'
 NEXYS_USB_SER   = b'210276'
 
@@ -51,14 +67,24 @@ class Nexysio(Spi):
         :returns: Device handle
         """
 
-        data = bytearray()
-
         clkdiv = max(clkdiv, 1)
 
-        for byte in value:
-            data.extend([byte] * clkdiv)
+        return bytearray(np.repeat(np.frombuffer(bytes(value), dtype=np.uint8), clkdiv).tobytes())
 
-        return data
+    @staticmethod
+    def __bits(value: bytearray) -> np.ndarray:
+        """
+        Convert bitvector to array with one element per bit
+
+        :param value: BitArray or iterable of bits
+
+        :returns: Array of 0/1
+        """
+
+        if isinstance(value, Bits):
+            return np.unpackbits(np.frombuffer(value.tobytes(), dtype=np.uint8))[:len(value)]
+
+        return np.array([bit == 1 for bit in value], dtype=np.uint8)
 
     def debug_print(self, name: str, length: int, hbyte: int, lbyte: int, 
                     header: bytearray, value: bytearray):
@@ -79,6 +105,8 @@ class Nexysio(Spi):
         :returns: Device handle
         """
 
+        self.__check_ftd()
+
         self._handle = ftd.open(index)
 
         devinfo = self._handle.getDeviceInfo()
@@ -105,6 +133,8 @@ class Nexysio(Spi):
 
         :returns: Device handle
         """
+        self.__check_ftd()
+
         # Get list with serialnumbers and descritions of all connected devices
         device_serial = ftd.listDevices(0)
         device_desc = ftd.listDevices(2)
@@ -130,6 +160,28 @@ class Nexysio(Spi):
         print('Nexys not found')
         return False
 
+    def simulate(self, **kwargs):
+        """
+        Opens a simulated Nexys instead of the FTDI device
+
+        :param kwargs: Arguments of NexysSimulator, e.g. hitrate
+
+        :returns: Device handle
+        """
+
+        self._handle = NexysSimulator(**kwargs)
+        self.__setup()
+
+        logger.info("Simulated Nexys opened")
+
+        return self._handle
+
+    @staticmethod
+    def __check_ftd() -> None:
+        if ftd is None:
+            logger.error('ftd2xx could not be loaded, only simulation is available')
+            sys.exit(1)
+
     def write(self, value: bytes) -> None:
         """
         Direct write to FTDI chip
@@ -142,7 +194,7 @@ class Nexysio(Spi):
             # split large vectors into multiple parts
             while len(value) > 64000:
                 logger.debug("Split writevector in parts")
-                self._handle.write(value[0:63999])
+                self._handle.write(value[0:64000])
                 value = value[64000:]
 
             self._handle.write(value)
@@ -241,6 +293,29 @@ class Nexysio(Spi):
 
         return answer
 
+    def read_registers(self, registers: list) -> bytes:
+        """
+        Read from multiple Registers in one USB transaction
+
+        :param registers: List of (register, number of bytes) tuples
+
+        :returns: Concatenated register values
+        """
+
+        request = bytearray()
+        num = 0
+
+        for register, length in registers:
+            request.extend([READ_ADRESS, register, length >> 8, length % 256])
+            num += length
+
+        self.write(bytes(request))
+        answer = self.read(num)
+
+        logger.debug("Read Registers %s Value 0x%s", registers, answer.hex())
+
+        return answer
+
     def gen_gecco_pattern(self, address: int, value: bytearray, clkdiv: int = 16) -> bytes:
         """
         Generate GECCO SR write pattern from bitvector
@@ -262,21 +337,16 @@ class Nexysio(Spi):
 
         self.debug_print("GECCO Config", length, hbyte, lbyte, header, value)
 
-        data = bytearray()
-
         # data
-        for bit in value:
-            pattern = SIN_GECCO if bit == 1 else 0
-
-            data.extend([pattern, pattern | 1, pattern])
+        data = GECCO_BIT_PATTERN[self.__bits(value)].tobytes()
 
         # Load signal
-        data.extend([LD_GECCO, 0x00])
+        data += bytes([LD_GECCO, 0x00])
 
         # Add 8 clocks
-        data.extend([0x01, 0x00] * 8)
+        data += bytes([0x01, 0x00] * 8)
 
-        data.extend([LD_GECCO, 0x00])
+        data += bytes([LD_GECCO, 0x00])
 
         data = self.__addbytes(data, clkdiv)
 
@@ -298,7 +368,8 @@ class Nexysio(Spi):
         # Number of Bytes to write
 
         if not readback_mode:
-            length = (len(value) * 5 + 30) * clkdiv
+            # 30 bytes load signal only in the last part
+            length = (len(value) * 5 + (30 if wload else 0)) * clkdiv
         else:
             length = ((len(value)+1) * 5) * clkdiv
 
@@ -311,27 +382,17 @@ class Nexysio(Spi):
 
         self.debug_print("ASIC Config", length, hbyte, lbyte, header, value)
 
-        data, load = bytearray(), bytearray()
-
         if not readback_mode:
-        # data
-            for bit in value:
-                pattern = SIN_ASIC if bit == 1 else 0
-
-                data.extend([pattern, pattern | 1, pattern, pattern | 2, pattern]) # Generate double clocked pattern
+            # data, double clocked pattern per bit
+            data = self.__addbytes(ASIC_BIT_PATTERN[self.__bits(value)].tobytes(), clkdiv)
 
             # Load signal
             if wload:
-                load.extend([0x00, LD_ASIC, 0x00])
-
-            data = self.__addbytes(data, clkdiv)
-            data.extend(self.__addbytes(load, clkdiv * 10))
+                data.extend(self.__addbytes([0x00, LD_ASIC, 0x00], clkdiv * 10))
 
         else:
-            data.extend([4 | 32, 4 | 33, 4|32, 4 | 34, 4|32])
-            for bit in value:
-                #data.extend([4 | 32, 4 | 33, 4, 4 | 2, 4])
-                data.extend([4 , 4 | 1, 4, 4 | 2, 4])
+            data = bytearray([4 | 32, 4 | 33, 4|32, 4 | 34, 4|32])
+            data.extend(ASIC_READBACK_PATTERN * len(value))
             data = self.__addbytes(data, clkdiv)
 
         # concatenate header+data
@@ -362,7 +423,7 @@ class Nexysio(Spi):
 
         while length >= max_value:
             data.append(self.gen_asic_pattern_part(value[:max_value], False, clkdiv, readback_mode))
-            value=value[max_value + 1:]
+            value=value[max_value:]
             length -= max_value
         else:
             data.append(self.gen_asic_pattern_part(value, wload, clkdiv, readback_mode))
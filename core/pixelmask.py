@@ -0,0 +1,200 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Array-backed pixel mask and injection map
+
+Bit layout of the recconfig word of column N, for num_rows rows:
+| Bit 0                 Injection enable of row N
+| Bit 1 - num_rows      Comparator disable of rows 0 - num_rows-1
+| Bit num_rows+1        Injection enable of column N
+| Bit num_rows+2        Analog output of column N
+"""
+import logging
+
+import numpy as np
+
+from modules.setup_logger import logger
+
+logger = logging.getLogger(__name__)
+
+
+class PixelMask:
+    """Comparator enable, injection and analog output state of one chip"""
+
+    def __init__(self, num_cols: int = 35, num_rows: int = 35) -> None:
+        """
+        Create mask with all pixels, injection switches and analog outputs disabled
+
+        :param num_cols: Number of columns
+        :param num_rows: Number of rows
+        """
+
+        self.num_cols = num_cols
+        self.num_rows = num_rows
+
+        # Comparator enable, indexed [col, row]
+        self.comparator = np.zeros((num_cols, num_rows), dtype=bool)
+
+        self.inj_row = np.zeros(num_rows, dtype=bool)
+        self.inj_col = np.zeros(num_cols, dtype=bool)
+        self.ampout = np.zeros(num_cols, dtype=bool)
+
+    @property
+    def nbits(self) -> int:
+        """Length of recconfig word"""
+
+        return self.num_rows + 3
+
+    @classmethod
+    def from_words(cls, words, num_rows: int = 35) -> 'PixelMask':
+        """
+        Create mask from recconfig words
+
+        :param words: recconfig word per column
+        :param num_rows: Number of rows
+
+        :returns: PixelMask
+        """
+
+        words = np.asarray(words, dtype=np.uint64)
+
+        mask = cls(len(words), num_rows)
+        bits = ((words[:, None] >> np.arange(mask.nbits, dtype=np.uint64)) & 1).astype(bool)
+
+        mask.comparator[:] = ~bits[:, 1:num_rows + 1]
+        mask.inj_row[:] = bits[:num_rows, 0] if mask.num_cols >= num_rows \
+            else np.pad(bits[:, 0], (0, num_rows - mask.num_cols))
+        mask.inj_col[:] = bits[:, num_rows + 1]
+        mask.ampout[:] = bits[:, num_rows + 2]
+
+        return mask
+
+    @classmethod
+    def from_recconfig(cls, recconfig: dict, num_cols: int = 35, num_rows: int = 35) -> 'PixelMask':
+        """
+        Create mask from recconfig section of an ASIC config
+
+        :param recconfig: Dict with [nbits, value] per column 'col<N>'
+        :param num_cols: Number of columns
+        :param num_rows: Number of rows
+
+        :returns: PixelMask
+        """
+
+        return cls.from_words([recconfig[f'col{col}'][1] for col in range(num_cols)], num_rows)
+
+    def to_words(self) -> np.ndarray:
+        """
+        Encode mask to recconfig words
+
+        :returns: Array with recconfig word per column
+        """
+
+        bits = np.zeros((self.num_cols, self.nbits), dtype=np.uint64)
+
+        rows = min(self.num_cols, self.num_rows)
+        bits[:rows, 0] = self.inj_row[:rows]
+        bits[:, 1:self.num_rows + 1] = ~self.comparator
+        bits[:, self.num_rows + 1] = self.inj_col
+        bits[:, self.num_rows + 2] = self.ampout
+
+        return (bits << np.arange(self.nbits, dtype=np.uint64)).sum(axis=1, dtype=np.uint64)
+
+    def to_recconfig(self, recconfig: dict) -> None:
+        """
+        Write mask to recconfig section of an ASIC config
+
+        :param recconfig: Dict with [nbits, value] per column 'col<N>'
+        """
+
+        for col, word in enumerate(self.to_words()):
+            recconfig.setdefault(f'col{col}', [self.nbits, 0])[1] = int(word)
+
+    def copy(self) -> 'PixelMask':
+        """Returns independent copy"""
+
+        mask = PixelMask(self.num_cols, self.num_rows)
+        mask.comparator[:] = self.comparator
+        mask.inj_row[:] = self.inj_row
+        mask.inj_col[:] = self.inj_col
+        mask.ampout[:] = self.ampout
+
+        return mask
+
+    def __check(self, cols, rows) -> tuple:
+        cols = np.asarray(cols, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+
+        valid = (cols >= 0) & (cols < self.num_cols) & (rows >= 0) & (rows < self.num_rows)
+
+        if not np.all(valid):
+            logger.error("Ignored %d pixels outside of %dx%d matrix", np.size(valid) - np.count_nonzero(valid),
+                         self.num_cols, self.num_rows)
+
+        return cols[valid], rows[valid]
+
+    def enable_pixels(self, cols, rows) -> None:
+        """
+        Enable comparators
+
+        :param cols: Column or array of columns
+        :param rows: Row or array of rows
+        """
+
+        cols, rows = self.__check(cols, rows)
+        self.comparator[cols, rows] = True
+
+    def disable_pixels(self, cols, rows) -> None:
+        """
+        Disable comparators
+
+        :param cols: Column or array of columns
+        :param rows: Row or array of rows
+        """
+
+        cols, rows = self.__check(cols, rows)
+        self.comparator[cols, rows] = False
+
+    def set_pixels(self, enable) -> None:
+        """
+        Set comparators from boolean array
+
+        :param enable: Boolean array with shape (num_cols, num_rows), or scalar for all pixels
+        """
+
+        self.comparator[:] = enable
+
+    def reset(self) -> None:
+        """Disable all pixels, injection switches and analog outputs, as Asic.reset_recconfig"""
+
+        self.comparator[:] = False
+        self.inj_row[:] = False
+        self.inj_col[:] = False
+        self.ampout[:] = False
+
+    def apply_noise_scan(self, cols, rows, counts, threshold: int) -> int:
+        """
+        Disable pixels with more than threshold noise counts, enable all other scanned pixels
+
+        :param cols: Array of columns
+        :param rows: Array of rows
+        :param counts: Array of noise counts per pixel
+        :param threshold: Maximum number of noise counts of enabled pixels
+
+        :returns: Number of masked pixels
+        """
+
+        cols, rows, counts = (np.asarray(values, dtype=np.int64) for values in (cols, rows, counts))
+
+        noisy = counts > threshold
+
+        self.disable_pixels(cols[noisy], rows[noisy])
+        self.enable_pixels(cols[~noisy], rows[~noisy])
+
+        logger.info("Masked %d of %d scanned pixels with more than %d noise counts",
+                    np.count_nonzero(noisy), len(counts), threshold)
+
+        return int(np.count_nonzero(noisy))
+
+    def __repr__(self) -> str:
+        return f"PixelMask({self.num_cols}x{self.num_rows}, {np.count_nonzero(self.comparator)} pixels enabled)"
@@ -0,0 +1,279 @@
+# -*- coding: utf-8 -*-
+""""""
+"""
+Software model of the Nexys FTDI interface
+
+NexysSimulator implements the parts of the ftd2xx device handle used by Nexysio,
+so all I/O paths can be run and profiled without FPGA.
+"""
+import logging
+import time
+
+import numpy as np
+
+from core.spi import SPI_CONFIG_REG, SPI_WRITE_REG, SPI_READ_REG, \
+    SPI_READBACK_REG, SPI_READBACK_REG_CONF, SPI_REVERSE_BITORDER
+from modules.setup_logger import logger
+
+READ_ADRESS     = 0x00
+WRITE_ADRESS    = 0x01
+
+CONFIG_REG      = 0x00
+INTERRUPT_REG   = 70
+
+# Idle byte clocked out by the chip if no hits are buffered
+IDLE_BYTE       = 0xbc
+
+# Value returned when reading from an empty FIFO
+EMPTY_BYTE      = 0xff
+
+logger = logging.getLogger(__name__)
+
+
+class NexysSimulator:
+    """
+    Emulated Nexys FTDI device handle with AstroPix3 hit generator
+
+    Registers:
+    | Config Register 0 (0x00), Bit 4 chip reset, writes >1 Byte are ASIC SR patterns
+    | SPI_Config Register 21 (0x15), FIFO flags are generated from the FIFO state
+    | SPI_CLKDIV Register 22 (0x16)
+    | SPI_Write Register 23 (0x17), every byte clocks one byte out of the chip
+    | SPI_Read Register 24 (0x18)
+    | SR Readback Register 60/61 (0x3C/0x3D)
+    | Interrupt Register 70, 0 if hits are buffered in the chip
+    | all other registers store the last written value
+    """
+
+    def __init__(self, hitrate: float = 1000., chipid: int = 0, num_cols: int = 35, num_rows: int = 35,
+                 seed: int = None, nchips: int = 1) -> None:
+        """
+        :param hitrate: Mean rate of generated hits in Hz, each hit gives a row and a column frame
+        :param chipid: Chip ID written to the frames, first chip ID for telescopes
+        :param num_cols: Number of columns
+        :param num_rows: Number of rows
+        :param seed: Seed of the random number generator
+        :param nchips: Number of chips in a telescope, hits are spread evenly over the chips
+        """
+
+        self.hitrate = hitrate
+        self.chipid = chipid
+        self.nchips = nchips
+        self.num_cols = num_cols
+        self.num_rows = num_rows
+
+        self.registers = bytearray(256)
+
+        self._rng = np.random.default_rng(seed)
+        self._last = time.monotonic()
+
+        # Bytes buffered in the chip, not yet clocked out
+        self._chip = bytearray()
+        self._chip_pos = 0
+
+        self._read_fifo = bytearray()
+        self._answer = bytearray()
+
+        # Incomplete command of the last write
+        self._stream = bytearray()
+
+        self.reset_counters()
+
+    def reset_counters(self) -> None:
+        """Reset transaction and hit counters"""
+
+        self.transactions = 0
+        self.bytes_written = 0
+        self.bytes_read = 0
+        self.hits_generated = 0
+        self.sr_bytes = 0
+
+    # ftd2xx handle interface
+
+    def getDeviceInfo(self) -> dict:
+        return {'type': 0, 'id': 0, 'description': b'Digilent USB Device A', 'serial': b'210276SIM'}
+
+    def setTimeouts(self, read: int, write: int) -> None:
+        pass
+
+    def setBitMode(self, mask: int, enable: int) -> None:
+        pass
+
+    def setLatencyTimer(self, latency: int) -> None:
+        pass
+
+    def setUSBParameters(self, in_size: int, out_size: int = 0) -> None:
+        pass
+
+    def close(self) -> None:
+        logger.info("Closed simulated Nexys")
+
+    def write(self, data: bytes) -> int:
+        """
+        Execute register read and write commands
+
+        Commands can be split across writes, as on the FTDI stream.
+
+        :param data: Commands with 4 Byte header, address, register, length high byte, length low byte
+
+        :returns: Number of bytes written
+        """
+
+        self.transactions += 1
+        self.bytes_written += len(data)
+
+        self._stream.extend(data)
+        i = 0
+
+        while i + 4 <= len(self._stream):
+            address, register, hbyte, lbyte = self._stream[i:i + 4]
+            length = (hbyte << 8) + lbyte
+
+            if address == WRITE_ADRESS:
+                if i + 4 + length > len(self._stream):
+                    break
+                self.__write_register(register, bytes(self._stream[i + 4:i + 4 + length]))
+                i += 4 + length
+            else:
+                self._answer.extend(self.__read_register(register, length))
+                i += 4
+
+        del self._stream[:i]
+
+        return len(data)
+
+    def read(self, num: int) -> bytes:
+        """
+        Read answers to previous read commands
+
+        :param num: Number of bytes
+
+        :returns: Answer bytes
+        """
+
+        if num > len(self._answer):
+            logger.warning("Read timeout, requested %d bytes, %d available", num, len(self._answer))
+
+        answer = bytes(self._answer[:num])
+        del self._answer[:num]
+
+        self.bytes_read += len(answer)
+
+        return answer
+
+    # Register model
+
+    def __write_register(self, register: int, value: bytes) -> None:
+
+        if register == CONFIG_REG and len(value) > 1:
+            # ASIC shift register pattern
+            self.sr_bytes += len(value)
+
+        elif register == SPI_WRITE_REG:
+            self.__clock_spi(len(value))
+
+        elif register == SPI_CONFIG_REG and value:
+            config = value[-1]
+            # Write FIFO is drained instantly, only the read FIFO needs a reset
+            if config & 8:
+                self._read_fifo.clear()
+            # Flags are read-only
+            self.registers[register] = config & 0b11001001
+
+        elif register == CONFIG_REG and value:
+            if value[-1] & 16:
+                self._chip.clear()
+                self._chip_pos = 0
+                self._last = time.monotonic()
+            self.registers[register] = value[-1]
+
+        elif value:
+            self.registers[register] = value[-1]
+
+    def __read_register(self, register: int, num: int) -> bytes:
+
+        if register == SPI_READ_REG:
+            answer = bytes(self._read_fifo[:num])
+            del self._read_fifo[:num]
+            return answer + bytes([EMPTY_BYTE]) * (num - len(answer))
+
+        if register == SPI_CONFIG_REG:
+            # Write FIFO empty, read FIFO empty flags
+            value = self.registers[register] | 2 | (0 if self._read_fifo else 16)
+        elif register == SPI_READBACK_REG_CONF:
+            value = self.registers[register] | 16
+        elif register == SPI_READBACK_REG:
+            value = 0
+        elif register == INTERRUPT_REG:
+            self.__generate()
+            value = 0 if len(self._chip) > self._chip_pos else 1
+        else:
+            value = self.registers[register]
+
+        return bytes([value]) * num
+
+    # Chip model
+
+    def __clock_spi(self, num: int) -> None:
+        """Clock num bytes out of the chip into the read FIFO"""
+
+        # SPI module in reset
+        if self.registers[SPI_CONFIG_REG] & 128:
+            return
+
+        self.__generate()
+
+        data = self._chip[self._chip_pos:self._chip_pos + num]
+        self._chip_pos += len(data)
+
+        self._read_fifo.extend(data)
+        self._read_fifo.extend([IDLE_BYTE] * (num - len(data)))
+
+        if self._chip_pos == len(self._chip):
+            self._chip.clear()
+            self._chip_pos = 0
+
+    def __generate(self) -> None:
+        """Generate hits for the time passed since the last call"""
+
+        now = time.monotonic()
+        elapsed, self._last = now - self._last, now
+
+        # Chip in reset
+        if self.registers[CONFIG_REG] & 16:
+            return
+
+        nhits = self._rng.poisson(self.hitrate * elapsed) if self.hitrate > 0 else 0
+
+        if nhits:
+            self._chip.extend(self.gen_frames(nhits))
+            self.hits_generated += nhits
+
+    def gen_frames(self, nhits: int) -> bytes:
+        """
+        Generate bit-reversed AstroPix3 frames, a row and a column frame per hit
+
+        :param nhits: Number of hits
+
+        :returns: Frame bytes as clocked out by the chip
+        """
+
+        rng = self._rng
+
+        location = np.empty((nhits, 2), dtype=np.uint8)
+        location[:, 0] = rng.integers(0, self.num_rows, nhits)
+        location[:, 1] = rng.integers(0, self.num_cols, nhits) | 0x80
+
+        timestamp = rng.integers(0, 256, nhits, dtype=np.uint8)
+        tot = rng.integers(0, 4096, (nhits, 2), dtype=np.uint16)
+
+        frames = np.empty((nhits, 2, 5), dtype=np.uint8)
+        chipids = self.chipid + rng.integers(0, self.nchips, nhits, dtype=np.uint8)
+
+        frames[:, :, 0] = ((chipids << 3) | 4)[:, None]
+        frames[:, :, 1] = location
+        frames[:, :, 2] = timestamp[:, None]
+        frames[:, :, 3] = tot >> 8
+        frames[:, :, 4] = tot & 0xff
+
+        return frames.tobytes().translate(SPI_REVERSE_BITORDER)
@@ -7,7 +7,6 @@ Created on Tue Jul 12 20:07:13 2021
 """
 import logging
 from time import sleep
-from bitstring import BitArray
 
 from modules.setup_logger import logger
 
@@ -32,6 +31,12 @@ SPI_HEADER_EMPTY    = 0b001 << 5
 SPI_HEADER_ROUTING  = 0b010 << 5
 SPI_HEADER_SR       = 0b011 << 5
 
+# Depth of the Nexys SPI Write FIFO
+SPI_FIFO_DEPTH      = 1023
+
+# Lookup table to reverse bit order of a byte with bytes.translate
+SPI_REVERSE_BITORDER = bytes(int(f'{i:08b}'[::-1], 2) for i in range(256))
+
 logger = logging.getLogger(__name__)
 
 
@@ -55,6 +60,8 @@ class Spi:
     """
     def __init__(self):
         self._spi_clkdiv = 16
+        self._spi_readout_bytes = 0
+        self._spi_readout_cmd = {}
 
     @staticmethod
     def set_bit(value, bit):
@@ -163,6 +170,8 @@ class Spi:
             configregister = self.clear_bit(configregister, bit)
             self.write_register(SPI_CONFIG_REG, configregister, True)
 
+        self._spi_readout_bytes = 0
+
     def sr_readback_reset(self) -> None:
         """
         Reset SPI
@@ -193,6 +202,7 @@ class Spi:
         :param data: Data
         """
         self.write_registers(SPI_WRITE_REG, data, True)
+        self._spi_readout_bytes += len(data)
 
     def read_spi(self, num: int):
         """
@@ -220,17 +230,40 @@ class Spi:
         """ Continous readout """
         pass
 
-    def read_spi_fifo(self) -> bytearray:
-        """ Read Data from SPI FIFO until empty """
+    def read_spi_fifo(self, max_chunk: int = 64, wait: float = 0) -> bytearray:
+        """
+        Read Data from SPI FIFO until empty
+
+        Every byte written to SPI clocks one byte into the read FIFO. These bytes are read
+        in one USB transaction together with the SPI config register, so the empty flag needs
+        no extra round trip. Data beyond that is read in chunks of max_chunk.
+
+        :param max_chunk: Bytes per read if the FIFO content is not known
+        :param wait: Wait between chunks in s
+
+        :returns: SPI Read data
+        """
 
         read_stream = bytearray()
 
-        while not self.get_spi_config() & 16:
-            readbuffer = self.read_spi(64)
+        expected = self._spi_readout_bytes
+        self._spi_readout_bytes = 0
 
-            read_stream.extend(readbuffer)
+        empty = self.get_spi_config() & 16
 
-            sleep(0.01)
+        while not empty:
+            if len(read_stream) < expected:
+                chunk = min(65535, expected - len(read_stream))
+            else:
+                chunk = max_chunk
+
+            readbuffer = self.read_registers([(SPI_READ_REG, chunk), (SPI_CONFIG_REG, 1)])
+
+            read_stream.extend(readbuffer[:chunk])
+            empty = readbuffer[chunk] & 16
+
+            if wait:
+                sleep(wait)
 
         return read_stream
 
@@ -252,6 +285,8 @@ class Spi:
         """
         Write to SPI for readout
 
+        The readout command only depends on n_bytes, its USB packets are built once and cached.
+
         :param n_bytes: Number of Bytes
         """
 
@@ -260,7 +295,14 @@ class Spi:
             logger.warning("Cannot write more than 64000 Bytes")
 
         logger.info("SPI: Write %d Bytes", 8 * n_bytes + 4)
-        self.write_spi(bytearray([SPI_HEADER_EMPTY] * n_bytes * 8), False, 8191)
+
+        packets = self._spi_readout_cmd.get(n_bytes)
+
+        if packets is None:
+            packets = self.spi_write_packets(bytearray([SPI_HEADER_EMPTY] * n_bytes * 8), False)
+            self._spi_readout_cmd[n_bytes] = packets
+
+        self.__write_spi_packets(packets)
 
     def send_routing_cmd(self) -> None:
         """
@@ -270,58 +312,57 @@ class Spi:
         logger.info("SPI: Send routing cmd")
         self.write_spi(bytearray([SPI_HEADER_EMPTY, 0, 0, 0, 0, 0, 0, 0]), False)
 
-    def write_spi(self, data: bytearray, MSBfirst: bool = True, buffersize: int = 1023) -> None:
+    def spi_write_packets(self, data: bytearray, MSBfirst: bool = True, buffersize: int = SPI_FIFO_DEPTH) -> list:
         """
-        Write to Nexys SPI Write FIFO
+        Generate USB packets for the Nexys SPI Write FIFO
 
         :param data: Bytearray vector
         :param MSBfirst: SPI MSB first
-        :param buffersize: Buffersize
+        :param buffersize: Maximum bytes per packet, limited to the FIFO depth
+
+        :returns: List of packets with SPI write register header and data
         """
 
-        if not MSBfirst:
+        data = bytes(data)
 
-            for index, item in enumerate(data):
+        if not MSBfirst:
+            data = data.translate(SPI_REVERSE_BITORDER)
 
-                item_rev = BitArray(uint=item, length=8)
-                item_rev.reverse()
+        logger.debug('SPIdata: %s', data)
 
-                data[index] = item_rev.uint
+        buffersize = max(1, min(buffersize, SPI_FIFO_DEPTH))
 
-        logger.debug('SPIdata: %s', data)
+        return [bytes(self.write_registers(SPI_WRITE_REG, data[i:i + buffersize]))
+                for i in range(0, len(data), buffersize)]
 
-        waiting = True
-        i = 0
-        counter = buffersize / 3
+    def __write_spi_packets(self, packets: list) -> None:
+        """
+        Write packets to Nexys SPI Write FIFO
 
-        # WrFIFO bit positons in spi_config register 0x21
-        compare_empty = 2
-        compare_full = 4
+        Each packet fills at most the whole FIFO, so waiting for the FIFO to run empty
+        before every packet is sufficient flow control.
 
-        # Check if WrFIFO is Empty
-        while waiting:
+        :param packets: List of packets from spi_write_packets
+        """
 
-            # Convert Hex string to int
-            result = self.get_spi_config()
+        for packet in packets:
 
             # Wait until WrFIFO empty
-            if result & compare_empty:
-                waiting = False
-
-        while i < len(data):
+            while not self.get_spi_config() & 2:
+                pass
 
-            if counter > 0:
-                writebuffer = bytearray(data[i:(i + 16)])
+            self.write(packet)
 
-                i += 16
-                counter -= 1
+            # Every byte written clocks one byte out of the chip into the read FIFO
+            self._spi_readout_bytes += len(packet) - 4
 
-                self.direct_write_spi(bytes(writebuffer))
+    def write_spi(self, data: bytearray, MSBfirst: bool = True, buffersize: int = SPI_FIFO_DEPTH) -> None:
+        """
+        Write to Nexys SPI Write FIFO
 
-            else:
-                result = self.get_spi_config()
+        :param data: Bytearray vector
+        :param MSBfirst: SPI MSB first
+        :param buffersize: Buffersize
+        """
 
-                if result & compare_empty:
-                    counter = buffersize / 3
-                elif not result & compare_full:
-                    counter = 1
+        self.__write_spi_packets(self.spi_write_packets(data, MSBfirst, buffersize))
@@ -37,10 +37,9 @@ class Voltageboard(Nexysio):
 
         vdacbits = BitArray()
 
-        # Reverse List of dacs in-place
-        dacs.reverse()
-
-        for vdac in dacs:
+        # DACs are sent in reverse order, the list itself is not changed
+        # so repeated updates send the same vector
+        for vdac in reversed(dacs):
 
             dacvalue = int(vdac * 16383 / self.vsupply / self.vcal)
 
@@ -1,38 +1,19 @@
 """
 Decode raw data (bitstreams) after data-taking, save decoded information in CSV format identical to when running beam_test.py with option -c
+Files, or chunks of large files, are decoded in parallel processes (modules/postrun.py)
 
 Author: Amanda Steinhebel
 amanda.l.steinhebel@nasa.gov
 """
 
-from astropix import astropix3
 import glob
-import binascii
-import pandas as pd
-import numpy as np
 import logging
 import argparse
-import re
-import time
 
+from modules.rawdata import RAW_EXTENSION
+from modules.postrun import decode_files, output_path
 from modules.setup_logger import logger
 
-# This is the dataframe which is written to the csv if the decoding fails
-decode_fail_frame = pd.DataFrame({
-                'readout': np.nan,
-                'Chip ID': np.nan,
-                'payload': np.nan,
-                'location': np.nan,
-                'isCol': np.nan,
-                'timestamp': np.nan,
-                'tot_msb': np.nan,
-                'tot_lsb': np.nan,
-                'tot_total': np.nan,
-                'tot_us': np.nan,
-                'hittime': np.nan
-                }, index=[0]
-)
-
 
 #Initialize
 def main(args):
@@ -41,13 +22,13 @@ def main(args):
     if args.fileInput and args.dirInput:
         logger.error("Input a single file with -f OR a single directory with -d... not both! Try running again")
         exit()
+    if not args.fileInput and not args.dirInput:
+        logger.error("Input a single file with -f or a single directory with -d")
+        exit()
 
     #Define boolean for args.fileInput
     f_in = True if args.fileInput is not None else False
 
-    #Create objet
-    astro = astropix3(offline=True)
-
     #Define output file path
     if args.outDir is not None:
         outpath = args.outDir
@@ -61,69 +42,22 @@ def main(args):
         outpath = args.dirInput
     
     #Symmetrize structure
-    inputFiles = [args.fileInput] if f_in else glob.glob(f'{args.dirInput}*.log')
-
-    #Run over all input files
-    for infile in inputFiles:
-
-        #Define output file name
-        csvname = re.split(r'\\|/',infile)[-1][:-4] #split Mac or OS path; identify file name and eliminate '.log'
-        csvpath = outpath + csvname + '_offline.csv'
-
-        #Setup CSV structure
-        csvframe =pd.DataFrame(columns = [
-                'readout',
-                'Chip ID',
-                'payload',
-                'location',
-                'isCol',
-                'timestamp',
-                'tot_msb',
-                'tot_lsb',
-                'tot_total',
-                'tot_us',
-                'hittime'
-        ])
-
-        #Import data file            
-        f=np.loadtxt(infile, skiprows=6, dtype=str)
-
-        #isolate only bitstream without b'...' structure 
-        strings = [a[2:-1] for a in f[:,1]]
-        #print(strings)
-
-        i = 0
-        errors=0
-
-        for s in strings:
-            #convert hex to binary and decode
-            rawdata = list(binascii.unhexlify(s))
-            #print(rawdata)
-            try:
-                hits = astro.decode_readout(rawdata, i, printer = args.printDecode)
-                #print(hits)
-                hits.hittime = time.time()
-            except IndexError:
-                errors += 1
-                logger.warning(f"Decoding failed. Failure {errors} on readout {i}")
-                hits = decode_fail_frame
-                #hits.rawdata = i
-                hits['hittime']=np.nan
-            finally:
-                i += 1
-                #Overwrite hittime - computed during decoding
-                #Populate csv
-                csvframe = pd.concat([csvframe, hits])
-                #csvframe.readout = csvframe.readout.astype(int)
-        #Save csv
-        logger.info(f"Saving to {csvpath}")
-        csvframe.to_csv(csvpath)
+    inputFiles = [args.fileInput] if f_in else sorted(glob.glob(f'{args.dirInput}*.log') + glob.glob(f'{args.dirInput}*{RAW_EXTENSION}'))
+
+    #Decode all input files in parallel, files are split in chunks of readouts
+    #Unchanged files are skipped, files that grew are decoded from where the last run stopped
+    nhits = decode_files(inputFiles, outpath, workers=args.jobs, chunksize=args.chunksize,
+                         fmt=args.format, printer=args.printDecode, force=args.force,
+                         calibration=args.calibration, kev_per_mv=args.kevpermv)
+
+    for infile, n in nhits.items():
+        logger.info(f"Decoded {n} hits from {infile} to {output_path(infile, outpath, args.format)}")
     
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Post-run decoding')
-    parser.add_argument('-f', '--fileInput', default=None, required=True,
+    parser.add_argument('-f', '--fileInput', default=None, required=False,
                     help='Input data file to decode')
 
     parser.add_argument('-d', '--dirInput', default=None, required=False,
@@ -135,9 +69,27 @@ if __name__ == "__main__":
     parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='I',
                     help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: D')
 
-    parser.add_argument('-p', '--printDecode', action='store_true', default=True, required=False,
+    parser.add_argument('-p', '--printDecode', action='store_true', default=False, required=False,
                     help='Print decoded info into terminal. Default: False')
 
+    parser.add_argument('-j', '--jobs', type=int, action='store', default=None, required=False,
+                    help='Number of decoding processes, 1 decodes without process pool. Default: number of CPUs')
+
+    parser.add_argument('--chunksize', type=int, action='store', default=10000, required=False,
+                    help='Number of readouts decoded per task. Default: 10000')
+
+    parser.add_argument('--format', type=str, choices = ['csv', 'parquet', 'h5'], action='store', default='csv', required=False,
+                    help='Output format of decoded hits. parquet requires pyarrow, h5 requires pytables. Default: csv')
+
+    parser.add_argument('--force', action='store_true', default=False, required=False,
+                    help='Decode all files again, ignoring the manifests of earlier runs. Default: False')
+
+    parser.add_argument('--calibration', action='store', default=None, required=False,
+                    help='Calibration array (.npy) of fit_calibration.py, adds charge_mv to the decoded hits. Default: None')
+
+    parser.add_argument('--kevpermv', type=float, action='store', default=None, required=False,
+                    help='Energy per mV injection voltage, adds energy_kev to calibrated hits. Default: None')
+
     #python3.9 decode_postRun.py -f "../BeamTest0223/BeamData/Chip_230103/run17_protons120_20230224-090711.log" -o "../BeamTest0223/BeamData/Chip_230103/" -L D -p
 
     parser.add_argument
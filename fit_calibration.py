@@ -0,0 +1,127 @@
+"""
+Fit per-pixel S-curves and ToT calibrations of an injection scan and save them as calibration array.
+Input are the decoded CSV files of injectionScan.py, the injection voltage is taken from
+the _<voltage>mVinj part of the file names.
+
+Run: python3.9 fit_calibration.py -f "./data/scan_*mVinj_*.csv" -o ./calibration -n chipA -N 100
+"""
+
+import glob
+import logging
+import argparse
+import os
+
+import numpy as np
+import pandas as pd
+
+from modules.aggregation import read_geometry
+from modules.clustering import read_hits, select_hits, match_pixels, PIXEL_COLUMNS
+from modules.calibration import injection_voltage, injection_tables, calibrate, save_calibration
+from modules.setup_logger import logger
+
+
+def main(args):
+
+    # Matrix size from chip config
+    num_cols, num_rows = read_geometry('./config/' + args.yaml + '.yml')
+
+    inputFiles = sorted(file for pattern in args.fileInput for file in glob.glob(pattern))
+
+    # Files of one injection voltage are combined
+    voltages = {}
+    for infile in inputFiles:
+        voltage = injection_voltage(os.path.basename(infile))
+        if voltage is None:
+            logger.warning(f"No injection voltage in file name {infile}, skipped")
+            continue
+        voltages.setdefault(voltage, []).append(infile)
+
+    if len(voltages) < 2:
+        logger.error("Need decoded files of at least two injection voltages")
+        return
+
+    x = np.array(sorted(voltages))
+    steps = []
+
+    for voltage in x:
+        pixels = []
+        for infile in voltages[voltage]:
+            try:
+                hits, _ = read_hits(infile)
+            except pd.errors.EmptyDataError:
+                # Steps below threshold may have no hits at all
+                continue
+            hits, _ = select_hits(hits)
+            pixels.append(match_pixels(hits, args.timestampdiff, args.totdiff))
+        steps.append(pd.concat(pixels, ignore_index=True) if pixels else pd.DataFrame(columns=PIXEL_COLUMNS))
+        logger.info(f"{voltage} mV: {sum(len(p) for p in pixels)} pixel hits in {len(voltages[voltage])} files")
+
+    counts, mean_tot = injection_tables(steps, num_cols, num_rows)
+    calibration = calibrate(x, counts, mean_tot, args.ninjections)
+
+    # Ensures output directory exists
+    if os.path.exists(args.outdir) == False:
+        os.makedirs(args.outdir)
+
+    name = 'calibration' + ('_' + args.name if args.name else '')
+    calpath = os.path.join(args.outdir, name + '.npy')
+    save_calibration(calpath, calibration)
+    print(f"{calpath} was created...")
+
+    # Human readable table of the calibrated pixels
+    if args.saveascsv:
+        csvpath = os.path.join(args.outdir, name + '.csv')
+        cols, rows = np.nonzero(calibration['valid'])
+        with open(csvpath, 'w') as csvfile:
+            csvfile.write("Col,Row," + ",".join(calibration.dtype.names[:-1]) + "\n")
+            for col, row in zip(cols, rows):
+                values = calibration[col, row]
+                csvfile.write(f"{col},{row}," + ",".join(f"{values[key]:.6g}" for key in calibration.dtype.names[:-1]) + "\n")
+        print(f"{csvpath} was created...")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Per-pixel calibration from injection scans')
+    parser.add_argument('-f', '--fileInput', nargs='+', required=True,
+                    help='Decoded data files (CSV) of injectionScan.py with _<voltage>mVinj in the name, wildcards allowed')
+
+    parser.add_argument('-o', '--outdir', default='./calibration', required=False,
+                    help='Output directory for the calibration array. Default: ./calibration')
+
+    parser.add_argument('-n', '--name', default='', required=False,
+                    help='Option to give additional name to output files')
+
+    parser.add_argument('-y', '--yaml', action='store', required=False, type=str, default = 'testconfig_v3',
+                    help = 'filepath (in config/ directory) .yml file containing chip configuration, used for the matrix size. Default: config/testconfig_v3.yml')
+
+    parser.add_argument('-N', '--ninjections', type=int, action='store', default=None, required=False,
+                    help='Number of injections per voltage step. Default: normalize every pixel to its highest count')
+
+    parser.add_argument('-c', '--saveascsv', action='store_true', default=False, required=False,
+                    help='Also save the calibrated pixels as CSV. Default: False')
+
+    parser.add_argument('--timestampdiff', type=float, required=False, default=0.5,
+                    help = 'Maximum timestamp difference of matched row and column hits. Default: 0.5')
+
+    parser.add_argument('--totdiff', type=float, required=False, default=1.0,
+                    help = 'Maximum ToT difference in us of matched row and column hits. Default: 1.0')
+
+    parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='I',
+                    help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: I')
+
+    args = parser.parse_args()
+
+    loglevel = {'D': logging.DEBUG, 'I': logging.INFO, 'E': logging.ERROR,
+                'W': logging.WARNING, 'C': logging.CRITICAL}[args.loglevel]
+
+    formatter = logging.Formatter('%(asctime)s:%(msecs)d.%(name)s.%(levelname)s:%(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+
+    logging.getLogger().addHandler(sh)
+    logging.getLogger().setLevel(loglevel)
+
+    logger = logging.getLogger(__name__)
+
+    main(args)
@@ -9,6 +9,9 @@ import pandas as pd
 import numpy as np
 import glob
 import os
+
+from modules.clustering import read_hits, select_hits, match_pixels, PIXEL_COLUMNS
+from modules.aggregation import PixelMaps
 plt.style.use('classic')
 
 def main(args):
@@ -26,8 +29,10 @@ def main(args):
     ###########################################################################
 
     ##### Loop over data files and Find hit pixels #######################################################
-    # List for hit pixels
-    pair = [] 
+    # Hit pixels per file
+    pairs = []
+    # Hits and ToT per pixel, matrix size from chip config
+    maps = PixelMaps.from_yaml('./config/' + args.yaml + '.yml')
     # How many events are remained in one dataset
     tot_n_nans = 0
     tot_n_evts = 0
@@ -35,76 +40,24 @@ def main(args):
     n_evt_used = 0
     # Loop over file
     for f in all_files:
-        # Read csv file
-        df = pd.read_csv(f)
+        # Read csv file, rows with NAN are skipped
+        df, n_nan_evts = read_hits(f)
         print(f"Reading in {f}...")
-     
+
         # Count per run
-        # Total number of rows
-        n_all_rows = df.shape[0]
-        # Non-NaN rows
-        n_non_nan_rows = df['readout'].count() 
-        # NaN events
-        n_nan_evts = n_all_rows - n_non_nan_rows
-        # Skip rows with NAN
-        df = df.apply(pd.to_numeric, errors='coerce')
-        df = df.dropna()
-        # Change float to int for readout col
-        df['readout'] = df['readout'].astype('Int64')
-        # Get last number of readouts/events per run
-        max_readout_n = df['readout'].iloc[-1]
-        
-        # Count for summary if multiple runs are read in
-        ni = 0
-        for ievt in range(0, max_readout_n+1, 1):
-            dff = df.loc[(df['readout'] == ievt)] 
-            if dff.empty:
-                continue
-            else:
-                ni += 1
-        n_evts = ni + n_nan_evts
+        n_evts = df['readout'].nunique() + n_nan_evts
         tot_n_evts += n_evts
         tot_n_nans += n_nan_evts
 
-        # Loop over readouts/events
-        for ievt in range(0, max_readout_n+1, 1):
-            # Collect one event
-            if args.exclusively:
-                dff = df. loc[(df['readout'] == ievt)] 
-            else:
-                dff = df.loc[(df['readout'] == ievt) & (df['payload'] == 4)]
-            # Check if it's empty
-            if dff.empty:
-                continue
-
-            # Check how many bad decoding lines within one event 
-            n_no_good_decoding = 0
-            for payload in dff['payload']:
-                if payload != 4:
-                    n_no_good_decoding += 1 
-            if n_no_good_decoding != 0:
-                n_evt_excluded += 1
-                pass
-            # Match col and row to find hit pixel
-            else:
-                n_evt_used += 1
-                # List column info of pixel within one event
-                dffcol = dff.loc[dff['isCol'] == True]
-                # List row info of pixel within one event
-                dffrow = dff.loc[dff['isCol'] == False]
-                # Matching conditions: timestamp and time-over-threshold (ToT)
-                timestamp_diff = args.timestampdiff
-                tot_time_limit = args.totdiff
-                # Loop over col and row info to find a pair to define a pixel
-                for indc in dffcol.index:
-                    for indr in dffrow.index:
-                        if ((abs(dffcol['timestamp'][indc] - dffrow['timestamp'][indr]) < timestamp_diff) & 
-                        (abs(dffcol['tot_us'][indc] - dffrow['tot_us'][indr]) < tot_time_limit)):
-                            # Record hit pixels per event
-                            pair.append([dffcol['location'][indc], dffrow['location'][indr], 
-                                         dffcol['timestamp'][indc], dffrow['timestamp'][indr], 
-                                         dffcol['tot_us'][indc], dffrow['tot_us'][indr],
-                                        (dffcol['tot_us'][indc] + dffrow['tot_us'][indr])/2])
+        # Select good decodings, in exclusively mode drop events with any bad decoding
+        dff, excluded = select_hits(df, args.exclusively)
+        n_evt_excluded += len(excluded)
+        n_evt_used += dff['readout'].nunique()
+
+        # Match col and row to find hit pixel
+        # Matching conditions: timestamp and time-over-threshold (ToT)
+        pairs.append(match_pixels(dff, args.timestampdiff, args.totdiff))
+        maps.add_pixels(pairs[-1])
         print("... Matching is done!")
     ######################################################################################################
 
@@ -130,32 +83,16 @@ def main(args):
 
     ##### Create hit pixel dataframes #######################################################
     # Hit pixel information for all events
-    dffpair = pd.DataFrame(pair, columns=['col', 'row', 
-                                          'timestamp_col', 'timestamp_row', 
-                                          'tot_us_col', 'tot_us_row', 'avg_tot_us'])
+    dffpair = pd.concat(pairs, ignore_index=True) if pairs else pd.DataFrame(columns=PIXEL_COLUMNS)
     # Create dataframe for number of hits 
-    dfpair = dffpair[['col','row']].copy()
-    dfpairc = dfpair[['col','row']].value_counts().reset_index(name='hits')
+    dfpairc = maps.frame()[['col', 'row', 'hits']]
     # How many hits are collected and shown in a plot
     nhits = dfpairc['hits'].sum()
     
     # Create dataframe for number of hits per 5 by 5 pixels grid
-    i = 0
     n_group = 5
-    center = round(n_group/2)
-    npixels = 0
-    paircsmooth = []
-    while i < 35:
-        j = 0
-        while j < 35:
-            df_or = dfpairc[((dfpairc['col'] >= i) & (dfpairc['col'] < i+5)) & 
-                            ((dfpairc['row'] >= j) & (dfpairc['row'] < j+5))]
-            paircsmooth.append([i+center, j+center, df_or['hits'].sum()/df_or.shape[0]])
-            npixels += df_or.shape[0]
-            j += n_group
-        i += n_group
-    dfpaircsmooth =pd.DataFrame(paircsmooth, columns=['col', 'row', 'hits'])
-    npixel = '%.2f' % ((npixels/1225) * 100.)
+    dfpaircsmooth = maps.block_frame(maps.hits, n_group).rename(columns={'value': 'hits'})
+    npixel = '%.2f' % ((maps.hit_pixels/maps.hits.size) * 100.)
 
     # Create masking map for pixels
     # Path to noise scan data location
@@ -169,45 +106,21 @@ def main(args):
     dfnoise['Masking'] = 0
     dfnoise['Masking'] = np.where(dfnoise['Count'] > args.noisethreshold, 1, dfnoise['Masking']) 
     # Calculate how many pixels are good
-    npixels = '%.2f' % ((dfnoise['Masking'].value_counts()[0]/1225.) * 100.)
+    npixels = '%.2f' % ((dfnoise['Masking'].value_counts()[0]/maps.hits.size) * 100.)
 
     # Create dataframe for normalized time-over-threshold per pixel
-    i = 0
-    pixel = []
-    while i < 35:
-        j = 0
-        while j < 35:
-            df_and = dffpair[((dffpair['col'] == i) & (dffpair['row'] == j))]    
-            if df_and.empty:
-                j += 1
-                continue
-            else:
-                pixel.append([i, j, 
-                              df_and['avg_tot_us'].sum()/df_and.shape[0]])
-                j += 1
-        i += 1
-    dfpixel = pd.DataFrame(pixel, columns=['col', 'row', 'norm_sum_avg_tot_us'])
+    dfpixel = maps.frame()[['col', 'row', 'mean_tot']].rename(columns={'mean_tot': 'norm_sum_avg_tot_us'})
     # Create dataframe for normalized time-over-threshold per 5 by 5 pixels grid
-    i = 0
-    n_group = 5
-    center = round(n_group/2)
-    pixelsmooth = []
-    while i < 35:
-        j = 0
-        while j < 35:
-            df_or = dfpixel[((dfpixel['col'] >= i) & (dfpixel['col'] < i+5)) & 
-                            ((dfpixel['row'] >= j) & (dfpixel['row'] < j+5))]
-            pixelsmooth.append([i+center, j+center, 
-                                df_or['norm_sum_avg_tot_us'].sum()/df_or.shape[0]])
-            j += n_group
-        i += n_group
-    
-    dfpixelsmooth = pd.DataFrame(pixelsmooth, columns=['col', 'row', 'norm_sum_avg_tot_us'])
+    dfpixelsmooth = maps.block_frame(maps.mean_tot, n_group).rename(columns={'value': 'norm_sum_avg_tot_us'})
     #########################################################################################
 
     # Print run number(s)
     runnum = '-'.join(args.runnolist)
     
+    # One bin per pixel
+    bins = [maps.num_cols, maps.num_rows]
+    hist_range = [[-0.5, maps.num_cols - 0.5], [-0.5, maps.num_rows - 0.5]]
+
     # Generate Plot - Pixel hits
     #fig, (ax1, ax2) = plt.subplots(ncols=2, figsize=(20, 8))
     row = 2
@@ -218,29 +131,29 @@ def main(args):
             for axis in ['top','bottom','left','right']:
                 ax[irow, icol].spines[axis].set_linewidth(1.5)
 
-    p1 = ax[0, 0].hist2d(x=dfpairc['col'], y=dfpairc['row'], bins=35, range=[[-0.5,34.5],[-0.5,34.5]], weights=dfpairc['hits'], cmap='Reds', cmin=1.0, norm=matplotlib.colors.LogNorm())
+    p1 = ax[0, 0].hist2d(x=dfpairc['col'], y=dfpairc['row'], bins=bins, range=hist_range, weights=dfpairc['hits'], cmap='Reds', cmin=1.0, norm=matplotlib.colors.LogNorm())
     fig.colorbar(p1[3], ax=ax[0, 0]).set_label(label='Hits', weight='bold', size=18)
     ax[0, 0].set_xlabel('Col', fontweight = 'bold', fontsize=18)
     ax[0, 0].set_ylabel('Row', fontweight = 'bold', fontsize=18)
     ax[0, 0].xaxis.set_tick_params(labelsize = 18)
     ax[0, 0].yaxis.set_tick_params(labelsize = 18)
 
-    p2 = ax[0, 1].hist2d(x=dfnoise['Col'],y=dfnoise['Row'],bins=35,range=[[-0.5,34.5],[-0.5,34.5]], weights=dfnoise['Masking'], cmap='Greys')
+    p2 = ax[0, 1].hist2d(x=dfnoise['Col'],y=dfnoise['Row'],bins=bins, range=hist_range, weights=dfnoise['Masking'], cmap='Greys')
     fig.colorbar(p2[3], ax=ax[0, 1]).set_label(label='Masking', weight='bold', size=18)
     ax[0, 1].set_xlabel('Col', fontweight = 'bold', fontsize=18)
     ax[0, 1].set_ylabel('Row', fontweight = 'bold', fontsize=18)
     ax[0, 1].xaxis.set_tick_params(labelsize = 18)
     ax[0, 1].yaxis.set_tick_params(labelsize = 18)
 
-    p6 = ax[0, 2].hist2d(x=dfpairc['col'], y=dfpairc['row'], bins=35, range=[[-0.5,34.5],[-0.5,34.5]], weights=dfpairc['hits'], cmap='Reds', cmin=1.0, norm=matplotlib.colors.LogNorm(), alpha=1.0)
-    ax[0, 2].hist2d(x=dfnoise['Col'],y=dfnoise['Row'],bins=35,range=[[-0.5,34.5],[-0.5,34.5]], weights=dfnoise['Masking'], cmap='binary', alpha=0.25)
+    p6 = ax[0, 2].hist2d(x=dfpairc['col'], y=dfpairc['row'], bins=bins, range=hist_range, weights=dfpairc['hits'], cmap='Reds', cmin=1.0, norm=matplotlib.colors.LogNorm(), alpha=1.0)
+    ax[0, 2].hist2d(x=dfnoise['Col'],y=dfnoise['Row'],bins=bins, range=hist_range, weights=dfnoise['Masking'], cmap='binary', alpha=0.25)
     fig.colorbar(p6[3], ax=ax[0, 2]).set_label(label='Hits', weight='bold', size=18)
     ax[0, 2].set_xlabel('Col', fontweight = 'bold', fontsize=18)
     ax[0, 2].set_ylabel('Row', fontweight = 'bold', fontsize=18)
     ax[0, 2].xaxis.set_tick_params(labelsize = 18)
     ax[0, 2].yaxis.set_tick_params(labelsize = 18)
 
-    p3 = ax[1, 0].hist2d(x=dfpixel['col'], y=dfpixel['row'], bins=35, range=[[-0.5,34.5],[-0.5,34.5]], weights=dfpixel['norm_sum_avg_tot_us'], cmap='Blues',cmin=1.0, norm=matplotlib.colors.LogNorm())
+    p3 = ax[1, 0].hist2d(x=dfpixel['col'], y=dfpixel['row'], bins=bins, range=hist_range, weights=dfpixel['norm_sum_avg_tot_us'], cmap='Blues',cmin=1.0, norm=matplotlib.colors.LogNorm())
     fig.colorbar(p3[3], ax=ax[1, 0]).set_label(label='\u03A3 Normalized Time-over-Threshold [us]', weight='bold', size=18)
     ax[1, 0].set_xlabel('Col', fontweight = 'bold', fontsize=18)
     ax[1, 0].set_ylabel('Row', fontweight = 'bold', fontsize=18)
@@ -293,6 +206,9 @@ if __name__ == "__main__":
     parser.add_argument('-n', '--name', default='chip_v3_APS3-W2-S03', required=True,
                     help='chip ID that can be used in name of output file ex) chip230103 or APCv2-230202')
 
+    parser.add_argument('-y', '--yaml', action='store', required=False, type=str, default = 'testconfig_v3',
+                    help = 'filepath (in config/ directory) .yml file containing chip configuration, used for the matrix size. Default: config/testconfig_v3.yml')
+
     parser.add_argument('-l','--runnolist', nargs='+', required=True,
                     help = 'List run number(s) you would like to see')
 
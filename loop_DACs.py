@@ -17,6 +17,8 @@ import time
 import logging
 import argparse
 
+from modules.hitsink import HitSink
+from modules.rawdata import RawDataWriter, RAW_EXTENSION
 from modules.setup_logger import logger
 
 
@@ -92,31 +94,15 @@ def main(args,dac):
     # Prepares the file paths 
     if args.saveascsv: # Here for csv
         csvpath = args.outdir +'/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-        csvframe =pd.DataFrame(columns = [
-                'readout',
-                'Chip ID',
-                'payload',
-                'location',
-                'isCol',
-                'timestamp',
-                'tot_msb',
-                'tot_lsb',
-                'tot_total',
-                'tot_us',
-                'hittime'
-        ])
+        csvframe = HitSink(csvpath)
 
     # Save final configuration to output file    
     ymlpathout=args.outdir+pathdelim+args.yaml+"_"+time.strftime("%Y%m%d-%H%M%S")+".yml"
     astro.write_conf_to_yaml(ymlpathout)
-    # And here for the text files/logs
-    bitpath = args.outdir + '/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
-    # textfiles are always saved so we open it up 
-    bitfile = open(bitpath,'w')
-    # Writes all the config information to the file
-    bitfile.write(astro.get_log_header())
-    bitfile.write(str(args))
-    bitfile.write("\n")
+    # Prepare raw data file
+    bitpath = args.outdir + '/' + fname + time.strftime("%Y%m%d-%H%M%S") + RAW_EXTENSION
+    # Raw data files are always saved, the header holds all the config information
+    bitfile = RawDataWriter(bitpath, astro.get_raw_header(args))
 
     try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly
         
@@ -135,8 +121,8 @@ def main(args,dac):
 
                 readout = astro.get_readout(3) # Gets the bytearray from the chip
 
-                # Writes the hex version to hits
-                bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
+                # Writes the raw readout
+                bitfile.write(i, readout)
                 print(binascii.hexlify(readout))
 
                 # Added fault tolerance for decoding, the limits of which are set through arguments
@@ -154,7 +140,7 @@ def main(args,dac):
 
                     # If we are saving a csv this will write it out. 
                     if args.saveascsv:
-                        csvframe = pd.concat([csvframe, hits])
+                        csvframe.append(hits)
 
             # If no hits are present this waits for some to accumulate
             else: time.sleep(.001)
@@ -168,8 +154,7 @@ def main(args,dac):
         logger.exception(f"Encountered Unexpected Exception! \n{e}")
     finally:
         if args.saveascsv: 
-            csvframe.index.name = "dec_order"
-            csvframe.to_csv(csvpath) 
+            csvframe.close()
         if args.inject: astro.stop_injection()   
         bitfile.close() # Close open file       
         astro.close_connection() # Closes SPI
@@ -0,0 +1,231 @@
+"""
+Per-pixel hit maps
+
+PixelMaps accumulates hit counts and ToT sums per pixel with np.bincount, runs can be
+added one by one as they arrive and maps of several campaigns can be merged or saved.
+Block binning (e.g. 5x5 pixels) is done by reshaping the maps, the matrix size is
+taken from the chip config YAML.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+import yaml
+
+from modules.setup_logger import logger
+
+logger = logging.getLogger(__name__)
+
+
+def read_geometry(filename: str, chipname: str = 'astropix', chipversion: int = 3) -> tuple:
+    """
+    Read matrix size from chip config
+
+    :param filename: Chip config YAML, e.g. config/testconfig_v3.yml
+    :param chipname: Chip name
+    :param chipversion: Chip version
+
+    :returns: Number of columns, number of rows
+    """
+
+    with open(filename, 'r') as stream:
+        dict_from_yml = yaml.safe_load(stream)
+
+    geometry = dict_from_yml[f'{chipname}{chipversion}']['geometry']
+
+    return geometry['cols'], geometry['rows']
+
+
+class PixelMaps:
+    """Hit count and ToT sum per pixel, indexed [col, row]"""
+
+    def __init__(self, num_cols: int = 35, num_rows: int = 35) -> None:
+        """
+        :param num_cols: Number of columns
+        :param num_rows: Number of rows
+        """
+
+        self.num_cols = num_cols
+        self.num_rows = num_rows
+
+        self.hits = np.zeros((num_cols, num_rows), dtype=np.int64)
+        self.tot_sum = np.zeros((num_cols, num_rows), dtype=np.float64)
+
+    @classmethod
+    def from_yaml(cls, filename: str, chipname: str = 'astropix', chipversion: int = 3) -> 'PixelMaps':
+        """
+        Create empty maps with the matrix size of a chip config
+
+        :param filename: Chip config YAML
+        :param chipname: Chip name
+        :param chipversion: Chip version
+
+        :returns: PixelMaps
+        """
+
+        return cls(*read_geometry(filename, chipname, chipversion))
+
+    def add(self, cols, rows, tot=None) -> None:
+        """
+        Add pixel hits
+
+        :param cols: Array of columns
+        :param rows: Array of rows
+        :param tot: Array of ToT per hit, e.g. avg_tot_us of modules.clustering.match_pixels
+        """
+
+        cols = np.asarray(cols, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+
+        valid = (cols >= 0) & (cols < self.num_cols) & (rows >= 0) & (rows < self.num_rows)
+
+        if not np.all(valid):
+            logger.warning("Ignored %d hits outside of %dx%d matrix", np.size(valid) - np.count_nonzero(valid),
+                           self.num_cols, self.num_rows)
+
+        index = cols[valid] * self.num_rows + rows[valid]
+        size = self.num_cols * self.num_rows
+
+        self.hits += np.bincount(index, minlength=size).reshape(self.hits.shape)
+
+        if tot is not None:
+            tot = np.asarray(tot, dtype=np.float64)[valid]
+            self.tot_sum += np.bincount(index, weights=tot, minlength=size).reshape(self.tot_sum.shape)
+
+    def add_pixels(self, pixels: pd.DataFrame) -> None:
+        """
+        Add pixel hit table of modules.clustering.match_pixels
+
+        :param pixels: Dataframe with columns col, row, avg_tot_us
+        """
+
+        self.add(pixels['col'].to_numpy(), pixels['row'].to_numpy(), pixels['avg_tot_us'].to_numpy())
+
+    def merge(self, other: 'PixelMaps') -> None:
+        """
+        Add maps of another run
+
+        :param other: PixelMaps with the same geometry
+        """
+
+        if (other.num_cols, other.num_rows) != (self.num_cols, self.num_rows):
+            raise ValueError("Pixel maps do not have the same geometry")
+
+        self.hits += other.hits
+        self.tot_sum += other.tot_sum
+
+    @property
+    def mean_tot(self) -> np.ndarray:
+        """Mean ToT per pixel, NaN for pixels without hits"""
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.tot_sum / self.hits
+
+    @property
+    def hit_pixels(self) -> int:
+        """Number of pixels with hits"""
+
+        return int(np.count_nonzero(self.hits))
+
+    def block_sum(self, values: np.ndarray, n: int = 5) -> np.ndarray:
+        """
+        Sum of values over blocks of n x n pixels
+
+        The matrix is padded with zeros if its size is no multiple of n.
+
+        :param values: Array with shape (num_cols, num_rows)
+        :param n: Block size in pixels
+
+        :returns: Array with shape (ceil(num_cols/n), ceil(num_rows/n))
+        """
+
+        cols = -(-self.num_cols // n)
+        rows = -(-self.num_rows // n)
+
+        padded = np.zeros((cols * n, rows * n), dtype=np.asarray(values).dtype)
+        padded[:self.num_cols, :self.num_rows] = values
+
+        return padded.reshape(cols, n, rows, n).sum(axis=(1, 3))
+
+    def block_mean(self, values: np.ndarray, n: int = 5) -> np.ndarray:
+        """
+        Mean of values over the pixels with hits in blocks of n x n pixels
+
+        :param values: Array with shape (num_cols, num_rows)
+        :param n: Block size in pixels
+
+        :returns: Array with one value per block, NaN for blocks without hits
+        """
+
+        hit = self.hits > 0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return self.block_sum(np.where(hit, values, 0), n) / self.block_sum(hit.astype(np.int64), n)
+
+    def block_centers(self, n: int = 5) -> tuple:
+        """
+        Center pixel of blocks of n x n pixels
+
+        :param n: Block size in pixels
+
+        :returns: Arrays of center columns and rows, with the shape of block_sum
+        """
+
+        centers = lambda size: np.arange(0, size, n) + round(n / 2)
+
+        return np.meshgrid(centers(self.num_cols), centers(self.num_rows), indexing='ij')
+
+    def frame(self) -> pd.DataFrame:
+        """
+        Returns pixels with hits as dataframe with columns col, row, hits, mean_tot
+        """
+
+        cols, rows = np.nonzero(self.hits)
+
+        return pd.DataFrame({
+            'col': cols,
+            'row': rows,
+            'hits': self.hits[cols, rows],
+            'mean_tot': self.tot_sum[cols, rows] / self.hits[cols, rows],
+        })
+
+    def block_frame(self, values: np.ndarray, n: int = 5) -> pd.DataFrame:
+        """
+        Returns block means as dataframe with columns col, row, value
+
+        :param values: Array with shape (num_cols, num_rows)
+        :param n: Block size in pixels
+        """
+
+        cols, rows = self.block_centers(n)
+
+        return pd.DataFrame({'col': cols.ravel(), 'row': rows.ravel(), 'value': self.block_mean(values, n).ravel()})
+
+    def save(self, filename: str) -> None:
+        """
+        Save maps, e.g. to add runs of a campaign later
+
+        :param filename: Output .npz file
+        """
+
+        np.savez(filename, hits=self.hits, tot_sum=self.tot_sum)
+
+    @classmethod
+    def load(cls, filename: str) -> 'PixelMaps':
+        """
+        Load maps saved with save
+
+        :param filename: Input .npz file
+
+        :returns: PixelMaps
+        """
+
+        with np.load(filename) as data:
+            maps = cls(*data['hits'].shape)
+            maps.hits[:] = data['hits']
+            maps.tot_sum[:] = data['tot_sum']
+
+        return maps
+
+    def __repr__(self) -> str:
+        return f"PixelMaps({self.num_cols}x{self.num_rows}, {self.hits.sum()} hits in {self.hit_pixels} pixels)"
@@ -0,0 +1,450 @@
+"""
+Per-pixel calibration from injection scans
+
+The hit counts of all pixels at all injection voltages are fitted at once: error function
+S-curves with a batched Levenberg-Marquardt fit (threshold = 50% point, noise = width) and
+a straight line of the mean ToT against the injection voltage by weighted least squares.
+Both work on arrays with one row per pixel, there is no loop over pixels.
+
+The results are stored as a structured array with CALIBRATION_DTYPE, indexed [col, row],
+in a .npy file that can be memory-mapped. Voltages are injection voltages in mV, ToT in us.
+Calibration applies the array to decoded hits, online in astropix3 and offline in the
+post-run decoding.
+"""
+import logging
+import re
+import warnings
+
+import numpy as np
+
+from modules.aggregation import PixelMaps
+from modules.setup_logger import logger
+
+# Calibration per pixel, indexed [col, row]
+CALIBRATION_DTYPE = np.dtype([
+    ('threshold', np.float32),      # 50% point of the S-curve in mV
+    ('noise', np.float32),          # Width of the S-curve in mV
+    ('chi2', np.float32),           # S-curve chi2 per degree of freedom, steps on the rise only
+    ('tot_slope', np.float32),      # ToT per injection voltage in us/mV
+    ('tot_offset', np.float32),     # ToT at 0 mV in us
+    ('valid', np.bool_),            # S-curve and ToT fit converged
+])
+
+# Columns appended to decoded hits, energy_kev only with a conversion factor
+CALIBRATED_COLUMNS = ['charge_mv', 'energy_kev']
+
+# Injection voltage in the file names of injectionScan.py, e.g. run_300mVinj_20230220-012049.csv
+INJECTION_PATTERN = re.compile(r'_(\d+(?:\.\d+)?)mVinj')
+
+logger = logging.getLogger(__name__)
+
+# Calibrations of this process, see get_calibration
+_calibrations = {}
+
+
+def erf(x) -> np.ndarray:
+    """
+    Error function, Abramowitz and Stegun 7.1.26, absolute error below 1.5e-7
+
+    :param x: Array
+
+    :returns: erf(x)
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    t = 1. / (1. + 0.3275911 * np.abs(x))
+    poly = t * (0.254829592 + t * (-0.284496736 + t * (1.421413741 + t * (-1.453152027 + t * 1.061405429))))
+
+    return np.sign(x) * (1. - poly * np.exp(-x * x))
+
+
+def scurve(x, threshold, noise) -> np.ndarray:
+    """
+    Efficiency of a pixel with Gaussian noise
+
+    :param x: Injection voltages
+    :param threshold: 50% point
+    :param noise: Width
+
+    :returns: Efficiency between 0 and 1
+    """
+
+    return 0.5 * (1. + erf((np.asarray(x) - threshold) / (np.sqrt(2.) * noise)))
+
+
+def scurve_start(x: np.ndarray, efficiency: np.ndarray) -> tuple:
+    """
+    Start values from the 16%, 50% and 84% crossings of the measured efficiency
+
+    :param x: Injection voltages, ascending, shape (steps,)
+    :param efficiency: Efficiency per pixel, shape (pixels, steps)
+
+    :returns: Arrays of threshold and noise start values
+    """
+
+    def crossing(level):
+        above = np.nan_to_num(efficiency, nan=0.) >= level
+        k = np.argmax(above, axis=1)
+        k0 = np.maximum(k - 1, 0)
+
+        y0 = np.take_along_axis(efficiency, k0[:, None], axis=1)[:, 0]
+        y1 = np.take_along_axis(efficiency, k[:, None], axis=1)[:, 0]
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            frac = np.where(y1 > y0, (level - y0) / (y1 - y0), 0.)
+
+        return np.where(k > 0, x[k0] + np.clip(frac, 0., 1.) * (x[k] - x[k0]), x[0])
+
+    step = np.min(np.diff(x)) if len(x) > 1 else 1.
+
+    threshold = crossing(0.5)
+    noise = np.maximum((crossing(0.84) - crossing(0.16)) / 2., step / 2.)
+
+    return threshold, noise
+
+
+def fit_scurves(x, counts, ninjections=None, iterations: int = 100) -> tuple:
+    """
+    Fit S-curves of all pixels at once
+
+    :param x: Injection voltages in mV, shape (steps,)
+    :param counts: Hits per pixel and step, shape (..., steps)
+    :param ninjections: Injections per step, scalar or broadcastable to counts.
+                        None normalizes every pixel to its highest count
+    :param iterations: Levenberg-Marquardt iterations
+
+    :returns: Arrays of threshold, noise and chi2 per degree of freedom with the shape of counts
+              without the last axis, NaN for pixels without hits. The degrees of freedom are the
+              steps on the rise of the S-curve, not the saturated steps at 0% and 100%
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    counts = np.asarray(counts, dtype=np.float64)
+    shape = counts.shape[:-1]
+
+    order = np.argsort(x)
+    x = x[order]
+    counts = counts.reshape(-1, len(x))[:, order]
+
+    if ninjections is None:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            n = np.broadcast_to(counts.max(axis=1, keepdims=True), counts.shape)
+    else:
+        n = np.broadcast_to(np.asarray(ninjections, dtype=np.float64), shape + (len(x),)).reshape(-1, len(x))[:, order]
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        efficiency = np.clip(counts / n, 0., 1.)
+
+    # Steps without injections or measurements do not enter the fit
+    measured = np.isfinite(efficiency) & (n > 0)
+    efficiency = np.where(measured, efficiency, 0.)
+
+    valid = measured.any(axis=1) & (np.where(measured, counts, 0.).sum(axis=1) > 0)
+
+    threshold, noise = scurve_start(x, np.where(measured, efficiency, np.nan))
+    damping = np.full(len(threshold), 1e-3)
+
+    def residuals(threshold, noise):
+        return np.where(measured, efficiency - scurve(x, threshold[:, None], noise[:, None]), 0.)
+
+    cost = (residuals(threshold, noise) ** 2).sum(axis=1)
+
+    for _ in range(iterations):
+        t = (x - threshold[:, None]) / noise[:, None]
+        gauss = np.where(measured, np.exp(-0.5 * t * t) / (np.sqrt(2. * np.pi) * noise[:, None]), 0.)
+
+        # Derivatives of the S-curve by threshold and noise
+        jthr = -gauss
+        jnoise = -gauss * t
+        r = residuals(threshold, noise)
+
+        a11 = (jthr * jthr).sum(axis=1)
+        a12 = (jthr * jnoise).sum(axis=1)
+        a22 = (jnoise * jnoise).sum(axis=1)
+        b1 = (jthr * r).sum(axis=1)
+        b2 = (jnoise * r).sum(axis=1)
+
+        # Damped 2x2 normal equations, solved for all pixels at once
+        d11 = a11 * (1. + damping)
+        d22 = a22 * (1. + damping)
+        det = d11 * d22 - a12 * a12
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            dthr = np.where(det > 0, (d22 * b1 - a12 * b2) / det, 0.)
+            dnoise = np.where(det > 0, (d11 * b2 - a12 * b1) / det, 0.)
+
+        new_threshold = threshold + dthr
+        new_noise = np.maximum(noise + dnoise, 1e-6)
+        new_cost = (residuals(new_threshold, new_noise) ** 2).sum(axis=1)
+
+        better = new_cost < cost
+        threshold = np.where(better, new_threshold, threshold)
+        noise = np.where(better, new_noise, noise)
+        cost = np.where(better, new_cost, cost)
+        damping = np.where(better, damping / 10., damping * 10.)
+
+    # chi2 with binomial errors of the fitted efficiency. Steps where the model is saturated at 0% or 100%
+    # add (almost) nothing to the chi2, ndf counts the steps on the rise with a count variance above 0.1
+    model = scurve(x, threshold[:, None], noise[:, None])
+    variance = np.maximum(model * (1. - model), 1. / np.maximum(n, 1.) ** 2) / np.maximum(n, 1.)
+    informative = measured & (n * model * (1. - model) > 0.1)
+    ndf = np.maximum(informative.sum(axis=1) - 2, 1)
+    chi2 = np.where(measured, (efficiency - model) ** 2 / variance, 0.).sum(axis=1) / ndf
+
+    threshold = np.where(valid, threshold, np.nan)
+    noise = np.where(valid, noise, np.nan)
+    chi2 = np.where(valid, chi2, np.nan)
+
+    return threshold.reshape(shape), noise.reshape(shape), chi2.reshape(shape)
+
+
+def fit_lines(x, y, weights=None) -> tuple:
+    """
+    Weighted straight line fits of all pixels at once, NaN values are skipped
+
+    :param x: Injection voltages, shape (steps,)
+    :param y: Values per pixel and step, shape (..., steps), e.g. mean ToT
+    :param weights: Weights with the shape of y, e.g. hits per step, default 1
+
+    :returns: Arrays of slope and offset, NaN for pixels with less than two points
+    """
+
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+
+    w = np.ones_like(y) if weights is None else np.asarray(weights, dtype=np.float64) * np.ones_like(y)
+    w = np.where(np.isfinite(y) & (w > 0), w, 0.)
+    y = np.where(w > 0, y, 0.)
+
+    sw = w.sum(axis=-1)
+    sx = (w * x).sum(axis=-1)
+    sy = (w * y).sum(axis=-1)
+    sxx = (w * x * x).sum(axis=-1)
+    sxy = (w * x * y).sum(axis=-1)
+
+    denominator = sw * sxx - sx * sx
+    enough = (np.count_nonzero(w, axis=-1) >= 2) & (denominator > 0)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        slope = np.where(enough, (sw * sxy - sx * sy) / denominator, np.nan)
+        offset = np.where(enough, (sy - slope * sx) / sw, np.nan)
+
+    return slope, offset
+
+
+def injection_tables(steps: list, num_cols: int = 35, num_rows: int = 35) -> tuple:
+    """
+    Hit count and mean ToT per pixel and injection step
+
+    :param steps: Pixel hit tables of modules.clustering.match_pixels, one per injection voltage
+    :param num_cols: Number of columns
+    :param num_rows: Number of rows
+
+    :returns: Arrays of hits and mean ToT in us, shape (num_cols, num_rows, steps)
+    """
+
+    counts = np.zeros((num_cols, num_rows, len(steps)), dtype=np.int64)
+    mean_tot = np.full((num_cols, num_rows, len(steps)), np.nan)
+
+    for k, pixels in enumerate(steps):
+        maps = PixelMaps(num_cols, num_rows)
+        maps.add_pixels(pixels)
+
+        counts[:, :, k] = maps.hits
+        mean_tot[:, :, k] = maps.mean_tot
+
+    return counts, mean_tot
+
+
+def calibrate(x, counts, mean_tot, ninjections=None, iterations: int = 100) -> np.ndarray:
+    """
+    Fit S-curves and ToT lines and fill the calibration array
+
+    :param x: Injection voltages in mV, shape (steps,)
+    :param counts: Hits per pixel and step, shape (num_cols, num_rows, steps)
+    :param mean_tot: Mean ToT in us per pixel and step, same shape
+    :param ninjections: Injections per step, see fit_scurves
+    :param iterations: Levenberg-Marquardt iterations
+
+    :returns: Array with CALIBRATION_DTYPE, shape (num_cols, num_rows)
+    """
+
+    threshold, noise, chi2 = fit_scurves(x, counts, ninjections, iterations)
+    slope, offset = fit_lines(x, mean_tot, counts)
+
+    calibration = np.zeros(counts.shape[:-1], dtype=CALIBRATION_DTYPE)
+    calibration['threshold'] = threshold
+    calibration['noise'] = noise
+    calibration['chi2'] = chi2
+    calibration['tot_slope'] = slope
+    calibration['tot_offset'] = offset
+    calibration['valid'] = np.isfinite(threshold) & np.isfinite(slope) & (slope > 0)
+
+    logger.info("Calibrated %d of %d pixels", np.count_nonzero(calibration['valid']), calibration.size)
+
+    return calibration
+
+
+def injection_voltage(filename: str) -> float:
+    """
+    Injection voltage from a file name of injectionScan.py
+
+    :param filename: File name containing _<voltage>mVinj
+
+    :returns: Injection voltage in mV, None if the name has no voltage
+    """
+
+    match = INJECTION_PATTERN.search(filename)
+
+    return float(match.group(1)) if match else None
+
+
+def save_calibration(filename: str, calibration: np.ndarray) -> None:
+    """
+    Save calibration array
+
+    :param filename: Output .npy file
+    :param calibration: Array with CALIBRATION_DTYPE
+    """
+
+    np.save(filename, np.asarray(calibration, dtype=CALIBRATION_DTYPE))
+
+
+def load_calibration(filename: str, mmap: bool = True) -> np.ndarray:
+    """
+    Load calibration array
+
+    :param filename: .npy file of save_calibration
+    :param mmap: Memory-map the file read-only instead of reading it
+
+    :returns: Array with CALIBRATION_DTYPE, indexed [col, row]
+    """
+
+    calibration = np.load(filename, mmap_mode='r' if mmap else None)
+
+    if calibration.dtype != CALIBRATION_DTYPE:
+        raise ValueError(f"{filename} is no calibration array")
+
+    return calibration
+
+
+class Calibration:
+    """
+    Calibration stage for decoded hits
+
+    Appends the charge as equivalent injection voltage in mV, and the energy in keV if a
+    conversion factor is given. Row and column hits of decode_readout are single strips,
+    they are calibrated with the mean calibration of the valid pixels of their strip.
+    Matched pixel hits of modules.clustering.match_pixels use their own pixel.
+    """
+
+    def __init__(self, calibration: np.ndarray, kev_per_mv: float = None) -> None:
+        """
+        :param calibration: Array with CALIBRATION_DTYPE, e.g. from load_calibration
+        :param kev_per_mv: Energy per mV injection voltage, None adds no energy column
+        """
+
+        self.calibration = calibration
+        self.kev_per_mv = kev_per_mv
+
+        self.num_cols, self.num_rows = calibration.shape
+
+        # Per-pixel lookup, invalid pixels give NaN
+        valid = np.asarray(calibration['valid'])
+        self.slope = np.where(valid, calibration['tot_slope'], np.nan)
+        self.offset = np.where(valid, calibration['tot_offset'], np.nan)
+
+        # Strip means over the valid pixels, indexed by location. Locations beyond the
+        # matrix give NaN
+        with np.errstate(invalid='ignore'), warnings.catch_warnings():
+            warnings.simplefilter('ignore', RuntimeWarning)
+            self.strip_slope = np.full((2, 64), np.nan)
+            self.strip_offset = np.full((2, 64), np.nan)
+            self.strip_slope[0, :self.num_rows] = np.nanmean(self.slope, axis=0)
+            self.strip_offset[0, :self.num_rows] = np.nanmean(self.offset, axis=0)
+            self.strip_slope[1, :self.num_cols] = np.nanmean(self.slope, axis=1)
+            self.strip_offset[1, :self.num_cols] = np.nanmean(self.offset, axis=1)
+
+    @property
+    def columns(self) -> list:
+        """Columns appended to decoded hits"""
+
+        return CALIBRATED_COLUMNS if self.kev_per_mv is not None else CALIBRATED_COLUMNS[:1]
+
+    @classmethod
+    def from_file(cls, filename: str, kev_per_mv: float = None) -> 'Calibration':
+        """
+        Load calibration array memory-mapped
+
+        :param filename: .npy file of save_calibration
+        :param kev_per_mv: Energy per mV injection voltage
+
+        :returns: Calibration
+        """
+
+        return cls(load_calibration(filename, mmap=True), kev_per_mv)
+
+    def __append(self, frame, tot, slope, offset):
+        with np.errstate(invalid='ignore', divide='ignore'):
+            charge = (tot - offset) / slope
+
+        frame['charge_mv'] = charge
+        if self.kev_per_mv is not None:
+            frame['energy_kev'] = charge * self.kev_per_mv
+
+        return frame
+
+    def apply(self, hits):
+        """
+        Append charge_mv (and energy_kev) to decoded row and column hits
+
+        :param hits: Dataframe of decode_readout, columns isCol, location, tot_us
+
+        :returns: The same dataframe with the new columns
+        """
+
+        iscol = hits['isCol'].to_numpy().astype(np.int64)
+        location = hits['location'].to_numpy().astype(np.int64) & 0b111111
+
+        return self.__append(hits, hits['tot_us'].to_numpy(), self.strip_slope[iscol, location],
+                             self.strip_offset[iscol, location])
+
+    def apply_pixels(self, pixels):
+        """
+        Append charge_mv (and energy_kev) to matched pixel hits
+
+        :param pixels: Dataframe of modules.clustering.match_pixels, columns col, row, avg_tot_us
+
+        :returns: The same dataframe with the new columns
+        """
+
+        cols = pixels['col'].to_numpy().astype(np.int64)
+        rows = pixels['row'].to_numpy().astype(np.int64)
+
+        inside = (cols >= 0) & (cols < self.num_cols) & (rows >= 0) & (rows < self.num_rows)
+        cols, rows = np.where(inside, cols, 0), np.where(inside, rows, 0)
+
+        return self.__append(pixels, pixels['avg_tot_us'].to_numpy(),
+                             np.where(inside, self.slope[cols, rows], np.nan),
+                             np.where(inside, self.offset[cols, rows], np.nan))
+
+    def __repr__(self) -> str:
+        return f"Calibration({self.num_cols}x{self.num_rows}, {np.count_nonzero(np.isfinite(self.slope))} pixels)"
+
+
+def get_calibration(filename: str, kev_per_mv: float = None) -> Calibration:
+    """
+    Calibration of this process, loaded once per file
+
+    :param filename: .npy file of save_calibration
+    :param kev_per_mv: Energy per mV injection voltage
+
+    :returns: Calibration
+    """
+
+    key = (filename, kev_per_mv)
+
+    if key not in _calibrations:
+        _calibrations[key] = Calibration.from_file(filename, kev_per_mv)
+
+    return _calibrations[key]
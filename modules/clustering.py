@@ -0,0 +1,134 @@
+"""
+Row/column hit matching
+
+A pixel hit is a column hit and a row hit in the same readout with close timestamp and
+ToT. Hits are sorted once by readout and timestamp, the candidate rows of every column
+hit are found with a sorted window join (searchsorted) and all pairs are compared
+vectorized, without a Python loop over readouts or hits.
+"""
+import logging
+
+import numpy as np
+import pandas as pd
+
+from modules.setup_logger import logger
+
+# Columns of the pixel hit table
+PIXEL_COLUMNS = [
+    'readout',
+    'col',
+    'row',
+    'timestamp_col',
+    'timestamp_row',
+    'tot_us_col',
+    'tot_us_row',
+    'avg_tot_us'
+]
+
+logger = logging.getLogger(__name__)
+
+
+def read_hits(path: str) -> tuple:
+    """
+    Read decoded hits and drop lines of failed decodings
+
+    :param path: CSV file of decoded hits, from beam_test.py or decode_postRun.py
+
+    :returns: Dataframe with numeric hits, number of dropped lines
+    """
+
+    df = pd.read_csv(path)
+
+    # Lines of failed decodings have no readout number
+    n_nan = len(df) - df['readout'].count()
+
+    df = df.apply(pd.to_numeric, errors='coerce').dropna()
+    df['readout'] = df['readout'].astype(np.int64)
+
+    return df, n_nan
+
+
+def select_hits(hits: pd.DataFrame, exclusively: bool = False) -> tuple:
+    """
+    Select hits with good payload
+
+    :param hits: Dataframe with decoded hits
+    :param exclusively: Drop all hits of a readout that has any hit with bad payload
+
+    :returns: Dataframe with selected hits, array of excluded readouts
+    """
+
+    bad = hits['payload'].to_numpy() != 4
+
+    if not exclusively:
+        return hits[~bad], np.empty(0, dtype=np.int64)
+
+    excluded = np.unique(hits['readout'].to_numpy()[bad])
+
+    return hits[~np.isin(hits['readout'].to_numpy(), excluded)], excluded
+
+
+def match_pixels(hits: pd.DataFrame, timestampdiff: float = 0.5, totdiff: float = 1.0) -> pd.DataFrame:
+    """
+    Match column and row hits of the same readout to pixel hits
+
+    All pairs with |timestamp difference| < timestampdiff and |ToT difference| < totdiff
+    are returned, ordered by column hit and then row hit as in the input.
+
+    :param hits: Dataframe with decoded hits, columns readout, isCol, location, timestamp, tot_us
+    :param timestampdiff: Maximum timestamp difference
+    :param totdiff: Maximum ToT difference in us
+
+    :returns: Dataframe with PIXEL_COLUMNS, one line per pixel hit
+    """
+
+    iscol = hits['isCol'].to_numpy().astype(bool)
+
+    readout = hits['readout'].to_numpy().astype(np.int64)
+    location = hits['location'].to_numpy()
+    timestamp = hits['timestamp'].to_numpy().astype(np.float64)
+    tot_us = hits['tot_us'].to_numpy().astype(np.float64)
+
+    cols = np.flatnonzero(iscol)
+    rows = np.flatnonzero(~iscol)
+
+    if len(cols) == 0 or len(rows) == 0:
+        return pd.DataFrame({column: [] for column in PIXEL_COLUMNS})
+
+    # Rows sorted by readout and timestamp, a combined key keeps readouts apart
+    # as long as the timestamp window does not reach the next readout
+    span = np.ptp(timestamp) + 2 * timestampdiff + 1
+    rowkey = readout[rows] * span + (timestamp[rows] - timestamp.min())
+    order = np.argsort(rowkey, kind='stable')
+    rows, rowkey = rows[order], rowkey[order]
+
+    colkey = readout[cols] * span + (timestamp[cols] - timestamp.min())
+
+    # Window of candidate rows per column hit, strict inequality on both sides
+    lo = np.searchsorted(rowkey, colkey - timestampdiff, side='right')
+    hi = np.searchsorted(rowkey, colkey + timestampdiff, side='left')
+    counts = np.maximum(hi - lo, 0)
+
+    # Expand windows to all candidate pairs
+    colpair = np.repeat(cols, counts)
+    rowpair = rows[np.repeat(lo, counts) + np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)]
+
+    good = np.abs(tot_us[colpair] - tot_us[rowpair]) < totdiff
+    colpair, rowpair = colpair[good], rowpair[good]
+
+    # Order of the nested loop over column and row hits
+    order = np.lexsort((rowpair, colpair))
+    colpair, rowpair = colpair[order], rowpair[order]
+
+    logger.debug("Matched %d pixel hits from %d column and %d row hits", len(colpair), len(cols), len(rows))
+
+    return pd.DataFrame({
+        'readout': readout[colpair],
+        'col': location[colpair],
+        'row': location[rowpair],
+        'timestamp_col': timestamp[colpair],
+        'timestamp_row': timestamp[rowpair],
+        'tot_us_col': tot_us[colpair],
+        'tot_us_row': tot_us[rowpair],
+        'avg_tot_us': (tot_us[colpair] + tot_us[rowpair]) / 2,
+    })
@@ -0,0 +1,289 @@
+"""
+Offline event display rendering
+
+Renders the row/column strips of single events as HitPlotter does, but headless with
+the Agg backend and without the pyplot state machine. Every worker process keeps its
+figures and artists and only updates strip vertices, ticks and title per event. Events
+are split into tasks that are rendered in a process pool, as single PDFs per event,
+multi-page PDFs or PNG contact sheets.
+"""
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from tqdm import tqdm
+
+from modules.setup_logger import logger
+
+# Output modes
+RENDER_MODES = ['pdf', 'multipage', 'sheet']
+
+# Strip colors of HitPlotter
+EVENT_COLORS = ['green', 'orange', 'red']
+
+logger = logging.getLogger(__name__)
+
+# Figures of this worker process, reused for all tasks
+_figures = {}
+
+
+def event_colors(nrows, ncols) -> np.ndarray:
+    """
+    Classify events as HitPlotter
+
+    green: one row and one column, red: more than two rows or columns, orange otherwise
+
+    :param nrows: Array of number of row hits per event
+    :param ncols: Array of number of column hits per event
+
+    :returns: Array of color names
+    """
+
+    nrows = np.asarray(nrows)
+    ncols = np.asarray(ncols)
+
+    return np.where((nrows == 1) & (ncols == 1), 'green',
+                    np.where((nrows > 2) | (ncols > 2), 'red', 'orange'))
+
+
+def split_events(hits: pd.DataFrame, colors: list = ('orange', 'red'), maxevents: int = None) -> list:
+    """
+    Group decoded hits into events
+
+    :param hits: Dataframe with decoded hits, columns readout, isCol, location
+    :param colors: Event classes to keep, default the events HitPlotter saves
+    :param maxevents: Maximum number of events
+
+    :returns: List of (eventID, rows, cols, color) in readout order
+    """
+
+    readout = hits['readout'].to_numpy().astype(np.int64)
+    iscol = hits['isCol'].to_numpy().astype(bool)
+    location = hits['location'].to_numpy().astype(np.int64)
+
+    order = np.argsort(readout, kind='stable')
+    readout, iscol, location = readout[order], iscol[order], location[order]
+
+    events, starts = np.unique(readout, return_index=True)
+    ncols = np.add.reduceat(iscol.astype(np.int64), starts) if len(starts) else np.empty(0, dtype=np.int64)
+    nrows = np.diff(np.append(starts, len(readout))) - ncols
+    color = event_colors(nrows, ncols)
+
+    selected = np.flatnonzero(np.isin(color, colors))
+    if maxevents is not None:
+        selected = selected[:maxevents]
+
+    bounds = np.append(starts, len(readout))
+    result = []
+
+    for k in selected:
+        event = slice(bounds[k], bounds[k + 1])
+        result.append((int(events[k]), location[event][~iscol[event]], location[event][iscol[event]], str(color[k])))
+
+    return result
+
+
+class EventFigure:
+    """Agg figure with persistent artists for one or more event panels"""
+
+    def __init__(self, nPix=(35, 35), grid=(1, 1), d: float = 0.5, panelsize: float = 7.) -> None:
+        """
+        :param nPix: Number of rows and columns (int for square arrays or tuple), as HitPlotter
+        :param grid: Panels per figure, rows and columns
+        :param d: Width of bars for strip visualization
+        :param panelsize: Size of one panel in inches
+        """
+
+        from matplotlib.figure import Figure
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        from matplotlib.collections import PolyCollection
+
+        self.nPix = (nPix, nPix) if isinstance(nPix, int) else tuple(nPix)
+        self.d = d
+
+        self.figure = Figure(figsize=(panelsize * grid[1], panelsize * grid[0]))
+        FigureCanvasAgg(self.figure)
+
+        self.axes = self.figure.subplots(*grid, squeeze=False).ravel()
+        self.strips = []
+
+        for ax in self.axes:
+            ax.set_xlim(-1, self.nPix[1])
+            ax.set_ylim(-1, self.nPix[0])
+            ax.set_aspect('equal')
+            ax.set_xlabel("Column")
+            ax.set_ylabel("Row")
+
+            strips = PolyCollection([], alpha=0.4, edgecolor='none')
+            ax.add_collection(strips)
+            self.strips.append(strips)
+
+        self.figure.tight_layout()
+
+    def __verts(self, rows, cols) -> list:
+        d = self.d
+        top, right = self.nPix[0], self.nPix[1]
+
+        colverts = [((x - d, -1), (x + d, -1), (x + d, top), (x - d, top)) for x in cols]
+        rowverts = [((-1, y - d), (right, y - d), (right, y + d), (-1, y + d)) for y in rows]
+
+        return colverts + rowverts
+
+    def draw_event(self, panel: int, eventID, rows, cols, color: str) -> None:
+        """
+        Update one panel with an event
+
+        :param panel: Panel number
+        :param eventID: Event number (for title)
+        :param rows: Row hit locations
+        :param cols: Column hit locations
+        :param color: Strip color
+        """
+
+        ax = self.axes[panel]
+        size = "x-large" if color == 'green' else ("x-small" if color == 'red' else "small")
+
+        ax.set_visible(True)
+        self.strips[panel].set_verts(self.__verts(rows, cols))
+        self.strips[panel].set_facecolor(color)
+
+        ax.set_xticks(cols)
+        ax.set_xticklabels([str(x) for x in cols], weight='bold', color=color, size=size)
+        ax.set_yticks(rows)
+        ax.set_yticklabels([str(y) for y in rows], weight='bold', color=color, size=size)
+
+        ax.set_title(f"Event {eventID}, {len(rows)} + {len(cols)} hits")
+
+        # Ticks outside of the matrix would extend the axes
+        ax.set_xlim(-1, self.nPix[1])
+        ax.set_ylim(-1, self.nPix[0])
+
+    def clear(self, first: int = 0) -> None:
+        """
+        Hide panels, e.g. the unused panels of the last contact sheet
+
+        :param first: First panel to hide
+        """
+
+        for ax in self.axes[first:]:
+            ax.set_visible(False)
+
+
+def get_figure(nPix, grid) -> EventFigure:
+    """
+    Figure of this process, created once per geometry and grid
+
+    :param nPix: Number of rows and columns
+    :param grid: Panels per figure
+
+    :returns: EventFigure
+    """
+
+    key = (tuple(nPix) if not isinstance(nPix, int) else (nPix, nPix), tuple(grid))
+
+    if key not in _figures:
+        _figures[key] = EventFigure(key[0], key[1])
+
+    return _figures[key]
+
+
+def render_task(task: dict) -> int:
+    """
+    Render one task, runs in a worker process
+
+    :param task: Dict with events, mode, path, nPix and grid
+
+    :returns: Number of rendered events
+    """
+
+    mode = task['mode']
+    events = task['events']
+
+    if mode == 'pdf':
+        figure = get_figure(task['nPix'], (1, 1))
+
+        for eventID, rows, cols, color in events:
+            figure.draw_event(0, eventID, rows, cols, color)
+            figure.figure.savefig(os.path.join(task['path'], f"event_{eventID}.pdf"))
+
+    elif mode == 'multipage':
+        from matplotlib.backends.backend_pdf import PdfPages
+
+        figure = get_figure(task['nPix'], (1, 1))
+
+        with PdfPages(task['path']) as pdf:
+            for eventID, rows, cols, color in events:
+                figure.draw_event(0, eventID, rows, cols, color)
+                pdf.savefig(figure.figure)
+
+    elif mode == 'sheet':
+        figure = get_figure(task['nPix'], task['grid'])
+
+        for panel, (eventID, rows, cols, color) in enumerate(events):
+            figure.draw_event(panel, eventID, rows, cols, color)
+        figure.clear(len(events))
+
+        figure.figure.savefig(task['path'], dpi=task.get('dpi', 50))
+
+    else:
+        raise ValueError(f"Unknown render mode {mode}")
+
+    return len(events)
+
+
+def render_events(events: list, outdir: str, mode: str = 'pdf', nPix=(35, 35), grid=(5, 5),
+                  pages: int = 500, workers: int = None, name: str = 'events', dpi: int = 50) -> list:
+    """
+    Render events in a process pool
+
+    :param events: List of (eventID, rows, cols, color) from split_events
+    :param outdir: Output directory
+    :param mode: 'pdf' one file per event, 'multipage' multi-page PDFs, 'sheet' PNG contact sheets
+    :param nPix: Number of rows and columns
+    :param grid: Panels per contact sheet, rows and columns
+    :param pages: Events per multi-page PDF
+    :param workers: Number of worker processes, default number of CPUs, 1 renders in this process
+    :param name: Name of multi-page PDFs and contact sheets
+    :param dpi: Resolution of contact sheets
+
+    :returns: List of written files, or the output directory for mode 'pdf'
+    """
+
+    if mode not in RENDER_MODES:
+        raise ValueError(f"Unknown render mode {mode}, use one of {RENDER_MODES}")
+
+    os.makedirs(outdir, exist_ok=True)
+
+    if mode == 'pdf':
+        # Small tasks keep all workers busy, the figure is reused across tasks
+        size = 50
+        paths = [outdir] * len(range(0, len(events), size))
+    elif mode == 'multipage':
+        size = pages
+        paths = [os.path.join(outdir, f"{name}_{n:03d}.pdf") for n in range(len(range(0, len(events), size)))]
+    else:
+        size = grid[0] * grid[1]
+        paths = [os.path.join(outdir, f"{name}_{n:04d}.png") for n in range(len(range(0, len(events), size)))]
+
+    tasks = [{'events': events[start:start + size], 'mode': mode, 'path': path, 'nPix': nPix, 'grid': grid,
+              'dpi': dpi}
+             for start, path in zip(range(0, len(events), size), paths)]
+
+    progress = tqdm(total=len(events), desc='Rendering', unit='event')
+
+    try:
+        if workers == 1:
+            for task in tasks:
+                progress.update(render_task(task))
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for n in executor.map(render_task, tasks):
+                    progress.update(n)
+    finally:
+        progress.close()
+
+    logger.info("Rendered %d events to %s", len(events), outdir)
+
+    return [outdir] if mode == 'pdf' else paths
@@ -0,0 +1,196 @@
+"""
+Columnar output for decoded hits
+
+HitSink collects decoded hit dataframes in preallocated column arrays and writes them
+in chunks, so memory stays constant and time linear over long runs. Every chunk is
+written as soon as it is full, a crashed run leaves all but the last chunk on disk.
+
+Output format is chosen by file extension:
+| .csv          always available
+| .parquet      requires pyarrow
+| .h5, .hdf5    requires pytables
+"""
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+
+from modules.setup_logger import logger
+
+# Columns of astropix3.decode_readout
+HIT_COLUMNS = [
+    'readout',
+    'Chip ID',
+    'payload',
+    'location',
+    'isCol',
+    'timestamp',
+    'tot_msb',
+    'tot_lsb',
+    'tot_total',
+    'tot_us',
+    'hittime'
+]
+
+logger = logging.getLogger(__name__)
+
+
+class HitSink:
+    """Buffer decoded hits and write them to CSV, Parquet or HDF5 in chunks"""
+
+    def __init__(self, path: str, columns: list = None, chunksize: int = 65536, index_label: str = 'dec_order',
+                 append: bool = False) -> None:
+        """
+        :param path: Output file path, format from extension
+        :param columns: Output columns, defaults to the columns of astropix3.decode_readout
+        :param chunksize: Number of hits buffered before writing
+        :param index_label: Name of the index column
+        :param append: Append to an existing CSV or HDF5 file written with the same columns
+        """
+
+        self.path = path
+        self.columns = list(HIT_COLUMNS if columns is None else columns)
+        self.chunksize = chunksize
+        self.index_label = index_label
+        self.rows = 0
+
+        self._format = self.__format(path)
+
+        # Values are buffered as float to keep NaN of failed decodings, the dtype seen
+        # in the input is restored when writing
+        self._buffer = {column: np.empty(chunksize, dtype=np.float64) for column in self.columns}
+        self._index = np.empty(chunksize, dtype=np.int64)
+        self._kinds = {}
+        self._fill = 0
+
+        if append and self._format == 'parquet':
+            raise ValueError("Parquet files can not be appended to")
+
+        self._parquet = None
+        self._written = append
+
+    @staticmethod
+    def __format(path: str) -> str:
+        extension = os.path.splitext(path)[1].lower()
+
+        if extension == '.parquet':
+            return 'parquet'
+        if extension in ('.h5', '.hdf5'):
+            return 'hdf5'
+        return 'csv'
+
+    def append(self, hits: pd.DataFrame) -> None:
+        """
+        Add decoded hits
+
+        :param hits: Dataframe with decoded hits, missing columns are filled with NaN
+        """
+
+        length = len(hits)
+        if length == 0:
+            return
+
+        values = {}
+        for column in self.columns:
+            if column in hits:
+                array = hits[column].to_numpy()
+                if array.dtype.kind in 'biuf':
+                    self._kinds.setdefault(column, array.dtype.kind)
+                values[column] = pd.to_numeric(hits[column], errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+        index = hits.index.to_numpy() if hits.index.dtype.kind in 'iu' else np.arange(length)
+
+        start = 0
+        while start < length:
+            count = min(length - start, self.chunksize - self._fill)
+            stop = self._fill + count
+
+            for column in self.columns:
+                if column in values:
+                    self._buffer[column][self._fill:stop] = values[column][start:start + count]
+                else:
+                    self._buffer[column][self._fill:stop] = np.nan
+            self._index[self._fill:stop] = index[start:start + count]
+
+            self._fill = stop
+            start += count
+
+            if self._fill == self.chunksize:
+                self.flush()
+
+    def frame(self) -> pd.DataFrame:
+        """
+        Returns buffered hits, not yet written, as dataframe
+        """
+
+        data = {}
+        for column in self.columns:
+            values = self._buffer[column][:self._fill]
+            kind = self._kinds.get(column, 'f')
+
+            # HDF5 tables keep NaN as float, other formats use nullable types
+            if self._format == 'hdf5' or kind == 'f':
+                data[column] = values.copy()
+                continue
+
+            nan = np.isnan(values)
+            if kind == 'b':
+                values = pd.array(values.astype(bool), dtype='boolean')
+            else:
+                values = pd.array(np.where(nan, 0, values).astype(np.int64), dtype='Int64')
+            values[nan] = pd.NA
+
+            data[column] = values
+
+        return pd.DataFrame(data, index=pd.Index(self._index[:self._fill].copy(), name=self.index_label))
+
+    def flush(self) -> None:
+        """Write buffered hits"""
+
+        if self._fill == 0 and self._written:
+            return
+
+        frame = self.frame()
+
+        if self._format == 'parquet':
+            self.__write_parquet(frame)
+        elif self._format == 'hdf5':
+            frame.to_hdf(self.path, key='hits', mode='a' if self._written else 'w', format='table', append=True)
+        else:
+            frame.to_csv(self.path, mode='a' if self._written else 'w', header=not self._written)
+
+        logger.debug("Wrote %d hits to %s", self._fill, self.path)
+
+        self.rows += self._fill
+        self._fill = 0
+        self._written = True
+
+    def __write_parquet(self, frame: pd.DataFrame) -> None:
+        try:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+        except ImportError as exc:
+            raise RuntimeError("Parquet output requires pyarrow") from exc
+
+        table = pa.Table.from_pandas(frame)
+        if self._parquet is None:
+            self._parquet = pq.ParquetWriter(self.path, table.schema)
+        self._parquet.write_table(table)
+
+    def close(self) -> None:
+        """Write remaining hits and close output"""
+
+        self.flush()
+
+        if self._parquet is not None:
+            self._parquet.close()
+            self._parquet = None
+
+        logger.info("Saved %d hits to %s", self.rows, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
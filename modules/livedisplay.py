@@ -0,0 +1,225 @@
+"""
+Live hit display in a separate process
+
+The acquisition side only puts the decoded hits of each readout into a queue without
+waiting, a full queue drops the readout for the display. The display process matches
+row and column hits to pixels, accumulates occupancy and mean ToT maps and redraws at
+a limited rate with blitting: the figure is drawn once, later refreshes only update the
+image data and the text of persistent artists.
+"""
+import logging
+import multiprocessing
+import os
+import queue
+import time
+
+import numpy as np
+import pandas as pd
+
+from modules.aggregation import PixelMaps
+from modules.clustering import match_pixels
+from modules.setup_logger import logger
+
+# Columns used by the display process
+DISPLAY_COLUMNS = ['readout', 'isCol', 'location', 'timestamp', 'tot_us']
+
+logger = logging.getLogger(__name__)
+
+
+class LiveDisplay:
+    """Occupancy, mean ToT and last event maps, drawn in a separate process"""
+
+    def __init__(self, num_cols: int = 35, num_rows: int = 35, refresh: float = 10., outdir: str = None,
+                 timestampdiff: float = 0.5, totdiff: float = 1.0, maxqueue: int = 1000) -> None:
+        """
+        :param num_cols: Number of columns
+        :param num_rows: Number of rows
+        :param refresh: Maximum refresh rate in Hz
+        :param outdir: If not None, save the final maps as png and npz into this directory
+        :param timestampdiff: Maximum timestamp difference of matched row and column hits
+        :param totdiff: Maximum ToT difference in us of matched row and column hits
+        :param maxqueue: Number of readouts buffered for the display before readouts are dropped
+        """
+
+        self.dropped = 0
+
+        self._queue = multiprocessing.Queue(maxqueue)
+        self._process = multiprocessing.Process(
+            target=display_process, name='livedisplay', daemon=True,
+            args=(self._queue, num_cols, num_rows, refresh, outdir, timestampdiff, totdiff))
+
+    def start(self) -> None:
+        """Start display process"""
+
+        self._process.start()
+        logger.info("Live display started")
+
+    def send(self, hits: pd.DataFrame) -> bool:
+        """
+        Queue decoded hits of one readout for the display, never blocks
+
+        :param hits: Dataframe with decoded hits, as returned by astropix3.decode_readout
+
+        :returns: False if the hits were dropped because the display is behind
+        """
+
+        if len(hits) == 0:
+            return True
+
+        try:
+            # The dataframe is pickled by the feeder thread of the queue, not here
+            self._queue.put_nowait(hits)
+        except queue.Full:
+            self.dropped += 1
+            return False
+
+        return True
+
+    def close(self, timeout: float = 5.) -> None:
+        """
+        Stop display process, the final maps are saved if outdir is set
+
+        :param timeout: Time in s to wait for the display process
+        """
+
+        if self._process.is_alive():
+            try:
+                self._queue.put(None, timeout=timeout)
+            except queue.Full:
+                pass
+
+            self._process.join(timeout)
+
+            if self._process.is_alive():
+                self._process.terminate()
+
+        if self.dropped:
+            logger.info("Live display dropped %d readouts", self.dropped)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def display_process(hitqueue, num_cols: int, num_rows: int, refresh: float, outdir: str,
+                    timestampdiff: float, totdiff: float) -> None:
+    """
+    Main loop of the display process
+
+    :param hitqueue: Queue with dataframes of decoded hits, None stops the display
+    :param num_cols: Number of columns
+    :param num_rows: Number of rows
+    :param refresh: Maximum refresh rate in Hz
+    :param outdir: If not None, save the final maps into this directory
+    :param timestampdiff: Maximum timestamp difference of matched row and column hits
+    :param totdiff: Maximum ToT difference in us of matched row and column hits
+    """
+
+    # matplotlib is only loaded in the display process
+    import matplotlib.pyplot as plt
+
+    maps = PixelMaps(num_cols, num_rows)
+    event = np.zeros((num_rows, num_cols))
+    readouts = 0
+    eventID = None
+
+    fig, (ax_event, ax_hits, ax_tot) = plt.subplots(ncols=3, figsize=(18, 6))
+    extent = (-0.5, num_cols - 0.5, -0.5, num_rows - 0.5)
+
+    images = []
+    for ax, title, cmap in ((ax_event, "Last event", 'Oranges'), (ax_hits, "Occupancy", 'Reds'),
+                            (ax_tot, "Mean ToT [us]", 'Blues')):
+        image = ax.imshow(np.zeros((num_rows, num_cols)), origin='lower', extent=extent, cmap=cmap,
+                          vmin=0, vmax=1, interpolation='nearest', animated=True)
+        ax.set_title(title)
+        ax.set_xlabel("Column")
+        ax.set_ylabel("Row")
+        images.append(image)
+
+    texts = [ax.text(0.02, 0.98, "", transform=ax.transAxes, va='top', animated=True)
+             for ax in (ax_event, ax_hits, ax_tot)]
+
+    fig.tight_layout()
+    plt.show(block=False)
+
+    canvas = fig.canvas
+    canvas.draw()
+    background = canvas.copy_from_bbox(fig.bbox) if canvas.supports_blit else None
+
+    def redraw():
+        occupancy = maps.hits.T
+        tot = np.nan_to_num(maps.mean_tot.T)
+
+        for image, data in zip(images, (event, occupancy, tot)):
+            image.set_data(data)
+            image.set_clim(0, max(float(data.max()), 1.))
+
+        texts[0].set_text(f"Event {eventID}")
+        texts[1].set_text(f"{readouts} readouts, {int(maps.hits.sum())} pixel hits, max {int(occupancy.max())}")
+        texts[2].set_text(f"max {tot.max():.2f} us")
+
+        if background is None:
+            canvas.draw_idle()
+        else:
+            canvas.restore_region(background)
+            for artist in images + texts:
+                fig.draw_artist(artist)
+            canvas.blit(fig.bbox)
+
+        canvas.flush_events()
+
+    period = 1. / refresh
+    next_refresh = time.monotonic() + period
+    running = True
+
+    while running:
+        # Collect all readouts until the next refresh
+        batch = []
+        while True:
+            timeout = next_refresh - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                item = hitqueue.get(timeout=timeout)
+            except queue.Empty:
+                break
+            if item is None:
+                running = False
+                break
+            batch.append(item)
+
+        next_refresh = time.monotonic() + period
+
+        if batch:
+            hits = pd.concat([item[DISPLAY_COLUMNS] for item in batch], ignore_index=True)
+            readouts += len(batch)
+
+            maps.add_pixels(match_pixels(hits, timestampdiff, totdiff))
+
+            # Row and column strips of the last readout
+            last = batch[-1]
+            eventID = int(last['readout'].iloc[0])
+            iscol = last['isCol'].to_numpy().astype(bool)
+            locations = last['location'].to_numpy().astype(np.int64)
+
+            event[:] = 0
+            event[:, locations[iscol][locations[iscol] < num_cols]] += 1
+            event[locations[~iscol][locations[~iscol] < num_rows], :] += 1
+
+        # Drawing stops when the window is closed, the queue is still emptied
+        if batch and plt.fignum_exists(fig.number):
+            redraw()
+        elif plt.fignum_exists(fig.number):
+            canvas.flush_events()
+
+    if outdir is not None:
+        redraw()
+        canvas.draw()
+        name = os.path.join(outdir, "livedisplay_" + time.strftime("%Y%m%d-%H%M%S"))
+        fig.savefig(name + '.png')
+        maps.save(name + '.npz')
+
+    plt.close(fig)
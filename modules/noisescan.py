@@ -0,0 +1,344 @@
+"""
+Noise scan on one open connection
+
+The chip is configured once, between scan steps only the pixel mask is uploaded. The chip
+is reset with the upload and the FPGA buffer is dumped, so hits of the previous step are
+not counted. Every pixel is read out until maxruns readouts or maxtime, or stops early as
+soon as its count is above the noise threshold, because it is masked in data taking anyway.
+Each pixel is written to the summary CSV as soon as it is done, so an interrupted scan
+keeps all finished pixels.
+
+In pattern mode a diagonal of pixels without shared rows or columns is enabled per step.
+A column hit then belongs to the one enabled pixel of its column and a row hit to the one
+enabled pixel of its row, so the noise of all pixels of a step is counted at once and a
+square matrix is scanned in one step per column instead of one step per pixel.
+"""
+import csv
+import logging
+import time
+
+import numpy as np
+import pandas as pd
+
+from astropix import ReadoutPoller
+from modules.setup_logger import logger
+
+# Columns of the summary CSV, Col, Row and Count as read by beam_test.py
+SUMMARY_COLUMNS = ['Col', 'Row', 'Count', 'Readouts', 'Time', 'Start']
+
+logger = logging.getLogger(__name__)
+
+
+def scan_pixels(colrange, rowrange) -> list:
+    """
+    Pixels of a scan in the order of noise_scan.py, rows in the outer loop
+
+    :param colrange: First and last column
+    :param rowrange: First and last row
+
+    :returns: List of (col, row)
+    """
+
+    return [(col, row) for row in range(rowrange[0], rowrange[1] + 1)
+            for col in range(colrange[0], colrange[1] + 1)]
+
+
+def diagonal_patterns(colrange, rowrange) -> list:
+    """
+    Split a pixel range into diagonals without shared rows or columns
+
+    Pattern k holds the pixels (col_i, row_(i+k mod n)) of the shorter side i and the longer
+    side n, every pixel of the range is in exactly one pattern.
+
+    :param colrange: First and last column
+    :param rowrange: First and last row
+
+    :returns: List of (cols, rows) arrays, one per pattern
+    """
+
+    cols = np.arange(colrange[0], colrange[1] + 1)
+    rows = np.arange(rowrange[0], rowrange[1] + 1)
+
+    short, long = (cols, rows) if len(cols) <= len(rows) else (rows, cols)
+    index = np.arange(len(short))
+
+    patterns = []
+    for k in range(len(long)):
+        shifted = long[(index + k) % len(long)]
+        patterns.append((short, shifted) if short is cols else (shifted, short))
+
+    return patterns
+
+
+def attribute_hits(hits: pd.DataFrame, cols, rows, num_cols: int = 35, num_rows: int = 35) -> np.ndarray:
+    """
+    Assign decoded hits to the enabled pixels of a pattern without shared rows or columns
+
+    :param hits: Dataframe with decoded hits, columns isCol and location
+    :param cols: Columns of the enabled pixels
+    :param rows: Rows of the enabled pixels, same length as cols
+    :param num_cols: Number of columns
+    :param num_rows: Number of rows
+
+    :returns: Index into cols/rows per hit (-1 for hits outside the pattern)
+    """
+
+    # Enabled pixel per column and per row
+    bycol = np.full(max(num_cols, 64), -1, dtype=np.int64)
+    byrow = np.full(max(num_rows, 64), -1, dtype=np.int64)
+    bycol[np.asarray(cols)] = np.arange(len(cols))
+    byrow[np.asarray(rows)] = np.arange(len(rows))
+
+    iscol = hits['isCol'].to_numpy().astype(bool)
+    location = hits['location'].to_numpy().astype(np.int64) & 0b111111
+
+    return np.where(iscol, bycol[location], byrow[location])
+
+
+class NoiseScan:
+    """Per-pixel noise count with early stop, for a configured astropix3 object"""
+
+    def __init__(self, astro, maxruns: int = None, maxtime: float = None, noisethreshold: int = None,
+                 inject: bool = False, bufferlength: int = 3, pollmode: str = 'interrupt',
+                 rawfile=None, hitsink=None, rearm: bool = False) -> None:
+        """
+        :param astro: astropix3 object after asic_init and enable_spi
+        :param maxruns: Maximum number of readouts per pixel
+        :param maxtime: Maximum time per pixel in s
+        :param noisethreshold: Stop a pixel once its count is above this threshold, None scans all pixels fully
+        :param inject: Enable injection into the scanned pixel
+        :param bufferlength: Buffer length passed to get_readout
+        :param pollmode: ReadoutPoller mode, 'interrupt' or 'speculative'
+        :param rawfile: RawDataWriter for all readouts of the scan, optional
+        :param hitsink: HitSink for decoded hits with scan_col and scan_row, optional
+        :param rearm: Reset the chip and upload the config after every readout, as thresholdScan.py
+        """
+
+        if maxruns is None and maxtime is None:
+            raise ValueError("Noise scan needs maxruns or maxtime")
+
+        self.astro = astro
+        self.maxruns = maxruns
+        self.maxtime = maxtime
+        self.noisethreshold = noisethreshold
+        self.inject = inject
+        self.rawfile = rawfile
+        self.hitsink = hitsink
+        self.rearm = rearm
+
+        self.poller = ReadoutPoller(astro, bufferlength, pollmode)
+
+        # Mask from the YAML, the scanned pixel is enabled on top of it
+        self.base_mask = astro.get_pixel_mask()
+
+        # Readout number over the whole scan, as in the raw data file
+        self.index = 0
+
+    def _set_pixels(self, cols, rows) -> None:
+        mask = self.base_mask.copy()
+        mask.enable_pixels(cols, rows)
+
+        if self.inject:
+            mask.inj_col[cols] = True
+            mask.inj_row[rows] = True
+
+        # One upload per step with chip reset, the voltage boards and SPI stay configured
+        self.astro.set_pixel_mask(mask, inplace=False)
+        self.astro.asic_update(force=True)
+
+        # Hits still queued from the previous step must not be counted for this one
+        self.astro.dump_fpga()
+        self.astro.stream_decoder.reset()
+        self.poller.reset_counters()
+
+    def _readouts(self):
+        """Readout number and decoded hits until maxruns or maxtime"""
+
+        end_time = time.monotonic() + self.maxtime if self.maxtime is not None else None
+        readouts = 0
+
+        while True:
+            if self.maxruns is not None and readouts >= self.maxruns:
+                break
+            if end_time is not None and time.monotonic() >= end_time:
+                break
+
+            readout = self.poller.poll()
+            if readout is None:
+                continue
+
+            i = self.index
+            self.index += 1
+            readouts += 1
+
+            if self.rawfile is not None:
+                self.rawfile.write(i, readout)
+
+            if self.rearm:
+                self.astro.asic_update(force=True)
+
+            yield i, self.astro.decode_readout_stream(readout, i, printer=False)
+
+    def scan_pixel(self, col: int, row: int) -> dict:
+        """
+        Count readouts with hits of one pixel
+
+        :param col: Column
+        :param row: Row
+
+        :returns: Dict with SUMMARY_COLUMNS
+        """
+
+        self._set_pixels(col, row)
+
+        start = self.index
+        begin = time.monotonic()
+        count = 0
+
+        for i, hits in self._readouts():
+            if hits.empty:
+                continue
+
+            count += 1
+
+            if self.hitsink is not None:
+                self.hitsink.append(hits.assign(scan_col=col, scan_row=row))
+
+            if self.noisethreshold is not None and count > self.noisethreshold:
+                logger.info("Pixel col %d row %d above noise threshold after %d readouts", col, row,
+                            self.index - start)
+                break
+
+        return {
+            'Col': col,
+            'Row': row,
+            'Count': count,
+            'Readouts': self.index - start,
+            'Time': round(time.monotonic() - begin, 3),
+            'Start': start
+        }
+
+    def scan_pattern(self, cols, rows) -> list:
+        """
+        Count readouts with hits of several pixels at once, hits are assigned by location
+
+        Consecutive patterns enable the same columns, so every pattern starts with a chip reset
+        and a dumped FPGA buffer, otherwise queued hits of the previous pattern would be assigned
+        to the pixels of this one. Pixels above the noise threshold are masked the same way and
+        the step goes on with the remaining pixels until all stopped or maxruns or maxtime is
+        reached.
+
+        :param cols: Columns of the pixels, no column twice
+        :param rows: Rows of the pixels, no row twice, same length as cols
+
+        :returns: List of dicts with SUMMARY_COLUMNS, one per pixel
+        """
+
+        cols = np.asarray(cols, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+
+        if len(np.unique(cols)) != len(cols) or len(np.unique(rows)) != len(rows):
+            raise ValueError("Pixels of a pattern must not share rows or columns")
+
+        self._set_pixels(cols, rows)
+
+        num_cols, num_rows = self.base_mask.num_cols, self.base_mask.num_rows
+
+        start = self.index
+        begin = time.monotonic()
+
+        counts = np.zeros(len(cols), dtype=np.int64)
+        active = np.ones(len(cols), dtype=bool)
+        readouts = np.zeros(len(cols), dtype=np.int64)
+        elapsed = np.zeros(len(cols))
+        unassigned = 0
+
+        for i, hits in self._readouts():
+            readouts[active] += 1
+
+            if hits.empty:
+                continue
+
+            pixel = attribute_hits(hits, cols, rows, num_cols, num_rows)
+            unassigned += np.count_nonzero(pixel < 0)
+
+            # One count per readout and pixel, as in the single pixel scan. Hits of masked
+            # pixels are dropped with the reset, active keeps them out in any case
+            seen = np.unique(pixel[pixel >= 0])
+            counts[seen[active[seen]]] += 1
+
+            if self.hitsink is not None:
+                known = pixel >= 0
+                self.hitsink.append(hits.assign(scan_col=np.where(known, cols[pixel], -1),
+                                                scan_row=np.where(known, rows[pixel], -1)))
+
+            if self.noisethreshold is not None:
+                noisy = active & (counts > self.noisethreshold)
+
+                if np.any(noisy):
+                    active &= ~noisy
+                    elapsed[noisy] = time.monotonic() - begin
+                    logger.info("%d pixels above noise threshold after %d readouts", np.count_nonzero(noisy),
+                                self.index - start)
+
+                    if not np.any(active):
+                        break
+
+                    # Remaining pixels keep their columns, queued hits of the masked ones are dumped
+                    self._set_pixels(cols[active], rows[active])
+
+        elapsed[active] = time.monotonic() - begin
+
+        if unassigned:
+            logger.warning("%d hits outside of the enabled pixels", unassigned)
+
+        return [{
+            'Col': int(col),
+            'Row': int(row),
+            'Count': int(count),
+            'Readouts': int(n),
+            'Time': round(float(t), 3),
+            'Start': start
+        } for col, row, count, n, t in zip(cols, rows, counts, readouts, elapsed)]
+
+    def run(self, pixels: list, summarypath: str, printer: bool = True) -> pd.DataFrame:
+        """
+        Scan pixels and write summary line by line
+
+        :param pixels: List of (col, row) scanned one by one, or list of (cols, rows) arrays
+                       of diagonal_patterns scanned with scan_pattern
+        :param summarypath: Summary CSV
+        :param printer: Print summary line per pixel
+
+        :returns: Dataframe with SUMMARY_COLUMNS of the scanned pixels
+        """
+
+        results = []
+
+        with open(summarypath, 'w', newline='') as summaryfile:
+            writer = csv.DictWriter(summaryfile, fieldnames=SUMMARY_COLUMNS)
+            writer.writeheader()
+
+            try:
+                for col, row in pixels:
+                    if np.ndim(col) == 0:
+                        step = [self.scan_pixel(col, row)]
+                    else:
+                        step = self.scan_pattern(col, row)
+
+                    results.extend(step)
+                    writer.writerows(step)
+                    summaryfile.flush()
+
+                    if printer:
+                        for result in step:
+                            print(f"{result['Col']},{result['Row']},{result['Count']}")
+            finally:
+                # Leave the chip with the mask from the YAML
+                self.astro.set_pixel_mask(self.base_mask)
+
+                noisy = np.count_nonzero([result['Count'] > self.noisethreshold for result in results]) \
+                    if self.noisethreshold is not None else 0
+                logger.info("Scanned %d pixels, %d above noise threshold", len(results), noisy)
+
+        return pd.DataFrame(results, columns=SUMMARY_COLUMNS)
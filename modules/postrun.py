@@ -0,0 +1,456 @@
+"""
+Parallel offline decoding of raw data files
+
+Files are split into chunks of readouts which are decoded in a process pool with
+astropix3.decode_readouts. Chunks start after a readout with an idle gap, each chunk
+is decoded together with this readout, so frames split across readouts are completed
+as in the live decoding of beam_test.py. Decoded hits are written per file with HitSink, in readout order.
+
+A JSON manifest is kept next to each output file with size, mtime, content hash and
+decoder version of the input. Unchanged inputs are skipped, inputs that grew since the
+last run (a live run still writing) are decoded from the last decoded byte offset and
+appended to the output.
+
+With a calibration array (modules/calibration.py) every worker process maps it once and
+the decoded hits get calibrated charge (and energy) columns.
+"""
+import binascii
+import hashlib
+import json
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+from tqdm import tqdm
+
+from astropix import astropix3
+from modules.rawdata import RawDataReader, RAW_EXTENSION
+from modules.hitsink import HitSink, HIT_COLUMNS
+from modules.calibration import get_calibration
+from modules.setup_logger import logger
+
+# Output file extensions of HitSink
+OUTPUT_FORMATS = {'csv': '.csv', 'parquet': '.parquet', 'h5': '.h5'}
+
+# Increase when the decoded output changes, outputs of older versions are decoded again
+DECODER_VERSION     = 1
+
+# Bytes hashed at the start and the end of the decoded part of an input file
+HASH_BLOCKSIZE      = 1 << 20
+
+# Header lines of text log files
+LOG_HEADER_LINES    = 6
+
+logger = logging.getLogger(__name__)
+
+
+def read_log_readouts(path: str, offset: int = 0) -> tuple:
+    """
+    Read readouts from text log file of beam_test.py
+
+    Only complete lines are read, a line still being written is left for the next call.
+
+    :param path: Log file, header lines followed by one readout per line
+    :param offset: Byte offset of first readout line, 0 skips the header
+
+    :returns: List of readout bytes, byte offset after the last complete line
+    """
+
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        text = f.read()
+
+    end = text.rfind(b'\n') + 1
+    lines = text[:end].splitlines()
+
+    if offset == 0:
+        lines = lines[LOG_HEADER_LINES:]
+
+    # isolate only bitstream without b'...' structure and convert hex to binary
+    readouts = [binascii.unhexlify(line.split()[1][2:-1]) for line in lines if line.strip()]
+
+    return readouts, offset + end
+
+
+def in_sync(readout: bytes, bytesperhit: int = 5) -> bool:
+    """
+    Check if frame positions after the readout are independent of earlier readouts
+
+    A frame can contain idle bytes, but it can not span bytesperhit-1 consecutive idle
+    bytes. The first frame after such an idle run starts at its first non-idle byte.
+
+    :param readout: Readout stream, bit order as read from the chip
+    :param bytesperhit: Bytes per hit frame
+
+    :returns: True if the readout contains bytesperhit-1 consecutive idle bytes
+    """
+
+    data = np.frombuffer(readout, dtype=np.uint8)
+    idle = np.concatenate(([0], (data == 0xbc) | (data == 0xff), [0])).astype(np.int8)
+
+    edges = np.flatnonzero(np.diff(idle))
+
+    return bool(len(edges)) and int(np.max(edges[1::2] - edges[::2])) >= bytesperhit - 1
+
+
+def chunk_starts(readout_at, nreadouts: int, chunksize: int) -> list:
+    """
+    Split readouts into chunks that can be decoded independently
+
+    A chunk starts after a readout that is in sync, decoding the chunk together with
+    this readout gives the same frames as decoding the whole file. Chunks are extended
+    until such a readout is found, a saturated stream is decoded in one chunk.
+
+    :param readout_at: Function returning readout bytes by readout number
+    :param nreadouts: Number of readouts
+    :param chunksize: Minimum number of readouts per chunk
+
+    :returns: List of first readout numbers of chunks
+    """
+
+    starts = [0] if nreadouts else []
+    start = chunksize
+
+    while start < nreadouts:
+        if in_sync(readout_at(start - 1)):
+            starts.append(start)
+            start += chunksize
+        else:
+            start += 1
+
+    return starts
+
+
+def plan_file(path: str, chunksize: int, offset: int = 0, first: int = 0, tail: bytes = b'') -> tuple:
+    """
+    Split file into decode tasks
+
+    Readouts of log files are read here and passed to the workers, records of raw data
+    files are read by the workers from their byte offsets.
+
+    :param path: Log or raw data file
+    :param chunksize: Minimum number of readouts per task
+    :param offset: Byte offset to start from, 0 decodes the whole file
+    :param first: Readout number of the first readout at offset
+    :param tail: Incomplete frame left by the readouts before offset
+
+    :returns: List of task dicts in readout order, byte offset after the last readout
+    """
+
+    if path.endswith(RAW_EXTENSION):
+        with RawDataReader(path) as rawfile:
+            offsets, end = rawfile.scan(offset or rawfile.data_offset)
+            starts = chunk_starts(lambda i: bytes(rawfile.record(offsets[i])[2]), len(offsets), chunksize)
+        key, readouts = 'offsets', offsets
+    else:
+        readouts, end = read_log_readouts(path, offset)
+        starts = chunk_starts(readouts.__getitem__, len(readouts), chunksize)
+        key = 'readouts'
+
+    tasks = []
+
+    for start, stop in zip(starts, starts[1:] + [len(readouts)]):
+        tasks.append({
+            'path': path,
+            'start': first + start,
+            key: readouts[max(start - 1, 0):stop],
+            'prime': start > 0,
+            'tail': b'' if start > 0 else tail,
+        })
+
+    return tasks, end
+
+
+def decode_task(task: dict) -> tuple:
+    """
+    Decode one chunk of readouts, runs in a worker process
+
+    :param task: Task dict from plan_file
+
+    :returns: Dataframe with decoded hits, incomplete frame at the end of the chunk
+    """
+
+    if 'offsets' in task:
+        with RawDataReader(task['path']) as rawfile:
+            readouts = [bytes(rawfile.record(offset)[2]) for offset in task['offsets']]
+    else:
+        readouts = task['readouts']
+
+    astro = astropix3(offline=True)
+
+    if task.get('calibration'):
+        astro.load_calibration(*task['calibration'])
+
+    # The readout before the chunk only completes a frame split across the chunk boundary
+    if task['prime']:
+        astro.stream_decoder.feed_hits(readouts[0])
+        readouts = readouts[1:]
+    elif task['tail']:
+        astro.stream_decoder.feed_hits(task['tail'])
+
+    hits = astro.decode_readouts(readouts, task['start'])
+
+    return hits, astro.stream_decoder.tail
+
+
+def file_hash(path: str, end: int) -> str:
+    """
+    Hash of the first end bytes of a file
+
+    Only the first and the last HASH_BLOCKSIZE bytes are hashed, so the check stays
+    fast for large files. Appending to the file does not change the hash.
+
+    :param path: Input file
+    :param end: Number of bytes
+
+    :returns: Hex digest
+    """
+
+    digest = hashlib.sha256()
+
+    with open(path, 'rb') as f:
+        digest.update(f.read(min(end, HASH_BLOCKSIZE)))
+
+        if end > HASH_BLOCKSIZE:
+            f.seek(max(end - HASH_BLOCKSIZE, HASH_BLOCKSIZE))
+            digest.update(f.read(end - f.tell()))
+
+    return digest.hexdigest()
+
+
+def manifest_path(path: str, outpath: str) -> str:
+    """
+    Manifest file of a decoded input file
+
+    :param path: Input file
+    :param outpath: Output directory
+
+    :returns: Manifest file path
+    """
+
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    return os.path.join(outpath, name + '_offline.json')
+
+
+def read_manifest(path: str) -> dict:
+    """
+    Read manifest
+
+    :param path: Manifest file
+
+    :returns: Manifest dict, empty if the file is missing or unreadable
+    """
+
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(path: str, manifest: dict) -> None:
+    """
+    Write manifest, replacing the old one only when complete
+
+    :param path: Manifest file
+    :param manifest: Manifest dict
+    """
+
+    with open(path + '.tmp', 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+    os.replace(path + '.tmp', path)
+
+
+def check_manifest(path: str, outfile: str, manifest: dict, fmt: str, calibration: list = None) -> str:
+    """
+    Compare input file with its manifest
+
+    :param path: Input file
+    :param outfile: Output file
+    :param manifest: Manifest dict of the last decoding
+    :param fmt: Output format
+    :param calibration: Calibration id of calibration_id, None without calibration
+
+    :returns: 'skip' if unchanged, 'append' if data was appended, 'full' to decode again
+    """
+
+    if (manifest.get('decoder_version') != DECODER_VERSION or manifest.get('format') != fmt
+            or manifest.get('path') != os.path.abspath(path) or not os.path.exists(outfile)
+            or manifest.get('calibration') != calibration):
+        return 'full'
+
+    stat = os.stat(path)
+
+    if stat.st_size == manifest['size'] and stat.st_mtime == manifest['mtime']:
+        return 'skip'
+
+    if stat.st_size < manifest['offset'] or file_hash(path, manifest['offset']) != manifest['hash']:
+        return 'full'
+
+    # Parquet files can not be appended to
+    return 'full' if fmt == 'parquet' else 'append'
+
+
+def calibration_id(filename: str, kev_per_mv: float = None) -> list:
+    """
+    Identify a calibration in the manifest
+
+    :param filename: Calibration array file, None without calibration
+    :param kev_per_mv: Energy per mV injection voltage
+
+    :returns: Hash of the calibration file and kev_per_mv, None without calibration
+    """
+
+    if filename is None:
+        return None
+
+    return [file_hash(filename, os.path.getsize(filename)), kev_per_mv]
+
+
+def output_path(path: str, outpath: str, fmt: str = 'csv') -> str:
+    """
+    Output file of decoded hits
+
+    :param path: Input file
+    :param outpath: Output directory
+    :param fmt: Output format, csv, parquet or h5
+
+    :returns: Output file path
+    """
+
+    name = os.path.splitext(os.path.basename(path))[0]
+
+    return os.path.join(outpath, name + '_offline' + OUTPUT_FORMATS[fmt])
+
+
+def decode_files(paths: list, outpath: str, workers: int = None, chunksize: int = 10000,
+                 fmt: str = 'csv', printer: bool = False, force: bool = False, calibration: str = None,
+                 kev_per_mv: float = None) -> dict:
+    """
+    Decode files in a process pool
+
+    Files are checked against their manifests first: unchanged files are skipped and
+    files that grew are decoded from the last decoded offset.
+
+    :param paths: Log or raw data files
+    :param outpath: Output directory
+    :param workers: Number of worker processes, default number of CPUs, 1 decodes in this process
+    :param chunksize: Minimum number of readouts per task
+    :param fmt: Output format, csv, parquet or h5
+    :param printer: Print decoded hits to terminal
+    :param force: Decode all files completely, ignoring manifests
+    :param calibration: Calibration array file, adds charge_mv (and energy_kev) to the hits
+    :param kev_per_mv: Energy per mV injection voltage of the calibration
+
+    :returns: Dict with number of decoded hits per file
+    """
+
+    tasks = {}
+    sinks = {}
+    manifests = {}
+    nhits = {}
+
+    calid = calibration_id(calibration, kev_per_mv)
+    columns = None if calibration is None else HIT_COLUMNS + get_calibration(calibration, kev_per_mv).columns
+
+    for path in paths:
+        outfile = output_path(path, outpath, fmt)
+        manifest = {} if force else read_manifest(manifest_path(path, outpath))
+        mode = check_manifest(path, outfile, manifest, fmt, calid) if manifest else 'full'
+
+        if mode == 'skip':
+            logger.info("%s unchanged, skipped", path)
+            nhits[path] = manifest['hits']
+            continue
+
+        stat = os.stat(path)
+
+        if mode == 'append':
+            logger.info("%s grew by %d bytes, decoding from byte %d", path, stat.st_size - manifest['size'], manifest['offset'])
+            tasks[path], end = plan_file(path, chunksize, manifest['offset'], manifest['readouts'],
+                                         bytes.fromhex(manifest['tail']))
+        else:
+            manifest = {'readouts': 0, 'hits': 0, 'tail': ''}
+            tasks[path], end = plan_file(path, chunksize)
+
+        nreadouts = sum(len(task.get('offsets', task.get('readouts'))) - task['prime'] for task in tasks[path])
+
+        manifest = {
+            'path': os.path.abspath(path),
+            'size': stat.st_size,
+            'mtime': stat.st_mtime,
+            'hash': file_hash(path, end),
+            'decoder_version': DECODER_VERSION,
+            'format': fmt,
+            'offset': end,
+            'readouts': manifest['readouts'] + nreadouts,
+            'hits': manifest['hits'],
+            'tail': manifest['tail'],
+            'calibration': calid,
+        }
+        manifests[path] = manifest
+
+        if calibration is not None:
+            for task in tasks[path]:
+                task['calibration'] = (calibration, kev_per_mv)
+
+        sinks[path] = HitSink(outfile, columns=columns, index_label=None, append=(mode == 'append'))
+
+    ntasks = sum(len(filetasks) for filetasks in tasks.values())
+
+    # Results are written in readout order, later chunks wait for earlier ones
+    done = {path: {} for path in tasks}
+    written = {path: 0 for path in tasks}
+
+    def finish(path):
+        sinks[path].close()
+
+        manifests[path]['hits'] += sinks[path].rows
+        nhits[path] = manifests[path]['hits']
+
+        write_manifest(manifest_path(path, outpath), manifests[path])
+
+    def write(path, number, result):
+        done[path][number] = result
+
+        while written[path] in done[path]:
+            hits, tail = done[path].pop(written[path])
+            if printer:
+                print(hits.to_string())
+            sinks[path].append(hits)
+            manifests[path]['tail'] = tail.hex()
+            written[path] += 1
+
+        if written[path] == len(tasks[path]):
+            finish(path)
+
+    # Files without new readouts
+    for path in tasks:
+        if not tasks[path]:
+            logger.info("No new readouts in %s", path)
+            finish(path)
+
+    progress = tqdm(total=ntasks, desc='Decoding', unit='chunk')
+
+    try:
+        if workers == 1:
+            for path, filetasks in tasks.items():
+                for number, task in enumerate(filetasks):
+                    write(path, number, decode_task(task))
+                    progress.update()
+        else:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                futures = {executor.submit(decode_task, task): (path, number)
+                           for path, filetasks in tasks.items() for number, task in enumerate(filetasks)}
+
+                for future in as_completed(futures):
+                    path, number = futures[future]
+                    write(path, number, future.result())
+                    progress.update()
+    finally:
+        progress.close()
+
+    return {path: nhits[path] for path in paths}
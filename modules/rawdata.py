@@ -0,0 +1,205 @@
+"""
+Binary raw data format for readout streams
+
+A raw data file starts with a header followed by append-only records:
+
+| Header:  magic b'APXRAW', format version (uint16), header length (uint32),
+|          YAML text with config, run arguments and log header
+| Record:  readout index (uint64), monotonic timestamp in s (float64),
+|          data length (uint32), raw readout bytes
+
+All integers are little endian. A record that was cut by a crash is ignored by the reader.
+"""
+import logging
+import mmap
+import os
+import struct
+import time
+
+import yaml
+
+from modules.setup_logger import logger
+
+RAW_MAGIC           = b'APXRAW'
+RAW_VERSION         = 1
+RAW_EXTENSION       = '.raw'
+
+FILE_HEADER         = struct.Struct('<6sHI')
+RECORD_HEADER       = struct.Struct('<QdI')
+
+logger = logging.getLogger(__name__)
+
+
+class RawDataWriter:
+    """Append readouts to a binary raw data file"""
+
+    def __init__(self, path: str, header: dict = None, buffering: int = 1 << 16) -> None:
+        """
+        Create raw data file and write header
+
+        :param path: Output file path
+        :param header: Dict with run information stored as YAML in the file header
+        :param buffering: Write buffer size in bytes
+        """
+
+        self.path = path
+        self.records = 0
+
+        header_text = yaml.safe_dump(header or {}, default_flow_style=False, sort_keys=False).encode('utf-8')
+
+        self._file = open(path, 'wb', buffering=buffering)
+        self._file.write(FILE_HEADER.pack(RAW_MAGIC, RAW_VERSION, len(header_text)))
+        self._file.write(header_text)
+
+        logger.info("Opened raw data file %s", path)
+
+    def write(self, index: int, readout: bytes, timestamp: float = None) -> None:
+        """
+        Append one readout
+
+        :param index: Readout number
+        :param readout: Raw readout bytes
+        :param timestamp: Monotonic timestamp, defaults to time.monotonic()
+        """
+
+        if timestamp is None:
+            timestamp = time.monotonic()
+
+        self._file.write(RECORD_HEADER.pack(index, timestamp, len(readout)))
+        self._file.write(readout)
+        self.records += 1
+
+    def flush(self) -> None:
+        """Flush buffered records to disk"""
+
+        self._file.flush()
+
+    def close(self) -> None:
+        """Close file"""
+
+        if not self._file.closed:
+            self._file.close()
+            logger.info("Wrote %d readouts to %s", self.records, self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+class RawDataReader:
+    """Read a binary raw data file through a memory map"""
+
+    def __init__(self, path: str) -> None:
+        """
+        Open raw data file and parse header
+
+        :param path: Input file path
+        """
+
+        self.path = path
+
+        self._file = open(path, 'rb')
+        size = os.fstat(self._file.fileno()).st_size
+
+        if size < FILE_HEADER.size:
+            self._file.close()
+            raise ValueError(f"{path} is not an AstroPix raw data file")
+
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, self.version, header_length = FILE_HEADER.unpack_from(self._map, 0)
+
+        if magic != RAW_MAGIC:
+            self.close()
+            raise ValueError(f"{path} is not an AstroPix raw data file")
+
+        self.header = yaml.safe_load(self._map[FILE_HEADER.size:FILE_HEADER.size + header_length].decode('utf-8')) or {}
+
+        self.data_offset = FILE_HEADER.size + header_length
+        self._offsets = None
+
+    @property
+    def offsets(self) -> list:
+        """Byte offsets of all complete records"""
+
+        if self._offsets is None:
+            self._offsets, _ = self.scan(self.data_offset)
+
+        return self._offsets
+
+    def scan(self, offset: int) -> tuple:
+        """
+        Find complete records, only the record headers are read
+
+        :param offset: Byte offset of first record
+
+        :returns: List of record offsets, offset after the last complete record
+        """
+
+        offsets = []
+        size = len(self._map)
+
+        while offset + RECORD_HEADER.size <= size:
+            length = RECORD_HEADER.unpack_from(self._map, offset)[2]
+            end = offset + RECORD_HEADER.size + length
+
+            if end > size:
+                logger.warning("Incomplete record at byte %d in %s", offset, self.path)
+                break
+
+            offsets.append(offset)
+            offset = end
+
+        return offsets, offset
+
+    def record(self, offset: int) -> tuple:
+        """
+        Read record at byte offset
+
+        :param offset: Byte offset of record
+
+        :returns: Readout index, timestamp, readout bytes
+        """
+
+        index, timestamp, length = RECORD_HEADER.unpack_from(self._map, offset)
+        start = offset + RECORD_HEADER.size
+
+        return index, timestamp, self._map[start:start + length]
+
+    def readouts(self, offset: int = None) -> tuple:
+        """
+        Read all complete records starting at byte offset
+
+        :param offset: Byte offset of first record, defaults to first record in file
+
+        :returns: List of (index, timestamp, readout) tuples, offset after the last complete record
+        """
+
+        offsets, end = self.scan(self.data_offset if offset is None else offset)
+
+        return [self.record(record_offset) for record_offset in offsets], end
+
+    def __len__(self) -> int:
+        return len(self.offsets)
+
+    def __getitem__(self, item: int) -> tuple:
+        return self.record(self.offsets[item])
+
+    def __iter__(self):
+        for offset in self.offsets:
+            yield self.record(offset)
+
+    def close(self) -> None:
+        """Close file"""
+
+        if hasattr(self, '_map'):
+            self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
@@ -0,0 +1,174 @@
+"""
+Threshold finding by bisection
+
+The hit rate of a pixel falls with rising threshold voltage. Instead of measuring a fixed
+list of thresholds, every pixel is bisected between vmin and vmax: each step measures at
+the middle of the interval and keeps the half where the rate crosses the target rate,
+until the interval is smaller than the precision. A step ends as soon as the count is
+above target rate * maxtime, only quiet steps take the full maxtime. With a range of
+700 mV and 5 mV precision a pixel takes 9 steps.
+
+With injection the target rate is typically half the injection rate, the threshold is
+then the 50% point of the S-curve.
+"""
+import csv
+import logging
+import math
+
+import numpy as np
+import pandas as pd
+
+from modules.noisescan import NoiseScan
+from modules.setup_logger import logger
+
+# Columns of the summary CSV
+THRESHOLD_COLUMNS = ['Col', 'Row', 'Threshold', 'Low', 'High', 'Rate', 'Steps', 'Time']
+
+logger = logging.getLogger(__name__)
+
+
+class ThresholdScan(NoiseScan):
+    """Per-pixel threshold at a target hit rate, for a configured astropix3 object"""
+
+    def __init__(self, astro, maxtime: float, rate: float = 1., vmin: float = 0., vmax: float = 700.,
+                 precision: float = 5., maxruns: int = None, inject: bool = False, bufferlength: int = 3,
+                 pollmode: str = 'interrupt', rawfile=None, hitsink=None, rearm: bool = False) -> None:
+        """
+        :param astro: astropix3 object after init_voltages, asic_init and enable_spi
+        :param maxtime: Measurement time per step in s
+        :param rate: Target rate of readouts with hits in Hz
+        :param vmin: Lowest threshold in mV
+        :param vmax: Highest threshold in mV
+        :param precision: Stop when the threshold is known to this precision in mV
+        :param maxruns: Maximum number of readouts per step, optional
+        :param inject: Enable injection into the scanned pixel
+        :param bufferlength: Buffer length passed to get_readout
+        :param pollmode: ReadoutPoller mode, 'interrupt' or 'speculative'
+        :param rawfile: RawDataWriter for all readouts of the scan, optional
+        :param hitsink: HitSink for decoded hits with scan_col and scan_row, optional
+        :param rearm: Reset the chip and upload the config after every readout
+        """
+
+        if not vmin < vmax:
+            raise ValueError("vmin must be smaller than vmax")
+        if precision <= 0:
+            raise ValueError("precision must be positive")
+
+        # Count above which a step is decided as above the target rate
+        super().__init__(astro, maxruns=maxruns, maxtime=maxtime, noisethreshold=int(rate * maxtime),
+                         inject=inject, bufferlength=bufferlength, pollmode=pollmode, rawfile=rawfile,
+                         hitsink=hitsink, rearm=rearm)
+
+        self.rate = rate
+        self.vmin = vmin
+        self.vmax = vmax
+        self.precision = precision
+
+        self.steps = math.ceil(math.log2((vmax - vmin) / precision)) if vmax - vmin > precision else 0
+
+    def measure(self, col: int, row: int, vthreshold: float) -> tuple:
+        """
+        Measure one pixel at one threshold
+
+        :param col: Column
+        :param row: Row
+        :param vthreshold: Threshold in mV
+
+        :returns: True if the rate is above the target rate, result of scan_pixel
+        """
+
+        # Hits taken at the previous threshold are discarded with the chip reset of scan_pixel
+        self.astro.update_threshold(vthreshold)
+
+        result = self.scan_pixel(col, row)
+
+        logger.debug("Pixel col %d row %d at %.1f mV: %d readouts with hits in %.3f s", col, row,
+                     vthreshold, result['Count'], result['Time'])
+
+        return result['Count'] > self.noisethreshold, result
+
+    def find_threshold(self, col: int, row: int) -> dict:
+        """
+        Bisect the threshold of one pixel
+
+        :param col: Column
+        :param row: Row
+
+        :returns: Dict with THRESHOLD_COLUMNS, Threshold is the lowest threshold measured at or below
+                  the target rate, NaN if the pixel is above the target rate at vmax
+        """
+
+        low, high = self.vmin, self.vmax
+        steps = 1
+        elapsed = 0.
+
+        # The upper end has to be quiet, otherwise the threshold is out of range
+        above, result = self.measure(col, row, high)
+        elapsed += result['Time']
+        quiet = result
+
+        if above:
+            logger.warning("Pixel col %d row %d above target rate at %.1f mV", col, row, high)
+            low = high
+            quiet = None
+        else:
+            while high - low > self.precision:
+                middle = (low + high) / 2
+                above, result = self.measure(col, row, middle)
+                steps += 1
+                elapsed += result['Time']
+
+                if above:
+                    low = middle
+                else:
+                    high = middle
+                    quiet = result
+
+        return {
+            'Col': col,
+            'Row': row,
+            'Threshold': high if quiet is not None else np.nan,
+            'Low': low,
+            'High': high,
+            'Rate': round(quiet['Count'] / quiet['Time'], 3) if quiet is not None and quiet['Time'] > 0 else np.nan,
+            'Steps': steps,
+            'Time': round(elapsed, 3)
+        }
+
+    def run(self, pixels: list, summarypath: str, printer: bool = True) -> pd.DataFrame:
+        """
+        Find thresholds of pixels and write summary line by line
+
+        :param pixels: List of (col, row)
+        :param summarypath: Summary CSV
+        :param printer: Print summary line per pixel
+
+        :returns: Dataframe with THRESHOLD_COLUMNS of the scanned pixels
+        """
+
+        results = []
+        vthreshold = self.astro.get_threshold()
+
+        logger.info("Bisecting thresholds between %.1f and %.1f mV in %d steps per pixel", self.vmin, self.vmax,
+                    self.steps + 1)
+
+        with open(summarypath, 'w', newline='') as summaryfile:
+            writer = csv.DictWriter(summaryfile, fieldnames=THRESHOLD_COLUMNS)
+            writer.writeheader()
+
+            try:
+                for col, row in pixels:
+                    result = self.find_threshold(col, row)
+                    results.append(result)
+
+                    writer.writerow(result)
+                    summaryfile.flush()
+
+                    if printer:
+                        print(f"{col},{row},{result['Threshold']}")
+            finally:
+                # Leave the chip as configured before the scan
+                self.astro.update_threshold(vthreshold)
+                self.astro.set_pixel_mask(self.base_mask)
+
+        return pd.DataFrame(results, columns=THRESHOLD_COLUMNS)
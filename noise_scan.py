@@ -10,16 +10,14 @@ Author: Amanda Steinhebel
 #from msilib.schema import File
 #from http.client import SWITCHING_PROTOCOLS
 from astropix import astropix3
-import modules.hitplotter as hitplotter
 import os
-import binascii
-import pandas as pd
-import numpy as np
 import time
 import logging
 import argparse
-import csv
 
+from modules.rawdata import RawDataWriter, RAW_EXTENSION
+from modules.hitsink import HitSink
+from modules.noisescan import NoiseScan, scan_pixels, diagonal_patterns
 from modules.setup_logger import logger
 
 
@@ -30,36 +28,15 @@ if os.path.exists(logdir) == False:
 logname = "./runlogs/AstropixRunlog_" + time.strftime("%Y%m%d-%H%M%S") + ".log"
 
 
-# This is the dataframe which is written to the csv if the decoding fails
-decode_fail_frame = pd.DataFrame({
-                'readout': np.nan,
-                'Chip ID': np.nan,
-                'payload': np.nan,
-                'location': np.nan,
-                'isCol': np.nan,
-                'timestamp': np.nan,
-                'tot_msb': np.nan,
-                'tot_lsb': np.nan,
-                'tot_total': np.nan,
-                'tot_us': np.nan,
-                'hittime': np.nan
-                }, index=[0]
-)
-
-  
-
 #Init 
-def main(args,row,col,injectPix):
+def main(args, pixels, summarypath):
 
     # Ensures output directory exists
     if os.path.exists(args.outdir) == False:
         os.mkdir(args.outdir)
 
-    # Prepare everything, create the object
-    if args.inject:
-        astro = astropix3(inject=injectPix) #enable injections
-    else:
-        astro = astropix3() #initialize without enabling injections
+    # Prepare everything, create the object once for the whole scan
+    astro = astropix3()
 
     astro.init_voltages(vthreshold=args.threshold) #no updates in YAML
 
@@ -70,106 +47,38 @@ def main(args,row,col,injectPix):
     #Initiate asic with pixel mask as defined in yaml 
     astro.asic_init(yaml=ymlpath)
 
-    #Enable single pixel in (col,row)
-    #Updates asic by default
-    astro.enable_pixel(col,row)
-
-    # If injection is on initalize the board
+    # If injection is on initalize the board, the injection switches follow the scanned pixel
     if args.inject:
         astro.init_injection(inj_voltage=args.vinj)
     astro.enable_spi() 
     logger.info("Chip configured")
     astro.dump_fpga()
 
-    if args.inject:
-        astro.start_injection()
-
-    i = 0
-    if args.maxtime is not None: 
-        end_time=time.time()+(args.maxtime*60.)
-    strPix = "_col"+str(col)+"_row"+str(row)
-    fname=strPix if not args.name else args.name+strPix+"_"
+    fname="" if not args.name else args.name+"_"
 
     # Prepares the file paths 
+    csvframe = None
     if args.saveascsv: # Here for csv
-        csvpath = args.outdir +'/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-        csvframe =pd.DataFrame(columns = [
-                'readout',
-                'Chip ID',
-                'payload',
-                'location',
-                'isCol',
-                'timestamp',
-                'tot_msb',
-                'tot_lsb',
-                'tot_total',
-                'tot_us',
-                'hittime'
-        ])
+        csvpath = args.outdir +'/' + fname + 'noise_scan_' + time.strftime("%Y%m%d-%H%M%S") + '.csv'
+        csvframe = HitSink(csvpath)
 
     # Save final configuration to output file    
     ymlpathout="config"+pathdelim+args.yaml+"_"+time.strftime("%Y%m%d-%H%M%S")+".yml"
     astro.write_conf_to_yaml(ymlpathout)
-    # And here for the text files/logs
-    bitpath = args.outdir + '/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
-    # textfiles are always saved so we open it up 
-    bitfile = open(bitpath,'w')
-    # Writes all the config information to the file
-    bitfile.write(astro.get_log_header())
-    bitfile.write(str(args))
-    bitfile.write("\n")
+    # One raw data file for the scan, readouts are assigned to pixels by the Start column of the summary
+    bitpath = args.outdir + '/' + fname + 'noise_scan_' + time.strftime("%Y%m%d-%H%M%S") + RAW_EXTENSION
+    # Raw data files are always saved, the header holds all the config information
+    bitfile = RawDataWriter(bitpath, astro.get_raw_header(args))
 
-    try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly
+    scan = NoiseScan(astro, maxruns=args.maxruns, maxtime=(args.maxtime*60. if args.maxtime is not None else None),
+                     noisethreshold=args.noisethreshold, inject=args.inject, pollmode=args.pollmode,
+                     rawfile=bitfile, hitsink=csvframe)
 
-        n_noise=0 # How many interrupts occurring during maximum run time per pixel
-        while (True): # Loop continues 
-
-            # Break conditions
-            if args.maxruns is not None:
-                if i >= args.maxruns: break
-            if args.maxtime is not None:
-                if time.time() >= end_time: break
-            
-            
-            if astro.hits_present(): # Checks if hits are present
-    
-                time.sleep(.001) # this is probably not needed, will ask Nicolas
-
-                readout = astro.get_readout(3) # Gets the bytearray from the chip
-
-                # Writes the hex version to hits
-                bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
-                #print(binascii.hexlify(readout))
-
-                # Added fault tolerance for decoding, the limits of which are set through arguments
-                try:
-                    hits = astro.decode_readout(readout, i, printer = False)
-                    if hits.empty:
-                        continue
-                    else:
-                        n_noise += 1
-
-                except IndexError:
-                    # We write out the failed decode dataframe
-                    hits = decode_fail_frame
-                    hits.readout = i
-                    hits.hittime = time.time()
-
-                finally:
-                    i += 1
-                    #n_noise += 1
-
-                    # If we are saving a csv this will write it out. 
-                    if args.saveascsv:
-                        csvframe = pd.concat([csvframe, hits])
-
-            # If no hits are present this waits for some to accumulate
-            else: time.sleep(.001)
-        
-        # Write noise scan summary per pixel
-        noisefile.write(f"{col},{row},{n_noise}\n")
-        noisefile.flush()
-        print(f"{col},{row},{n_noise}\n")
+    if args.inject:
+        astro.start_injection()
+
+    try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly
+        scan.run(pixels, summarypath)
     # Ends program cleanly when a keyboard interupt is sent.
     except KeyboardInterrupt:
         logger.info("Keyboard interupt. Program halt!")
@@ -178,8 +87,7 @@ def main(args,row,col,injectPix):
         logger.exception(f"Encountered Unexpected Exception! \n{e}")
     finally:
         if args.saveascsv: 
-            csvframe.index.name = "dec_order"
-            csvframe.to_csv(csvpath) 
+            csvframe.close()
         if args.inject: astro.stop_injection()   
         bitfile.close() # Close open file       
         astro.close_connection() # Closes SPI
@@ -223,6 +131,15 @@ if __name__ == "__main__":
     parser.add_argument('-R', '--rowrange', action='store', default=[0,33], type=int, nargs=2,
                     help =  'Loop over given range of rows. Default: 0 34')
 
+    parser.add_argument('-nt', '--noisethreshold', type=int, action='store', default=None,
+                    help = 'Stop counting a pixel once its count is above this threshold, as -nt of beam_test.py. Default: scan all pixels for maxruns/maxtime')
+
+    parser.add_argument('-d', '--diagonal', action='store_true', default=False, required=False,
+                    help = 'Scan diagonals of pixels without shared rows or columns at once, hits are assigned to pixels by location. Default: one pixel at a time')
+
+    parser.add_argument('--pollmode', action='store', default='interrupt', choices=['interrupt', 'speculative'],
+                    help = 'Readout polling: interrupt reads out only if the interrupt is set, speculative reads out on every poll. Default: interrupt')
+
     parser.add_argument('-L', '--loglevel', action='store', default=40, type=int, required=False,
                     help =  'Log output level CRITICAL ERROR WARNING INFO DEBUG NOTSET')
 
@@ -243,18 +160,13 @@ if __name__ == "__main__":
 
     logger = logging.getLogger(__name__)
 
-    # Save noise summary to output file
+    # Save noise summary to output file, written line by line during the scan
     noisepath = args.outdir + '/' + 'noise_scan_summary_' + args.name + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-    noisefile = open(noisepath,'w')
-    noisewriter = csv.writer(noisefile)
-    noisewriter.writerow(["Col", "Row", "Count"])
 
     #loop over full array by default, unless bounds are given as argument
-    for r in range(args.rowrange[0],args.rowrange[1]+1,1):
-        for c in range(args.colrange[0],args.colrange[1]+1,1):
-            injectPix=[r,c]
-            main(args,r,c,injectPix)
-            time.sleep(2) # to avoid loss of connection to Nexys
-    
-    # Close noise scan summary file
-    noisefile.close()
+    if args.diagonal:
+        pixels = diagonal_patterns(args.colrange, args.rowrange)
+    else:
+        pixels = scan_pixels(args.colrange, args.rowrange)
+
+    main(args, pixels, noisepath)
@@ -12,13 +12,13 @@ Author: Amanda Steinhebel
 from astropix import astropix3
 import modules.hitplotter as hitplotter
 import os
-import binascii
-import pandas as pd
 import numpy as np
 import time
 import logging
 import argparse
 
+from modules.hitsink import HitSink
+from modules.rawdata import RawDataWriter, RAW_EXTENSION
 from modules.setup_logger import logger
 
 
@@ -81,31 +81,16 @@ def main(args,row,col, fpgaCon:bool=True, fpgaDiscon:bool=True):
     # Prepares the file paths 
     if args.saveascsv: # Here for csv
         csvpath = args.outdir +'/' + fname + time.strftime("%Y%m%d-%H%M%S") + '.csv'
-        csvframe =pd.DataFrame(columns = [
-                'readout',
-                'Chip ID',
-                'payload',
-                'location',
-                'isCol',
-                'timestamp',
-                'tot_msb',
-                'tot_lsb',
-                'tot_total',
-                'tot_us',
-                'hittime'
-        ])
+        csvframe = HitSink(csvpath)
 
     # Prepares the file paths 
     # Save final configuration to output file    
     ymlpathout=args.outdir+pathdelim+args.yaml+"_"+fname+time.strftime("%Y%m%d-%H%M%S")+".yml"
     astro.write_conf_to_yaml(ymlpathout)
-    # And here for the text files/logs
-    bitpath = args.outdir + pathdelim + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
-    bitfile = open(bitpath,'w')
-    # Writes all the config information to the file
-    bitfile.write(astro.get_log_header())
-    bitfile.write(str(args))
-    bitfile.write("\n")
+    # Prepare raw data file
+    bitpath = args.outdir + pathdelim + fname + time.strftime("%Y%m%d-%H%M%S") + RAW_EXTENSION
+    # Raw data files are always saved, the header holds all the config information
+    bitfile = RawDataWriter(bitpath, astro.get_raw_header(args))
 
     try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly    
         while (True): # Loop continues 
@@ -119,8 +104,8 @@ def main(args,row,col, fpgaCon:bool=True, fpgaDiscon:bool=True):
 
                 readout = astro.get_readout(3) # Gets the bytearray from the chip
 
-                # Writes the hex version to hits
-                bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
+                # Writes the raw readout
+                bitfile.write(i, readout)
                 #print(binascii.hexlify(readout))
 
                 # Added fault tolerance for decoding, the limits of which are set through arguments
@@ -130,7 +115,7 @@ def main(args,row,col, fpgaCon:bool=True, fpgaDiscon:bool=True):
                     i += 1
                     # If we are saving a csv this will write it out. 
                     if args.saveascsv:
-                        csvframe = pd.concat([csvframe, hits])
+                        csvframe.append(hits)
             # If no hits are present this waits for some to accumulate
             else: time.sleep(.001)
     # Ends program cleanly when a keyboard interupt is sent.
@@ -141,8 +126,7 @@ def main(args,row,col, fpgaCon:bool=True, fpgaDiscon:bool=True):
         logger.exception(f"Encountered Unexpected Exception! \n{e}")
     finally:  
         if args.saveascsv: 
-            csvframe.index.name = "dec_order"
-            csvframe.to_csv(csvpath) 
+            csvframe.close()
         if boolInj is not None: astro.stop_injection() 
         bitfile.close() # Close open file       
         if fpgaDiscon:
@@ -10,6 +10,8 @@ import numpy as np
 import glob
 import os
 
+from modules.clustering import read_hits, select_hits, match_pixels, PIXEL_COLUMNS
+
 def main(args):
    
     # Path to beamdata location
@@ -22,61 +24,33 @@ def main(args):
         nfile = glob.glob(fname)
         all_files += nfile
 
-    # List for hit pixels
-    pair = []
+    # Hit pixels per file
+    pairs = []
     # How many events are used in plot
     n_evt_used = 0 
     tot_n_readouts = 0 
     # Loop over file
     for f in all_files:
-        # Read csv file
-        df = pd.read_csv(f)
+        # Read csv file, rows with NAN are skipped
+        df, _ = read_hits(f)
         print(f"Reading in {f}...")
-        # Skip rows with NAN
-        df = df.apply(pd.to_numeric, errors='coerce')
-        df = df.dropna()
-        # Changed float to int for readout col
-        df['readout'] = df['readout'].astype('Int64')
         # Get total number of readouts/events per run
         max_n_readouts = df['readout'].iloc[-1]
         tot_n_readouts += max_n_readouts
         print(f"{max_n_readouts} events were found...")
-        # Loop over readouts/events
-        for ievt in range(0, max_n_readouts, 1):
-            # Collect one event
-            if args.exclusively:
-                dff = df. loc[(df['readout'] == ievt)] 
-            else:
-                dff = df.loc[(df['readout'] == ievt) & (df['payload'] == 4)]
-            # Check how many bad decoding lines within one event 
-            n_no_good_decoding = 0
-            for payload in dff['payload']:
-                if payload != 4:
-                    n_no_good_decoding += 1 
-        
-            if n_no_good_decoding != 0:
-                pass
-            else:
-                n_evt_used += 1
-                # List column info of pixel within one event
-                dffcol = dff.loc[dff['isCol'] == True]
-                # List row info of pixel within one event
-                dffrow = dff.loc[dff['isCol'] == False]
-                # time difference in time over threshold (tot) in us to define a pixel
-                tot_time_limit = args.totdiff # before more exclusive cut on 0.3
-                timestamp_diff = args.timestampdiff# before more exclusive cut on exact same
-                # Loop over col and row info to find a pair to define a pixel
-                for indc in dffcol.index:
-                    for indr in dffrow.index:
-                        # Before more exclusive cut on timestamp like exact same
-                        if (abs(dffcol['timestamp'][indc] - dffrow['timestamp'][indr]) < timestamp_diff) & (abs(dffcol['tot_us'][indc] - dffrow['tot_us'][indr]) < tot_time_limit):
-                            # Record hit pixels per event
-                            pair.append([dffcol['location'][indc], dffrow['location'][indr], dffcol['timestamp'][indc], dffrow['timestamp'][indr], dffcol['tot_us'][indc], dffrow['tot_us'][indr]])
+        # Events up to the last readout
+        df = df[df['readout'] < max_n_readouts]
+        # Select good decodings, in exclusively mode drop events with any bad decoding
+        dff, excluded = select_hits(df, args.exclusively)
+        n_evt_used += max_n_readouts - len(excluded)
+        # Match col and row info to find a pair to define a pixel
+        # time difference in time over threshold (tot) in us and in timestamp to define a pixel
+        pairs.append(match_pixels(dff, args.timestampdiff, args.totdiff))
 
     # Calculate how many events are used
     nevents = '%.2f' % ((n_evt_used/(tot_n_readouts + 1)) * 100.)
     # Hit pixel information for all events
-    dffpair = pd.DataFrame(pair, columns=['col', 'row', 'timestamp_col', 'timestamp_row', 'tot_us_col', 'tot_us_row'])
+    dffpair = pd.concat(pairs, ignore_index=True) if pairs else pd.DataFrame(columns=PIXEL_COLUMNS)
     # For heatmap plot, it needs col, row, and hits 
     dfpair = dffpair[['col','row']].copy()
     dfpairc = dfpair[['col','row']].value_counts().reset_index(name='hits')
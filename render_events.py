@@ -0,0 +1,94 @@
+"""
+Render event displays of decoded beam data offline, without a display and in parallel.
+Events are shown as row and column strips as in the live HitPlotter display.
+
+Run: python3.9 render_events.py -f "./data/run22_*.csv" -o ./plots -m sheet
+"""
+
+import glob
+import logging
+import argparse
+import os
+
+from modules.aggregation import read_geometry
+from modules.clustering import read_hits
+from modules.eventrender import split_events, render_events, RENDER_MODES, EVENT_COLORS
+from modules.setup_logger import logger
+
+
+def main(args):
+
+    # Matrix size from chip config
+    num_cols, num_rows = read_geometry('./config/' + args.yaml + '.yml')
+
+    inputFiles = sorted(file for pattern in args.fileInput for file in glob.glob(pattern))
+    if not inputFiles:
+        logger.error("No decoded data files found")
+        return
+
+    colors = EVENT_COLORS if args.all else ['orange', 'red']
+
+    for infile in inputFiles:
+        # Read decoded hits, lines of failed decodings are skipped
+        hits, _ = read_hits(infile)
+        events = split_events(hits, colors, args.maxevents)
+        logger.info(f"{len(events)} events to render in {infile}")
+
+        name = os.path.splitext(os.path.basename(infile))[0]
+        outdir = os.path.join(args.outdir, name) if args.mode == 'pdf' else args.outdir
+
+        paths = render_events(events, outdir, mode=args.mode, nPix=(num_rows, num_cols), grid=args.grid,
+                              pages=args.pages, workers=args.jobs, name=name)
+
+        for path in paths:
+            print(f"{path} was created...")
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description='Offline event display rendering')
+    parser.add_argument('-f', '--fileInput', nargs='+', required=True,
+                    help='Decoded data file(s) (CSV), wildcards allowed')
+
+    parser.add_argument('-o', '--outdir', default='./plots', required=False,
+                    help='Output directory for rendered events. Default: ./plots')
+
+    parser.add_argument('-y', '--yaml', action='store', required=False, type=str, default = 'testconfig_v3',
+                    help = 'filepath (in config/ directory) .yml file containing chip configuration, used for the matrix size. Default: config/testconfig_v3.yml')
+
+    parser.add_argument('-m', '--mode', choices=RENDER_MODES, default='multipage', required=False,
+                    help='pdf: one PDF per event, multipage: multi-page PDFs, sheet: PNG contact sheets. Default: multipage')
+
+    parser.add_argument('-j', '--jobs', type=int, action='store', default=None, required=False,
+                    help='Number of rendering processes, 1 renders without process pool. Default: number of CPUs')
+
+    parser.add_argument('-N', '--maxevents', type=int, action='store', default=None, required=False,
+                    help='Maximum number of events rendered per file. Default: all')
+
+    parser.add_argument('--all', action='store_true', default=False, required=False,
+                    help='Render all events, not only events with more than one row or column hit. Default: False')
+
+    parser.add_argument('--grid', type=int, nargs=2, default=[5, 5], required=False,
+                    help='Events per contact sheet, rows and columns. Default: 5 5')
+
+    parser.add_argument('--pages', type=int, action='store', default=500, required=False,
+                    help='Events per multi-page PDF. Default: 500')
+
+    parser.add_argument('-L', '--loglevel', type=str, choices = ['D', 'I', 'E', 'W', 'C'], action="store", default='I',
+                    help='Set loglevel used. Options: D - debug, I - info, E - error, W - warning, C - critical. DEFAULT: I')
+
+    args = parser.parse_args()
+
+    loglevel = {'D': logging.DEBUG, 'I': logging.INFO, 'E': logging.ERROR,
+                'W': logging.WARNING, 'C': logging.CRITICAL}[args.loglevel]
+
+    formatter = logging.Formatter('%(asctime)s:%(msecs)d.%(name)s.%(levelname)s:%(message)s')
+    sh = logging.StreamHandler()
+    sh.setFormatter(formatter)
+
+    logging.getLogger().addHandler(sh)
+    logging.getLogger().setLevel(loglevel)
+
+    logger = logging.getLogger(__name__)
+
+    main(args)
@@ -0,0 +1,7 @@
+"""
+Tests run from the repository root like the scripts, modules are imported as core.* and modules.*
+"""
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
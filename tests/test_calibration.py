@@ -0,0 +1,141 @@
+"""
+S-curve and ToT fits on synthetic injection scans with known pixels, and applying the calibration to hits
+
+Run: python3.9 -m pytest tests
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from modules.calibration import (CALIBRATION_DTYPE, Calibration, calibrate, fit_lines, fit_scurves,
+                                 load_calibration, save_calibration, scurve)
+
+STEPS = np.arange(0., 400., 10.)
+NINJECTIONS = 100
+
+
+def synthetic_scan(seed: int, num_cols: int = 35, num_rows: int = 35) -> tuple:
+    """
+    Binomial hit counts and mean ToT of pixels with random threshold, noise and ToT line
+
+    :returns: Tuple of counts, mean ToT and the true threshold, noise, slope and offset
+    """
+
+    rng = np.random.default_rng(seed)
+    shape = (num_cols, num_rows)
+
+    threshold = rng.uniform(150., 250., shape)
+    noise = rng.uniform(5., 30., shape)
+    slope = rng.uniform(0.02, 0.05, shape)
+    offset = rng.uniform(-2., 2., shape)
+
+    counts = rng.binomial(NINJECTIONS, scurve(STEPS, threshold[..., None], noise[..., None]))
+
+    # Mean over the hits of a step, ToT spread 0.5 us per hit
+    with np.errstate(invalid='ignore', divide='ignore'):
+        mean_tot = slope[..., None] * STEPS + offset[..., None] + rng.normal(0., 0.5, counts.shape) / np.sqrt(counts)
+    mean_tot = np.where(counts > 0, mean_tot, np.nan)
+
+    return counts, mean_tot, threshold, noise, slope, offset
+
+
+def test_fit_scurves():
+    counts, _, threshold, noise, _, _ = synthetic_scan(1)
+
+    fitted, fitted_noise, chi2 = fit_scurves(STEPS, counts, NINJECTIONS)
+
+    assert fitted.shape == threshold.shape
+    assert np.median(np.abs(fitted - threshold)) < 2.
+    assert np.median(np.abs(fitted_noise - noise) / noise) < 0.1
+
+    # Binomial counts, chi2 per degree of freedom of the rising steps near 1
+    assert 0.8 < np.median(chi2) < 1.2
+
+
+def test_fit_scurves_unsorted_and_without_hits():
+    counts, _, threshold, _, _, _ = synthetic_scan(2, 4, 4)
+    counts[0, 0] = 0
+
+    order = np.random.default_rng(2).permutation(len(STEPS))
+    fitted, noise, chi2 = fit_scurves(STEPS[order], counts[..., order], NINJECTIONS)
+
+    assert np.isnan(fitted[0, 0]) and np.isnan(noise[0, 0]) and np.isnan(chi2[0, 0])
+    assert np.all(np.abs(fitted - threshold)[np.isfinite(fitted)] < 10.)
+
+
+def test_fit_lines():
+    rng = np.random.default_rng(3)
+    slope = rng.uniform(0.02, 0.05, 100)
+    offset = rng.uniform(-2., 2., 100)
+
+    y = slope[:, None] * STEPS + offset[:, None]
+    y[:, ::3] = np.nan
+    y[0, 1:] = np.nan
+
+    fitted_slope, fitted_offset = fit_lines(STEPS, y)
+
+    # One point is not enough for a line
+    assert np.isnan(fitted_slope[0]) and np.isnan(fitted_offset[0])
+    np.testing.assert_allclose(fitted_slope[1:], slope[1:])
+    np.testing.assert_allclose(fitted_offset[1:], offset[1:], atol=1e-9)
+
+
+def test_calibrate(tmp_path):
+    counts, mean_tot, threshold, _, slope, offset = synthetic_scan(4)
+
+    calibration = calibrate(STEPS, counts, mean_tot, NINJECTIONS)
+
+    assert calibration.dtype == CALIBRATION_DTYPE
+    assert calibration['valid'].all()
+    assert np.median(np.abs(calibration['threshold'] - threshold)) < 2.
+    assert np.median(np.abs(calibration['tot_slope'] - slope) / slope) < 0.04
+    assert np.median(np.abs(calibration['tot_offset'] - offset)) < 0.2
+
+    filename = tmp_path / 'calibration.npy'
+    save_calibration(filename, calibration)
+    np.testing.assert_array_equal(load_calibration(filename), calibration)
+
+
+def calibration_array(num_cols: int = 4, num_rows: int = 3) -> np.ndarray:
+    """Calibration with slope 0.01 * (col + 1) and offset row, pixel [1, 1] invalid"""
+
+    calibration = np.zeros((num_cols, num_rows), dtype=CALIBRATION_DTYPE)
+    calibration['tot_slope'] = 0.01 * (np.arange(num_cols)[:, None] + 1)
+    calibration['tot_offset'] = np.arange(num_rows)[None, :]
+    calibration['valid'] = True
+    calibration['valid'][1, 1] = False
+
+    return calibration
+
+
+@pytest.mark.parametrize('kev_per_mv', [None, 0.5])
+def test_apply_pixels(kev_per_mv):
+    calib = Calibration(calibration_array(), kev_per_mv)
+
+    pixels = pd.DataFrame({'col': [0, 3, 1, 4, -1, 0],
+                           'row': [0, 2, 1, 0, 0, 3],
+                           'avg_tot_us': [1., 2.4, 1., 1., 1., 1.]})
+    calibrated = calib.apply_pixels(pixels)
+
+    # [0, 0] and [3, 2] inside, [1, 1] invalid, the rest outside the matrix
+    expected = np.array([1. / 0.01, (2.4 - 2.) / 0.04, np.nan, np.nan, np.nan, np.nan])
+    np.testing.assert_allclose(calibrated['charge_mv'], expected)
+
+    assert calib.columns == (['charge_mv'] if kev_per_mv is None else ['charge_mv', 'energy_kev'])
+    if kev_per_mv is not None:
+        np.testing.assert_allclose(calibrated['energy_kev'], expected * kev_per_mv)
+
+
+def test_apply_strips():
+    calib = Calibration(calibration_array(), 1.)
+
+    hits = pd.DataFrame({'isCol': [True, True, False, False, False],
+                         'location': [1, 3, 0, 1, 3],
+                         'tot_us': [1., 1., 1., 1., 1.]})
+    calibrated = calib.apply(hits)
+
+    # Column 1 without the invalid pixel [1, 1]: slope 0.02, offsets 0 and 2
+    # Row 1 without [1, 1]: slopes 0.01, 0.03, 0.04, offset 1. Row 3 is beyond the matrix
+    expected = np.array([(1. - 1.) / 0.02, (1. - 1.) / 0.04, 1. / 0.025, 0., np.nan])
+    np.testing.assert_allclose(calibrated['charge_mv'], expected)
+    np.testing.assert_allclose(calibrated['energy_kev'], expected)
@@ -0,0 +1,134 @@
+"""
+Parity of the vectorized decoder with the byte-by-byte decoder, and frames split across readouts
+
+Run: python3.9 -m pytest tests
+"""
+import numpy as np
+import pandas as pd
+import pytest
+
+from core.decode import Decode, StreamingDecoder
+
+IDLE_BYTES = {True: 0xbc, False: 0x3d}
+
+
+def random_stream(rng: np.random.Generator, reverse_bitorder: bool) -> bytearray:
+    """
+    Readout stream of idle bytes, 0xff and frames with random content, possibly truncated at the end
+
+    Frame bytes are random, so frames may start with an idle byte or contain idle bytes. Both
+    decoders have to resync the same way then.
+    """
+
+    idle = IDLE_BYTES[reverse_bitorder]
+    stream = bytearray()
+
+    for _ in range(rng.integers(0, 40)):
+        kind = rng.integers(0, 3)
+        if kind == 0:
+            stream.extend([idle] * int(rng.integers(1, 10)))
+        elif kind == 1:
+            stream.extend([0xff] * int(rng.integers(1, 4)))
+        else:
+            stream.extend(rng.integers(0, 256, 5, dtype=np.uint8).tobytes())
+
+    return stream[:len(stream) - int(rng.integers(0, 5))]
+
+
+def decode_scalar(decoder: Decode, stream: bytearray, reverse_bitorder: bool) -> pd.DataFrame:
+    """Complete frames of the stream decoded byte by byte"""
+
+    hits = decoder.hits_from_readoutstream(bytearray(stream), reverse_bitorder)
+
+    return decoder.decode_astropix2_hits(hits)
+
+
+@pytest.mark.parametrize('reverse_bitorder', [True, False])
+def test_hits_from_readoutstream_np(reverse_bitorder):
+    rng = np.random.default_rng(1)
+    decoder = Decode()
+
+    for _ in range(3000):
+        stream = random_stream(rng, reverse_bitorder)
+
+        expected = [bytes(hit) for hit in decoder.hits_from_readoutstream(bytearray(stream), reverse_bitorder)
+                    if len(hit) == decoder.bytesperhit]
+        hits = decoder.hits_from_readoutstream_np(stream, reverse_bitorder)
+
+        assert [hit.tobytes() for hit in hits] == expected
+
+
+@pytest.mark.parametrize('reverse_bitorder', [True, False])
+def test_decode_astropix2_hits_np(reverse_bitorder):
+    rng = np.random.default_rng(2)
+    decoder = Decode()
+
+    for _ in range(3000):
+        stream = random_stream(rng, reverse_bitorder)
+
+        expected = decode_scalar(decoder, stream, reverse_bitorder)
+        decoded = decoder.decode_astropix2_hits_np(decoder.hits_from_readoutstream_np(stream, reverse_bitorder))
+
+        pd.testing.assert_frame_equal(decoded, expected, check_dtype=False)
+
+
+@pytest.mark.parametrize('reverse_bitorder', [True, False])
+def test_streaming_split_at_every_byte(reverse_bitorder):
+    rng = np.random.default_rng(3)
+    idle = IDLE_BYTES[reverse_bitorder]
+
+    # Frames without idle bytes, separated by idle gaps, so every split lands in a known place
+    frames = rng.integers(0, 256, (20, 5), dtype=np.uint8)
+    frames[frames == idle] = 0
+    frames[frames == 0xff] = 0
+
+    stream = bytearray()
+    for frame in frames:
+        stream.extend(frame.tobytes())
+        stream.extend([idle] * int(rng.integers(0, 3)))
+
+    expected = decode_scalar(Decode(), stream, reverse_bitorder)
+    assert len(expected) == len(frames)
+
+    for split in range(len(stream) + 1):
+        decoder = StreamingDecoder(reverse_bitorder=reverse_bitorder)
+        decoded = pd.concat([decoder.feed(stream[:split]), decoder.feed(stream[split:])], ignore_index=True)
+
+        pd.testing.assert_frame_equal(decoded, expected, check_dtype=False)
+        assert decoder.pending == 0
+
+
+@pytest.mark.parametrize('reverse_bitorder', [True, False])
+def test_streaming_random_chunks(reverse_bitorder):
+    rng = np.random.default_rng(4)
+
+    for _ in range(500):
+        stream = random_stream(rng, reverse_bitorder)
+        cuts = np.sort(rng.integers(0, len(stream) + 1, rng.integers(0, 8)))
+
+        decoder = StreamingDecoder(reverse_bitorder=reverse_bitorder)
+        chunks = np.split(np.frombuffer(bytes(stream), dtype=np.uint8), cuts)
+        hits = np.concatenate([decoder.feed_hits(chunk.tobytes()) for chunk in chunks])
+
+        expected = Decode().hits_from_readoutstream_np(stream, reverse_bitorder)
+
+        np.testing.assert_array_equal(hits, expected)
+
+
+def test_streaming_tail_and_reset():
+    decoder = StreamingDecoder()
+    frame = bytes([0x21, 0x85, 0x10, 0x02, 0x40])
+
+    assert decoder.feed(frame[:3]).empty
+    assert decoder.pending == 3
+    assert decoder.tail == frame[:3]
+
+    # A new decoder fed with the tail continues the stream
+    restored = StreamingDecoder()
+    restored.feed(decoder.tail)
+    assert len(restored.feed(frame[3:] + bytes([0xbc] * 4))) == 1
+
+    # After a reset the dropped bytes are not completed with the next frame
+    decoder.reset()
+    assert decoder.pending == 0
+    pd.testing.assert_frame_equal(decoder.feed(frame + bytes([0xbc] * 4)), restored.feed(frame + bytes([0xbc] * 4)))
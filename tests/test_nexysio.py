@@ -0,0 +1,135 @@
+"""
+Parity of the numpy SR pattern generation with the former bit by bit implementation
+
+Run: python3.9 -m pytest tests
+"""
+import numpy as np
+import pytest
+from bitstring import BitArray
+
+from core.nexysio import Nexysio, WRITE_ADRESS, SR_ASIC_ADRESS, SIN_ASIC, LD_ASIC, SIN_GECCO, LD_GECCO
+
+CLKDIVS = [0, 1, 2, 8, 16]
+
+
+def addbytes_reference(value: bytearray, clkdiv: int) -> bytearray:
+    data = bytearray()
+
+    for byte in value:
+        data.extend([byte] * max(clkdiv, 1))
+
+    return data
+
+
+def asic_pattern_reference(value, wload: bool, clkdiv: int = 8, readback_mode=False) -> bytes:
+    """gen_asic_pattern_part before the numpy version, bitstring loop per bit"""
+
+    if not readback_mode:
+        length = (len(value) * 5 + 30) * clkdiv
+    else:
+        length = ((len(value)+1) * 5) * clkdiv
+
+    header = bytearray([WRITE_ADRESS, SR_ASIC_ADRESS, length >> 8, length % 256])
+
+    data, load = bytearray(), bytearray()
+
+    if not readback_mode:
+        for bit in value:
+            pattern = SIN_ASIC if bit == 1 else 0
+
+            data.extend([pattern, pattern | 1, pattern, pattern | 2, pattern])
+
+        if wload:
+            load.extend([0x00, LD_ASIC, 0x00])
+
+        data = addbytes_reference(data, clkdiv)
+        data.extend(addbytes_reference(load, clkdiv * 10))
+
+    else:
+        data.extend([4 | 32, 4 | 33, 4|32, 4 | 34, 4|32])
+        for bit in value:
+            data.extend([4 , 4 | 1, 4, 4 | 2, 4])
+        data = addbytes_reference(data, clkdiv)
+
+    return b''.join([header, data])
+
+
+def gecco_pattern_reference(address: int, value, clkdiv: int = 16) -> bytes:
+    """gen_gecco_pattern before the numpy version, bitstring loop per bit"""
+
+    length = (len(value) * 3 + 20) * clkdiv
+
+    header = bytearray([WRITE_ADRESS, address, length >> 8, length % 256])
+
+    data = bytearray()
+
+    for bit in value:
+        pattern = SIN_GECCO if bit == 1 else 0
+
+        data.extend([pattern, pattern | 1, pattern])
+
+    data.extend([LD_GECCO, 0x00])
+    data.extend([0x01, 0x00] * 8)
+    data.extend([LD_GECCO, 0x00])
+
+    data = addbytes_reference(data, clkdiv)
+
+    return b''.join([header, data])
+
+
+def random_vectors(seed: int, lengths: list, clkdiv: int = 1) -> list:
+    """
+    BitArrays of the given lengths, all zeros, all ones and random bits
+
+    Lengths longer than one SR part at clkdiv are skipped, gen_asic_pattern splits those.
+    """
+
+    rng = np.random.default_rng(seed)
+    vectors = []
+
+    for length in lengths:
+        if (length * 5 + 30) * clkdiv > 65534:
+            continue
+
+        vectors.append(BitArray(uint=0, length=length))
+        vectors.append(~BitArray(uint=0, length=length))
+        vectors.append(BitArray(rng.integers(0, 2, length).tolist()))
+
+    return vectors
+
+
+@pytest.mark.parametrize('clkdiv', CLKDIVS)
+@pytest.mark.parametrize('readback_mode', [False, True])
+def test_gen_asic_pattern_part(clkdiv, readback_mode):
+    nexys = Nexysio()
+
+    # 1545 bits is the config vector of one AstroPix3
+    for value in random_vectors(clkdiv, [1, 7, 8, 64, 131, 789, 1545], clkdiv):
+        expected = asic_pattern_reference(value, True, clkdiv, readback_mode)
+
+        assert nexys.gen_asic_pattern_part(value, True, clkdiv, readback_mode) == expected
+
+
+@pytest.mark.parametrize('clkdiv', CLKDIVS)
+def test_gen_asic_pattern_part_without_load(clkdiv):
+    nexys = Nexysio()
+
+    for value in random_vectors(clkdiv + 10, [1, 64, 789, 1545], clkdiv):
+        pattern = nexys.gen_asic_pattern_part(value, False, clkdiv)
+        expected = asic_pattern_reference(value, False, clkdiv)
+
+        # Data is unchanged, the header no longer counts the 30 bytes of the load signal that is not sent
+        assert pattern[4:] == expected[4:]
+        assert int.from_bytes(pattern[2:4], 'big') == len(value) * 5 * clkdiv
+
+
+@pytest.mark.parametrize('clkdiv', CLKDIVS)
+def test_gen_gecco_pattern(clkdiv):
+    nexys = Nexysio()
+
+    for address in (1, 12):
+        # 136 bits is the vector of the 8 DAC voltage board
+        for value in random_vectors(address + clkdiv, [1, 16, 136], clkdiv):
+            expected = gecco_pattern_reference(address, value, clkdiv)
+
+            assert nexys.gen_gecco_pattern(address, value, clkdiv) == expected
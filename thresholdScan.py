@@ -1,22 +1,20 @@
 """
-Script to loop through pixels enabling one at a time, using astropix.py. 
-For a variety of threshold values, loop over full array and only record the number of times 
-the comparator would have fired. 
+Script to loop through pixels enabling one at a time, using astropix.py.
+For every pixel, find the threshold at which the comparator fires at a given rate by
+bisecting the threshold voltage, instead of recording counts for a fixed list of thresholds.
 Based off beam_test.py and example_loop.py
 
 Author: Amanda Steinhebel
 """
 
-from astropix import astropix2
-import modules.hitplotter as hitplotter
+from astropix import astropix3
 import os
-import binascii
-import pandas as pd
-import numpy as np
 import time
 import logging
 import argparse
 
+from modules.rawdata import RawDataWriter, RAW_EXTENSION
+from modules.thresholdscan import ThresholdScan
 from modules.setup_logger import logger
 
 
@@ -28,94 +26,67 @@ logname = "./runlogs/AstropixRunlog_" + time.strftime("%Y%m%d-%H%M%S") + ".log"
 
 
 
-#Init 
-def main(args,row,col,dataF, fpgaCon:bool=True, fpgaDiscon:bool=True):
+#Init
+def main(args, pixels, summarypath):
 
     # Ensures output directory exists
     if os.path.exists(args.outdir) == False:
         os.mkdir(args.outdir)
 
-    if fpgaCon:
-        # Prepare everything, create the object
-        global astro 
-        logger.info('Initiate FPGA connection')
-        astro = astropix2() #initialize without enabling injections
+    # Prepare everything, create the object once for the whole scan
+    logger.info('Initiate FPGA connection')
+    astro = astropix3()
 
-    astro.init_voltages(vthreshold=args.threshold) 
+    astro.init_voltages(vthreshold=args.vmax)
 
     #Define YAML path variables
     pathdelim=os.path.sep #determine if Mac or Windows separators in path name
     ymlpath="config"+pathdelim+args.yaml+".yml"
 
-    #Initiate asic with pixel mask as defined in yaml 
+    #Initiate asic with pixel mask as defined in yaml
     astro.asic_init(yaml=ymlpath)
 
-    #Enable single pixel in (col,row)
-    #Updates asic by default
-    astro.enable_pixel(col,row)
-
-
-    astro.enable_spi() 
+    # If injection is on initalize the board, the injection switches follow the scanned pixel
+    if args.inject:
+        astro.init_injection(inj_voltage=args.vinj)
+    astro.enable_spi()
     logger.info("Chip configured")
     astro.dump_fpga()
 
-    i = 0
-    if args.maxtime is not None: 
-        end_time=time.time()+(args.maxtime*60.)
-    strPix = "_"+str(args.threshold)[:-2]+"mVThresh_col"+str(col)+"_row"+str(row)+"_"
-    fname=strPix if not args.name else args.name+strPix+"_"
+    fname="" if not args.name else args.name+"_"
 
-    # Prepares the file paths 
-    # Save final configuration to output file    
-    ymlpathout=outdir+pathdelim+args.yaml+"_"+fname+time.strftime("%Y%m%d-%H%M%S")+".yml"
+    # Save final configuration to output file
+    ymlpathout=args.outdir+pathdelim+args.yaml+"_"+fname+time.strftime("%Y%m%d-%H%M%S")+".yml"
     astro.write_conf_to_yaml(ymlpathout)
-    # And here for the text files/logs
-    bitpath = outdir + pathdelim + fname + time.strftime("%Y%m%d-%H%M%S") + '.log'
-    bitfile = open(bitpath,'w')
-    # Writes all the config information to the file
-    bitfile.write(astro.get_log_header())
-    bitfile.write(str(args))
-    bitfile.write("\n")
-
-    try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly    
-        while (True): # Loop continues 
-            # Break conditions
-            if args.maxtime is not None:
-                if time.time() >= end_time: break
-            
-            if astro.hits_present(): # Checks if hits are present
-    
-                time.sleep(.001) # this is probably not needed, will ask Nicolas
-
-                readout = astro.get_readout(3) # Gets the bytearray from the chip
-
-                # Writes the hex version to hits
-                bitfile.write(f"{i}\t{str(binascii.hexlify(readout))}\n")
-                #print(binascii.hexlify(readout))
-                i += 1
-                astro.asic_update() #must be done after every interrupt check
-
-            # If no hits are present this waits for some to accumulate
-            else: time.sleep(.001)
+    # One raw data file for the scan, the header holds all the config information
+    bitpath = args.outdir + pathdelim + fname + 'threshold_scan_' + time.strftime("%Y%m%d-%H%M%S") + RAW_EXTENSION
+    bitfile = RawDataWriter(bitpath, astro.get_raw_header(args))
+
+    # The chip is reset after every readout, so every readout counts one comparator firing
+    scan = ThresholdScan(astro, maxtime=args.maxtime, rate=args.rate, vmin=args.vmin, vmax=args.vmax,
+                         precision=args.precision, inject=args.inject, rawfile=bitfile, rearm=True)
+
+    if args.inject:
+        astro.start_injection()
+
+    try: # By enclosing the main loop in try/except we are able to capture keyboard interupts cleanly
+        scan.run(pixels, summarypath)
     # Ends program cleanly when a keyboard interupt is sent.
     except KeyboardInterrupt:
         logger.info("Keyboard interupt. Program halt!")
     # Catches other exceptions
     except Exception as e:
         logger.exception(f"Encountered Unexpected Exception! \n{e}")
-    finally:  
-        interrfile = open(interrpath,'a+')
-        interrfile.write(f"{r} \t {i} \n")
-        interrfile.close()
-        bitfile.close() # Close open file       
-        if fpgaDiscon:
-            astro.close_connection() # Closes SPI
-            logger.info('FPGA Connection ended')
+    finally:
+        if args.inject: astro.stop_injection()
+        bitfile.close() # Close open file
+        astro.close_connection() # Closes SPI
+        logger.info('FPGA Connection ended')
         logger.info("Program terminated successfully")
     # END OF PROGRAM
 
 
-    
+
 
 if __name__ == "__main__":
 
@@ -126,14 +97,29 @@ if __name__ == "__main__":
     parser.add_argument('-o', '--outdir', default='.', required=False,
                     help='Output Directory for all datafiles')
 
-    parser.add_argument('-y', '--yaml', action='store', required=False, type=str, default = 'testconfig',
-                    help = 'filepath (in config/ directory) .yml file containing chip configuration. Default: config/testconfig.yml (All pixels off)')
+    parser.add_argument('-y', '--yaml', action='store', required=False, type=str, default = 'testconfig_v3',
+                    help = 'filepath (in config/ directory) .yml file containing chip configuration. Default: config/testconfig_v3.yml (All pixels off)')
+
+    parser.add_argument('-i', '--inject', action='store_true', default=False, required=False,
+                    help =  'Turn on injection into the scanned pixel. Default: No injection')
+
+    parser.add_argument('-v','--vinj', action='store', default = None, type=float,
+                    help = 'Specify injection voltage (in mV). DEFAULT 300 mV')
 
-    parser.add_argument('-t', '--threshold', type = float, action='store', default=None,
-                    help = 'Threshold voltage for digital ToT (in mV). DEFAULT 100mV')
+    parser.add_argument('--vmin', type = float, action='store', default=0.,
+                    help = 'Lowest threshold voltage (in mV). DEFAULT 0 mV')
 
-    parser.add_argument('-M', '--maxtime', type=float, action='store', default=None,
-                    help = 'Maximum run time (in minutes)')
+    parser.add_argument('--vmax', type = float, action='store', default=700.,
+                    help = 'Highest threshold voltage (in mV). DEFAULT 700 mV')
+
+    parser.add_argument('-p', '--precision', type = float, action='store', default=5.,
+                    help = 'Stop when the threshold is known to this precision (in mV). DEFAULT 5 mV')
+
+    parser.add_argument('--rate', type = float, action='store', default=1.,
+                    help = 'Hit rate at the threshold (in Hz), with injection e.g. half the injection rate. DEFAULT 1 Hz')
+
+    parser.add_argument('-M', '--maxtime', type=float, action='store', default=1.,
+                    help = 'Measurement time per threshold step (in s), steps above the rate end early. DEFAULT 1 s')
 
     parser.add_argument('-C', '--colrange', action='store', default=[0,34], type=int, nargs=2,
                     help =  'Loop over given range of columns. Default: 0 34')
@@ -141,41 +127,31 @@ if __name__ == "__main__":
     parser.add_argument('-R', '--rowrange', action='store', default=[0,34], type=int, nargs=2,
                     help =  'Loop over given range of rows. Default: 0 34')
 
+    parser.add_argument('-L', '--loglevel', action='store', default=20, type=int, required=False,
+                    help =  'Log output level CRITICAL ERROR WARNING INFO DEBUG NOTSET')
+
     parser.add_argument
     args = parser.parse_args()
-    
+
     # Logging
-    loglevel = logging.INFO
+    loglevel = args.loglevel
     formatter = logging.Formatter('%(asctime)s:%(msecs)d.%(name)s.%(levelname)s:%(message)s')
     fh = logging.FileHandler(logname)
     fh.setFormatter(formatter)
     sh = logging.StreamHandler()
     sh.setFormatter(formatter)
 
-    logging.getLogger().addHandler(sh) 
+    logging.getLogger().addHandler(sh)
     logging.getLogger().addHandler(fh)
     logging.getLogger().setLevel(loglevel)
 
     logger = logging.getLogger(__name__)
 
-    #loop over threshold values for long weekend run 
-    threshs = [25., 50., 75., 100., 150., 200.]
-    for t in threshs:
-        args.threshold = t
-        outdir = args.outdir + "/" + str(args.threshold)[:-2] + 'mV'
-        if os.path.exists(outdir) == False:
-            os.mkdir(outdir)
-        #loop over full array by default, unless bounds are given as argument
-        for c in range(args.colrange[0],args.colrange[1]+1,1):
-            interrpath = outdir + '/counts_' + str(args.threshold)[:-2] + 'mVThresh_' + args.name +'_col' + str(c) + "_"+ time.strftime("%Y%m%d-%H%M%S") + '.txt'
-            interrfile = open(interrpath,'a+')
-            interrfile.write(f"Row \t Counts \n")
-            interrfile.close()
-            for r in range(args.rowrange[0],args.rowrange[1]+1,1):
-                if r==args.rowrange[0] and c==args.colrange[0]:#first pixel probed - connect to FPGA but leave open
-                    main(args,r,c, interrpath, fpgaDiscon=False)
-                elif r==args.rowrange[1] and c==args.colrange[1]: #final pixel probed - disconnect from FPGA upon completion
-                    main(args,r,c, interrpath, fpgaCon=False)
-                else: #for bulk of pixels, FPGA is already open. Do not reconnect and do not disconnect when completed, leave it open for the next pixel
-                    main(args,r,c, interrpath, fpgaCon=False, fpgaDiscon=False)
-            
\ No newline at end of file
+    # Threshold per pixel, written line by line during the scan
+    summarypath = args.outdir + '/' + 'threshold_scan_summary_' + args.name + time.strftime("%Y%m%d-%H%M%S") + '.csv'
+
+    #loop over full array by default, unless bounds are given as argument, columns in the outer loop
+    pixels = [(c, r) for c in range(args.colrange[0],args.colrange[1]+1,1)
+              for r in range(args.rowrange[0],args.rowrange[1]+1,1)]
+
+    main(args, pixels, summarypath)